@@ -1,54 +1,270 @@
+import calendar
 import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 import urllib3
 from pvwa_integration import PvwaIntegration
 import aws_services
+import circuit_breaker
 import instance_processing
+import kp_processing
 import pvwa_api_calls
+import retry_mechanism
 from log_mechanism import LogMechanism
 
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+DEFAULT_BATCH_WORKERS = 10
+LOOKUPS_PER_EVENT = 3  # Instance item, instance details and stored parameters are looked up concurrently
 logger = LogMechanism()
 pvwa_integration_class = PvwaIntegration()
+# State change events dropped by the idempotency check, published at the end of each invocation
+skipped_events = {'duplicate': 0, 'stale': 0}
+skipped_events_lock = threading.Lock()
 
 def lambda_handler(event, context):
     logger.trace(context, caller_name='lambda_handler')
+    retry_mechanism.set_lambda_deadline(context)
     logger.info('Parsing event')
     try:
-        message = event["Records"][0]["Sns"]["Message"]
-        data = json.loads(message)
+        solution_account_id = context.invoked_function_arn.split(':')[4]
+        log_name = context.log_stream_name if context.log_stream_name else "None"
     except Exception as e:
-        logger.error(f"Error on retrieving Message Data from Event Message. Error: {e}")
+        logger.error(f"Error on retrieving Lambda context details. Error: {e}")
+        raise e
+
+    event_records = get_event_records(event)
+    logger.info(f'{len(event_records)} record(s) received')
+    batch_item_failures = []
+    workers = min(get_batch_workers(), len(event_records)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(message_id, executor.submit(process_record, data, solution_account_id, log_name))
+                   for message_id, data in event_records]
+        for message_id, future in futures:
+            if not future.result():
+                batch_item_failures.append({"itemIdentifier": message_id})
+    if batch_item_failures:
+        logger.error(f'{len(batch_item_failures)} out of {len(event_records)} record(s) failed')
+    log_ppk_cache_statistics()
+    log_skipped_events()
+    if batch_item_failures and not is_sqs_delivery(event):
+        # SNS and EventBridge invoke the lambda asynchronously and ignore batchItemFailures, a failed invocation is
+        # retried by Lambda and then sent to the dead letter queue
+        raise Exception(f'{len(batch_item_failures)} out of {len(event_records)} record(s) failed')
+    return {"batchItemFailures": batch_item_failures}
+
+
+# Logs the hit rate of the key pair conversion cache for this invocation
+def log_ppk_cache_statistics():
+    hits, misses = kp_processing.pop_ppk_cache_statistics()
+    if hits + misses:
+        hit_rate = hits * 100 / (hits + misses)
+        logger.info(f'PPK conversion cache: {hits} hit(s), {misses} miss(es), {hit_rate:.0f}% hit rate')
+        logger.metric('PpkConversionCacheHitRate', hit_rate, unit='Percent')
+
+
+# Returns a list of (message id, EC2 state change event) from SNS, SQS or raw EventBridge deliveries
+def get_event_records(event):
+    logger.trace(event, caller_name='get_event_records')
+    if "Records" not in event:  # EventBridge invokes the Lambda directly with a single event
+        return [(event.get("id", ""), event)]
+    event_records = []
+    for record in event["Records"]:
+        try:
+            if "Sns" in record:
+                message_id = record["Sns"]["MessageId"]
+                data = json.loads(record["Sns"]["Message"])
+            else:
+                message_id = record["messageId"]
+                data = json.loads(record["body"])
+                if data.get("Type") == "Notification":  # SNS message delivered to SQS without raw delivery
+                    data = json.loads(data["Message"])
+        except Exception as e:  # malformed message, redelivering it will not help
+            logger.error(f"Error on retrieving Message Data from Event Message. Error: {e}")
+            continue
+        event_records.append((message_id, data))
+    return event_records
+
+
+# Only an SQS event source mapping redelivers the records listed in batchItemFailures
+def is_sqs_delivery(event):
+    return "Records" in event and all("Sns" not in record for record in event["Records"])
 
+
+def get_batch_workers():
     try:
-        instance_id = data["detail"]["instance-id"]
-    except Exception as e:
-        logger.error(f"Error on retrieving Instance Id from Event Message. Error: {e}")
+        return max(int(os.environ.get('AOB_BATCH_WORKERS', DEFAULT_BATCH_WORKERS)), 1)
+    except ValueError:
+        return DEFAULT_BATCH_WORKERS
+
 
+# Shared by the events processed concurrently, lookups never submit work to the pool so it cannot deadlock
+lookup_executor = ThreadPoolExecutor(max_workers=get_batch_workers() * LOOKUPS_PER_EVENT)
+
+
+# Returns False when the record should be redelivered
+def process_record(data, solution_account_id, log_name):
+    logger.trace(data, solution_account_id, log_name, caller_name='process_record')
+    if data.get("source") == "aws.ssm":  # Parameter Store change, the cached parameters are no longer valid
+        logger.info(f'Parameter Store change detected: {data.get("detail", {}).get("name")}')
+        aws_services.invalidate_params_cache()
+        pvwa_api_calls.invalidate_key_pair_cache()
+        return True
+    if data.get("source") == "aws.events":  # Scheduled poll of the Windows instances waiting for their password
+        poll_pending_passwords(solution_account_id, log_name)
+        return True
     try:
+        instance_id = data["detail"]["instance-id"]
         action_type = data["detail"]["state"]
+        event_account_id = data["account"]
+        event_region = data["region"]
     except Exception as e:
-        logger.error(f"Error on retrieving Action Type from Event Message. Error: {e}")
-
+        logger.error(f"Error on retrieving Instance details from Event Message. Error: {e}")
+        return True
+    event_time = get_event_time(data)
+    claimed = False
+    if event_time and action_type in ('running', 'terminated'):
+        # Redelivered events and events older than the latest processed one are dropped before any other call
+        claimed, latest_event = aws_services.claim_instance_event(instance_id, action_type, event_time)
+        if not claimed:
+            count_skipped_event(instance_id, action_type, event_time, latest_event)
+            return True
     try:
-        event_account_id = data["account"]
+        processed = elasticity_function(instance_id, action_type, event_account_id, event_region, solution_account_id,
+                                        log_name) is not False
     except Exception as e:
-        logger.error(f"Error on retrieving Event Account Id from Event Message. Error: {e}")
+        logger.error(f"Unknown error occurred while processing {instance_id}: {e}")
+        processed = False
+    if claimed and not processed:
+        aws_services.release_instance_event(instance_id, action_type, event_time, latest_event)
+    return processed
 
+
+# Returns the epoch time of the state change, or None when the event has no valid time
+def get_event_time(data):
     try:
-        event_region = data["region"]
-        solution_account_id = context.invoked_function_arn.split(':')[4]
-        log_name = context.log_stream_name if context.log_stream_name else "None"
+        return calendar.timegm(time.strptime(data["time"], '%Y-%m-%dT%H:%M:%SZ'))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def count_skipped_event(instance_id, action_type, event_time, latest_event):
+    if latest_event.get('LastState') == action_type and latest_event.get('LastEventTime') == event_time:
+        logger.info(f'Duplicate {action_type} event of {instance_id} skipped')
+        skipped_event_type = 'duplicate'
+    else:
+        logger.info(f'Stale {action_type} event of {instance_id} skipped, '
+                    f'{latest_event.get("LastState")} event already processed')
+        skipped_event_type = 'stale'
+    with skipped_events_lock:
+        skipped_events[skipped_event_type] += 1
+
+
+# Publishes the number of events dropped by this invocation, each of them saved the lookups and PVWA calls of an event
+def log_skipped_events():
+    with skipped_events_lock:
+        duplicate_events, stale_events = skipped_events['duplicate'], skipped_events['stale']
+        skipped_events['duplicate'] = skipped_events['stale'] = 0
+    if duplicate_events + stale_events:
+        logger.info(f'{duplicate_events} duplicate and {stale_events} stale event(s) skipped')
+        logger.metric('DuplicateEventsSkipped', duplicate_events)
+        logger.metric('StaleEventsSkipped', stale_events)
+
+
+# Onboards the Windows instances whose password became available since their previous check
+def poll_pending_passwords(solution_account_id, log_name):
+    logger.trace(solution_account_id, log_name, caller_name='poll_pending_passwords')
+    pending_instances = aws_services.get_pending_password_instances(time.time())
+    if not pending_instances:
+        return
+    logger.info(f'Checking the password of {len(pending_instances)} pending Windows instance(s)')
+    with ThreadPoolExecutor(max_workers=min(get_batch_workers(), len(pending_instances))) as executor:
+        onboarded = list(executor.map(lambda pending_instance: poll_pending_password(pending_instance, solution_account_id,
+                                                                                     log_name), pending_instances))
+    logger.info(f'{sum(onboarded)} out of {len(pending_instances)} pending Windows instance(s) onboarded')
+
+
+# Returns True when the instance was onboarded
+def poll_pending_password(pending_instance, solution_account_id, log_name):
+    instance_id = pending_instance['InstanceId']
+    event_account_id = pending_instance['AccountId']
+    event_region = pending_instance['Region']
+    poll_attempts = int(pending_instance['PollAttempts']) + 1
+    try:
+        if not aws_services.claim_pending_password_poll(instance_id, poll_attempts,
+                                                        instance_processing.get_next_password_poll_time(poll_attempts)):
+            return False
+        if instance_processing.get_instance_password_data(instance_id, solution_account_id, event_region, event_account_id):
+            return elasticity_function(instance_id, 'running', event_account_id, event_region, solution_account_id,
+                                       log_name) is not False
+        if poll_attempts >= instance_processing.PASSWORD_POLL_MAX_ATTEMPTS:
+            logger.error(f'Password of {instance_id} is still not available after {poll_attempts} checks')
+            fail_pending_password(instance_id)
     except Exception as e:
-        logger.error(f"Error on retrieving Event Region from Event Message. Error: {e}")
-    elasticity_function(instance_id, action_type, event_account_id, event_region, solution_account_id, log_name)
+        logger.error(f"Error on checking the password of {instance_id}: {e}")
+    return False
+
+
+# The failed status is written with the lease, unless an event of the instance changed its status meanwhile
+def fail_pending_password(instance_id):
+    lease = aws_services.acquire_instance_lease(instance_id)
+    if not lease:
+        return
+    try:
+        if lease.instance_data and lease.instance_data['Status']['S'] == OnBoardStatus.pending_password:
+            aws_services.update_instances_table_status(instance_id, OnBoardStatus.on_boarded_failed,
+                                                       'Instance password data is not available', lease)
+    finally:
+        aws_services.release_instance_lease(lease)
 
 
 def elasticity_function(instance_id, action_type, event_account_id, event_region, solution_account_id, log_name):
+    if action_type not in ('running', 'terminated'):
+        logger.info('Unknown instance state')
+        return
+    # The events of an instance are processed one at a time, the lease also returns the instance item
+    lease = aws_services.acquire_instance_lease(instance_id)
+    if not lease:
+        return False
     try:
-        ec2_object = aws_services.get_account_details(solution_account_id, event_account_id, event_region)
-        instance_details = aws_services.get_ec2_details(instance_id, ec2_object, event_account_id)
-        instance_data = aws_services.get_instance_data_from_dynamo_table(instance_id)
+        # While the PVWA is unavailable the events are left to the sweeper instead of waiting for connections and timeouts
+        if requires_pvwa(action_type, lease.instance_data) and not circuit_breaker.is_pvwa_available():
+            return park_instance_event(instance_id, action_type, event_account_id, event_region, lease)
+        return process_instance_state(instance_id, action_type, event_account_id, event_region, solution_account_id,
+                                      log_name, lease)
+    finally:
+        aws_services.release_instance_lease(lease)
+
+
+# Events that only update the Instances table are processed while the PVWA circuit is open
+def requires_pvwa(action_type, instance_data):
+    instance_status = instance_data["Status"]["S"] if instance_data else None
+    if action_type == 'running':
+        return instance_status != OnBoardStatus.on_boarded
+    return instance_status in (OnBoardStatus.on_boarded, OnBoardStatus.delete_failed)
+
+
+# Saves the event as failed with its account and region, so the sweeper processes it again once the circuit closes
+def park_instance_event(instance_id, action_type, event_account_id, event_region, lease):
+    logger.info(f'PVWA circuit is open, {action_type} event of {instance_id} is left to the sweeper')
+    logger.metric('PvwaCircuitRejectedEvents', 1)
+    status = OnBoardStatus.on_boarded_failed if action_type == 'running' else OnBoardStatus.delete_failed
+    aws_services.update_instances_table_status(instance_id, status, 'PVWA circuit is open', lease, event_account_id,
+                                               event_region)
+    return False
+
+
+# Status transitions of the instance item are written with the lease, they fail once another event took it over
+def process_instance_state(instance_id, action_type, event_account_id, event_region, solution_account_id, log_name, lease):
+    instance_details = None
+    key_pair_value_on_safe = None
+    pvwa_connection_number, session_guid = None, ""
+    try:
+        instance_data = lease.instance_data
+        instance_details, store_parameters_class = get_instance_enrichment(
+            instance_id, action_type, event_account_id, event_region, solution_account_id, instance_data)
         if action_type == 'terminated':
             if not instance_data:
                 logger.info(f"Item {instance_id} does not exist on DB")
@@ -56,7 +272,11 @@ def elasticity_function(instance_id, action_type, event_account_id, event_region
             instance_status = instance_data["Status"]["S"]
             if instance_status == OnBoardStatus.on_boarded_failed:
                 logger.error(f"Item {instance_id} is in status OnBoard failed, removing from DynamoDB table")
-                aws_services.remove_instance_from_dynamo_table(instance_id)
+                aws_services.remove_instance_from_dynamo_table(instance_id, lease)
+                return None
+            if instance_status == OnBoardStatus.pending_password:
+                logger.info(f"Item {instance_id} was never onboarded, removing from DynamoDB table")
+                aws_services.remove_instance_from_dynamo_table(instance_id, lease)
                 return None
         elif action_type == 'running':
             if not instance_details["address"]:  # In case querying AWS return empty address
@@ -69,81 +289,122 @@ def elasticity_function(instance_id, action_type, event_account_id, event_region
                     return None
                 elif instance_status == OnBoardStatus.on_boarded_failed:
                     logger.error(f"Item {instance_id} exists with status 'OnBoard failed', adding to Vault")
+                elif instance_status == OnBoardStatus.pending_password:
+                    logger.info(f"Item {instance_id} is waiting for its password, adding to Vault")
                 else:
                     logger.info(f"Item {instance_id} does not exist on DB, adding to Vault")
-        else:
-            logger.info('Unknown instance state')
-            return
 
-        store_parameters_class = aws_services.get_params_from_param_store()
         if not store_parameters_class:
-            return
-        if store_parameters_class.aob_mode == 'Production':
-            # Save PVWA Verification key in /tmp folder
-            logger.info('Saving verification key')
-            crt = open("/tmp/server.crt", "w+")
-            crt.write(store_parameters_class.pvwa_verification_key)
-            crt.close()
-        pvwa_connection_number, session_guid = aws_services.get_session_from_dynamo()
+            return False
+        pvwa_connection_number, session_guid = aws_services.get_session_from_dynamo(
+            preferred_sessions=pvwa_integration_class.get_pooled_connections())
         if not pvwa_connection_number:
-            return
-        session_token = pvwa_integration_class.logon_pvwa(store_parameters_class.vault_username,
-                                                          store_parameters_class.vault_password,
-                                                          store_parameters_class.pvwa_url,
-                                                          pvwa_connection_number)
+            return False
+        session_token = pvwa_integration_class.get_session(store_parameters_class.vault_username,
+                                                           store_parameters_class.vault_password,
+                                                           store_parameters_class.pvwa_url,
+                                                           pvwa_connection_number)
         if not session_token:
-            return
-        disconnect = False
+            return False
         if action_type == 'terminated':
             logger.info(f'Detected termination of {instance_id}')
             instance_processing.delete_instance(instance_id, session_token, store_parameters_class, instance_data,
-                                                instance_details)
+                                                instance_details, lease)
         elif action_type == 'running':
             # get key pair
             logger.info('Retrieving account id where the key-pair is stored')
             # Retrieving the account id of the account where the instance keyPair is stored
             # AWS.<AWS Account>.<Event Region name>.<key pair name>
             key_pair_value_on_safe = f'AWS.{instance_details["aws_account_id"]}.{event_region}.{instance_details["key_name"]}'
-            key_pair_account_id = pvwa_api_calls.check_if_kp_exists(session_token, key_pair_value_on_safe,
-                                                                    store_parameters_class.key_pair_safe_name,
-                                                                    instance_id,
-                                                                    store_parameters_class.pvwa_url)
+            key_pair_account_id, instance_account_password = pvwa_api_calls.get_key_pair(
+                session_token, key_pair_value_on_safe, store_parameters_class.key_pair_safe_name, instance_id,
+                store_parameters_class.pvwa_url)
             if not key_pair_account_id:
                 logger.error(f"Key Pair {key_pair_value_on_safe} does not exist in Safe " \
                              f"{store_parameters_class.key_pair_safe_name}")
                 return
-            instance_account_password = pvwa_api_calls.get_account_value(session_token, key_pair_account_id, instance_id,
-                                                                         store_parameters_class.pvwa_url)
             if instance_account_password is False:
                 return
-            pvwa_integration_class.logoff_pvwa(store_parameters_class.pvwa_url, session_token)
-            aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
-            disconnect = True
+            # Windows instances whose password is not available yet are deferred to the pending password poll
             instance_processing.create_instance(instance_id, instance_details, store_parameters_class, log_name,
-                                                solution_account_id, event_region, event_account_id, instance_account_password)
+                                                solution_account_id, event_region, event_account_id,
+                                                instance_account_password, session_token, lease)
         else:
             logger.error('Unknown instance state')
             return
 
-        if not disconnect:
-            pvwa_integration_class.logoff_pvwa(store_parameters_class.pvwa_url, session_token)
-            aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
+        # The PVWA session stays in the pool for the next events using this connection
+        aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
 
     except Exception as e:
         logger.error(f"Unknown error occurred: {e}")
         if action_type == 'terminated':
             # put_instance_to_dynamo_table(instance_id, instance_details["address"]\
             # , OnBoardStatus.delete_failed, str(e), log_name)
-            aws_services.update_instances_table_status(instance_id, OnBoardStatus.delete_failed, str(e))
+            aws_services.update_instances_table_status(instance_id, OnBoardStatus.delete_failed, str(e), lease,
+                                                       event_account_id, event_region)
         elif action_type == 'running':
-            aws_services.put_instance_to_dynamo_table(instance_id, instance_details["address"], OnBoardStatus.on_boarded_failed,
-                                                      str(e), log_name)
-# TODO: Retry mechanism?
-        aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
-        return
+            # The cached key pair may be the cause, e.g. rotated in the vault, the next instances retrieve it again
+            if key_pair_value_on_safe:
+                pvwa_api_calls.invalidate_key_pair_cache(key_pair_value_on_safe)
+            # The lookups may have failed before the instance details were retrieved
+            address = instance_details["address"] if instance_details else None
+            if not address and lease.instance_data and 'Address' in lease.instance_data:
+                address = lease.instance_data['Address']['S']
+            aws_services.put_instance_to_dynamo_table(instance_id, address, OnBoardStatus.on_boarded_failed,
+                                                      str(e), log_name, lease=lease, event_account_id=event_account_id,
+                                                      event_region=event_region)
+        if pvwa_connection_number:
+            aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
+        return False
+
+
+# Runs the independent lookups of the event concurrently, returns the instance details and the stored parameters
+def get_instance_enrichment(instance_id, action_type, event_account_id, event_region, solution_account_id, instance_data):
+    start_time = time.time()
+    lookups = {'store_parameters': (aws_services.get_params_from_param_store,)}
+    if action_type == 'running':
+        lookups['instance_details'] = (get_instance_details, instance_id, event_account_id, event_region,
+                                       solution_account_id)
+    elif instance_data and 'VaultAccountId' not in instance_data:
+        # Instances onboarded before their vault account was saved are searched with their details
+        lookups['instance_details'] = (get_instance_details, instance_id, event_account_id, event_region,
+                                       solution_account_id)
+    results = run_lookups(instance_id, lookups)
+    duration = (time.time() - start_time) * 1000
+    logger.info(f'Lookups of {instance_id} completed in {duration:.0f} ms')
+    logger.metric('EnrichmentLatency', duration, unit='Milliseconds')
+    return results.get('instance_details'), results['store_parameters']
+
+
+# Returns the results of the lookups by name, the lookups not started yet are cancelled when one of them fails
+def run_lookups(instance_id, lookups):
+    futures = {lookup_executor.submit(timed_lookup, instance_id, name, *lookup): name for name, lookup in lookups.items()}
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in done:
+        if future.exception():
+            for pending_future in not_done:
+                pending_future.cancel()
+            raise future.exception()
+    return {name: future.result() for future, name in futures.items()}
+
+
+def timed_lookup(instance_id, name, lookup_function, *args):
+    start_time = time.time()
+    try:
+        return lookup_function(*args)
+    finally:
+        logger.info(f'Lookup {name} of {instance_id} took {(time.time() - start_time) * 1000:.0f} ms', DEBUG_LEVEL_DEBUG)
+
+
+# EC2 is described with the assumed role credentials of the event account
+def get_instance_details(instance_id, event_account_id, event_region, solution_account_id):
+    ec2_object = aws_services.get_account_details(solution_account_id, event_account_id, event_region)
+    return aws_services.get_ec2_details(instance_id, ec2_object, event_account_id)
 
 
 class OnBoardStatus:
     on_boarded = "on boarded"
     on_boarded_failed = "on board failed"
     delete_failed = "delete failed"
+    pending_password = aws_services.PENDING_PASSWORD_STATUS
@@ -0,0 +1,138 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import aws_clients
+import aws_services
+import aws_ec2_auto_onboarding
+import retry_mechanism
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+DEFAULT_RECONCILIATION_WORKERS = 10  # Leaves most of the PVWA connections to the elasticity lambda
+PROGRESS_LOG_INTERVAL = 50  # Instances between two progress reports
+REMAINING_TIME_MARGIN = 60000  # Milliseconds left to the invocation when no more instances are submitted
+# Instances in these states are not onboarded again
+RECONCILED_STATUSES = (aws_ec2_auto_onboarding.OnBoardStatus.on_boarded, aws_ec2_auto_onboarding.OnBoardStatus.pending_password)
+logger = LogMechanism()
+
+
+# Onboards the running instances of the accounts and regions that are not onboarded yet.
+# The event may list the 'accounts' and 'regions' to reconcile, instead of AOB_RECONCILIATION_ACCOUNTS and
+# AOB_RECONCILIATION_REGIONS. Invoking it again resumes an incomplete reconciliation.
+def lambda_handler(event, context):
+    logger.trace(event, context, caller_name='lambda_handler')
+    retry_mechanism.set_lambda_deadline(context)
+    try:
+        solution_account_id = context.invoked_function_arn.split(':')[4]
+        log_name = context.log_stream_name if context.log_stream_name else "None"
+    except Exception as e:
+        logger.error(f"Error on retrieving Lambda context details. Error: {e}")
+        raise e
+    accounts = event.get('accounts') or get_list_from_environment('AOB_RECONCILIATION_ACCOUNTS', [solution_account_id])
+    regions = event.get('regions') or get_list_from_environment('AOB_RECONCILIATION_REGIONS', [os.environ['AWS_REGION']])
+    report = ReconciliationReport()
+    workers = get_reconciliation_workers()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        for account_id, region, instance_id in get_unreconciled_instances(solution_account_id, accounts, regions, report):
+            if context.get_remaining_time_in_millis() < REMAINING_TIME_MARGIN:
+                logger.info('Stopping the reconciliation before the lambda times out')
+                report.complete = False
+                break
+            # At most one instance per worker is submitted, so the reconciliation can stop in time
+            if len(running) >= workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                report.add_results(done)
+            running.add(executor.submit(aws_ec2_auto_onboarding.elasticity_function, instance_id, 'running', account_id,
+                                        region, solution_account_id, log_name))
+        report.add_results(wait(running).done)
+    report.log()
+    logger.metric('ReconciliationThroughput', report.get_throughput(), unit='Count/Second')
+    return report.to_dict()
+
+
+# Yields (account, region, instance id) of the running instances that are not onboarded yet
+def get_unreconciled_instances(solution_account_id, accounts, regions, report):
+    for account_id in accounts:
+        for region in regions:
+            for instance_ids in get_running_instances(solution_account_id, account_id, region):
+                report.instances += len(instance_ids)
+                instances_status = aws_services.get_instances_status_from_dynamo_table(instance_ids)
+                for instance_id in instance_ids:
+                    if instances_status.get(instance_id) in RECONCILED_STATUSES:
+                        report.skipped += 1
+                    else:
+                        yield account_id, region, instance_id
+
+
+# Yields the ids of the running instances of the account and region, one describe_instances page at a time
+def get_running_instances(solution_account_id, account_id, region):
+    logger.info(f'Listing the running instances of account {account_id} in {region}')
+    credentials = aws_services.get_account_credentials(solution_account_id, account_id, region)
+    ec2_client = aws_clients.get_client('ec2', region_name=region, **credentials)
+    paginator = ec2_client.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]):
+        instance_ids = [instance['InstanceId'] for reservation in page['Reservations']
+                        for instance in reservation['Instances']]
+        if instance_ids:
+            yield instance_ids
+
+
+def get_list_from_environment(name, default):
+    values = [value.strip() for value in os.environ.get(name, '').split(',') if value.strip()]
+    return values or default
+
+
+def get_reconciliation_workers():
+    try:
+        workers = int(os.environ.get('AOB_RECONCILIATION_WORKERS', DEFAULT_RECONCILIATION_WORKERS))
+    except ValueError:
+        workers = DEFAULT_RECONCILIATION_WORKERS
+    # Each worker holds a PVWA connection while it onboards an instance
+    return min(max(workers, 1), aws_services.MAX_PVWA_CONNECTIONS)
+
+
+class ReconciliationReport:
+    def __init__(self):
+        self.start_time = time.time()
+        self.instances = 0
+        self.skipped = 0
+        self.processed = 0
+        self.failed = 0
+        self.complete = True
+
+
+    def add_results(self, futures):
+        for future in futures:
+            try:
+                succeeded = future.result() is not False
+            except Exception as e:
+                logger.error(f'Unknown error occurred during the reconciliation: {e}')
+                succeeded = False
+            if succeeded:
+                self.processed += 1
+            else:
+                self.failed += 1
+            if (self.processed + self.failed) % PROGRESS_LOG_INTERVAL == 0:
+                self.log()
+
+
+    def log(self):
+        logger.info(f'Reconciliation: {self.instances} running instance(s) found, {self.skipped} already onboarded, '
+                    f'{self.processed} processed, {self.failed} failed, {self.get_throughput():.2f} instance(s) per second')
+
+
+    def get_throughput(self):
+        return (self.processed + self.failed) / max(time.time() - self.start_time, 0.001)
+
+
+    def to_dict(self):
+        return {
+            'instances': self.instances,
+            'skipped': self.skipped,
+            'processed': self.processed,
+            'failed': self.failed,
+            'duration': round(time.time() - self.start_time, 2),
+            'throughput': round(self.get_throughput(), 2),
+            'complete': self.complete
+        }
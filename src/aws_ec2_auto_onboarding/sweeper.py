@@ -0,0 +1,208 @@
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import aws_clients
+import aws_services
+import aws_ec2_auto_onboarding
+import circuit_breaker
+import retry_mechanism
+from aws_ec2_auto_onboarding import OnBoardStatus
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+DEFAULT_SWEEPER_WORKERS = 5  # Leaves most of the PVWA connections to the elasticity lambda
+SWEEP_BASE_DELAY = 900  # Seconds before an instance that failed again is swept again, doubled on every sweep
+SWEEP_MAX_DELAY = 86400
+SWEEP_MAX_ATTEMPTS = 10  # Sweeps of an instance before it is left to its next state change
+PROGRESS_LOG_INTERVAL = 50  # Instances between two progress reports
+REMAINING_TIME_MARGIN = 60000  # Milliseconds left to the invocation when no more instances are submitted
+DESCRIBE_FILTER_LIMIT = 200  # Instance ids of a describe_instances filter
+# Failed statuses of the Instances table and the state change processed again for them
+SWEPT_STATUSES = {OnBoardStatus.on_boarded_failed: 'running', OnBoardStatus.delete_failed: 'terminated'}
+# Instance states of an instance that failed to be onboarded, for which it is removed from the Instances table
+TERMINATED_STATES = ('shutting-down', 'terminated')
+logger = LogMechanism()
+
+
+# Processes again the instances left in a failed status, which are otherwise retried only on their next state change.
+# The instances are grouped by account and region, so each group lists the states of its instances with a single set
+# of credentials. Instances failing again are swept later with an exponential backoff saved on their item.
+def lambda_handler(event, context):
+    logger.trace(event, context, caller_name='lambda_handler')
+    retry_mechanism.set_lambda_deadline(context)
+    try:
+        solution_account_id = context.invoked_function_arn.split(':')[4]
+        log_name = context.log_stream_name if context.log_stream_name else "None"
+    except Exception as e:
+        logger.error(f"Error on retrieving Lambda context details. Error: {e}")
+        raise e
+    report = SweepReport()
+    if circuit_breaker.is_pvwa_open():
+        logger.info('PVWA circuit is open, the failed instances are swept on the next schedule')
+        report.complete = False
+        return report.to_dict()
+    instance_groups = get_failed_instance_groups(time.time(), report)
+    workers = get_sweeper_workers()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        for account_id, region, instance_item, action_type in get_sweep_actions(solution_account_id, instance_groups,
+                                                                                report):
+            if context.get_remaining_time_in_millis() < REMAINING_TIME_MARGIN:
+                logger.info('Stopping the sweep before the lambda times out')
+                report.complete = False
+                break
+            if circuit_breaker.is_pvwa_open():  # The remaining instances would fail without calling the PVWA
+                logger.info('Stopping the sweep, the PVWA circuit is open')
+                report.complete = False
+                break
+            # At most one instance per worker is submitted, so the sweep can stop in time
+            if len(running) >= workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                report.add_results(done)
+            running.add(executor.submit(sweep_instance, instance_item, action_type, account_id, region,
+                                        solution_account_id, log_name))
+        report.add_results(wait(running).done)
+    report.log()
+    logger.metric('SweeperThroughput', report.get_throughput(), unit='Count/Second')
+    logger.metric('SweeperRecoveredInstances', report.recovered)
+    return report.to_dict()
+
+
+# Returns the items of the failed instances due for a sweep, by (account, region)
+def get_failed_instance_groups(sweep_time, report):
+    instance_groups = {}
+    for status in SWEPT_STATUSES:
+        for instance_item in aws_services.get_instances_to_sweep(status, sweep_time, SWEEP_MAX_ATTEMPTS):
+            report.instances += 1
+            if 'AccountId' not in instance_item:  # Failed before the account and region were saved on the item
+                logger.info(f'{instance_item["InstanceId"]} has no account and region, it is retried on its next state change',
+                            DEBUG_LEVEL_DEBUG)
+                report.skipped += 1
+                continue
+            instance_groups.setdefault((instance_item['AccountId'], instance_item['Region']), []).append(instance_item)
+    return instance_groups
+
+
+# Yields (account, region, instance item, state to process) of the instances to sweep, one group at a time
+def get_sweep_actions(solution_account_id, instance_groups, report):
+    for (account_id, region), instance_items in instance_groups.items():
+        logger.info(f'Sweeping {len(instance_items)} failed instance(s) of account {account_id} in {region}')
+        onboard_failed_ids = [instance_item['InstanceId'] for instance_item in instance_items
+                              if instance_item['Status'] == OnBoardStatus.on_boarded_failed]
+        try:
+            instance_states = get_instance_states(solution_account_id, account_id, region, onboard_failed_ids)
+        except Exception as e:
+            logger.error(f'Failed to describe the instances of account {account_id} in {region}: {str(e)}')
+            instance_states = None
+        for instance_item in instance_items:
+            action_type = SWEPT_STATUSES[instance_item['Status']]
+            if instance_item['Status'] == OnBoardStatus.on_boarded_failed:
+                if instance_states is None:
+                    report.failed += 1
+                    continue
+                instance_state = instance_states.get(instance_item['InstanceId'], 'terminated')
+                if instance_state in TERMINATED_STATES:
+                    action_type = 'terminated'
+                elif instance_state != 'running':  # Stopped instances are onboarded on their next running event
+                    report.skipped += 1
+                    continue
+            yield account_id, region, instance_item, action_type
+
+
+# Returns the state of each of the instances found, instances that no longer exist are not returned
+def get_instance_states(solution_account_id, account_id, region, instance_ids):
+    if not instance_ids:
+        return {}
+    credentials = aws_services.get_account_credentials(solution_account_id, account_id, region)
+    ec2_client = aws_clients.get_client('ec2', region_name=region, **credentials)
+    paginator = ec2_client.get_paginator('describe_instances')
+    instance_states = {}
+    for i in range(0, len(instance_ids), DESCRIBE_FILTER_LIMIT):
+        # A filter ignores the ids of deleted instances, instead of failing the whole request
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id',
+                                                 'Values': instance_ids[i:i + DESCRIBE_FILTER_LIMIT]}]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instance_states[instance['InstanceId']] = instance['State']['Name']
+    return instance_states
+
+
+# Returns True when the instance left its failed status, otherwise saves when it is swept next
+def sweep_instance(instance_item, action_type, account_id, region, solution_account_id, log_name):
+    instance_id = instance_item['InstanceId']
+    logger.info(f'Processing the {action_type} state of {instance_id} again, status: {instance_item["Status"]}')
+    aws_ec2_auto_onboarding.elasticity_function(instance_id, action_type, account_id, region, solution_account_id,
+                                                log_name)
+    instance_data = aws_services.get_instance_data_from_dynamo_table(instance_id)
+    if not instance_data or instance_data['Status']['S'] not in SWEPT_STATUSES:
+        logger.info(f'{instance_id} recovered from status {instance_item["Status"]}')
+        return True
+    sweep_attempts = int(instance_item.get('SweepAttempts', 0)) + 1
+    if sweep_attempts >= SWEEP_MAX_ATTEMPTS:
+        logger.error(f'{instance_id} is still in status {instance_data["Status"]["S"]} after {sweep_attempts} sweeps, '
+                     'it is retried on its next state change')
+    aws_services.put_instance_sweep_backoff(instance_id, instance_data['Status']['S'], sweep_attempts,
+                                            get_next_sweep_time(sweep_attempts))
+    return False
+
+
+def get_next_sweep_time(sweep_attempts):
+    delay = min(SWEEP_BASE_DELAY * 2 ** (sweep_attempts - 1), SWEEP_MAX_DELAY)
+    # Jitter spreads the sweeps of the instances that failed together
+    return time.time() + delay * random.uniform(0.8, 1.2)
+
+
+def get_sweeper_workers():
+    try:
+        workers = int(os.environ.get('AOB_SWEEPER_WORKERS', DEFAULT_SWEEPER_WORKERS))
+    except ValueError:
+        workers = DEFAULT_SWEEPER_WORKERS
+    # Each worker holds a PVWA connection while it processes an instance
+    return min(max(workers, 1), aws_services.MAX_PVWA_CONNECTIONS)
+
+
+class SweepReport:
+    def __init__(self):
+        self.start_time = time.time()
+        self.instances = 0
+        self.skipped = 0
+        self.recovered = 0
+        self.failed = 0
+        self.complete = True
+
+
+    def add_results(self, futures):
+        for future in futures:
+            try:
+                recovered = future.result()
+            except Exception as e:
+                logger.error(f'Unknown error occurred during the sweep: {e}')
+                recovered = False
+            if recovered:
+                self.recovered += 1
+            else:
+                self.failed += 1
+            if (self.recovered + self.failed) % PROGRESS_LOG_INTERVAL == 0:
+                self.log()
+
+
+    def log(self):
+        logger.info(f'Sweep: {self.instances} failed instance(s) due, {self.skipped} skipped, {self.recovered} recovered, '
+                    f'{self.failed} still failed, {self.get_throughput():.2f} instance(s) per second')
+
+
+    def get_throughput(self):
+        return (self.recovered + self.failed) / max(time.time() - self.start_time, 0.001)
+
+
+    def to_dict(self):
+        return {
+            'instances': self.instances,
+            'skipped': self.skipped,
+            'recovered': self.recovered,
+            'failed': self.failed,
+            'duration': round(time.time() - self.start_time, 2),
+            'throughput': round(self.get_throughput(), 2),
+            'complete': self.complete
+        }
@@ -1,9 +1,10 @@
 import uuid
-import time
+from types import MappingProxyType
 import requests
 import urllib3
 import boto3
 import cfnresponse
+import retry_mechanism
 from log_mechanism import LogMechanism
 from pvwa_integration import PvwaIntegration
 from dynamo_lock import LockerClient
@@ -11,13 +12,14 @@ from dynamo_lock import LockerClient
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
-DEFAULT_HEADER = {"content-type": "application/json"}
+DEFAULT_HEADER = MappingProxyType({"content-type": "application/json"})  # Read only, calls copy it before adding their token
 IS_SAFE_HANDLER = True
 logger = LogMechanism()
 
 
 def lambda_handler(event, context):
     logger.trace(event, context, caller_name='lambda_handler')
+    retry_mechanism.set_lambda_deadline(context)
     try:
         physical_resource_id = str(uuid.uuid4())
         if 'PhysicalResourceId' in event:
@@ -149,11 +151,11 @@ def lambda_handler(event, context):
                 pvwa_integration_class.logoff_pvwa(pvwa_url, pvwa_session_id)
 
 
-# Creating a safe, if a failure occur, retry 3 time, wait 10 sec. between retries
+# Creating a safe, throttling and server errors are retried by the PVWA retry policy
 def create_safe(pvwa_integration_class, safe_name, cpm_name, pvwa_ip, session_id, number_of_days_retention=7):
     logger.trace(pvwa_integration_class, safe_name, cpm_name, pvwa_ip, session_id, number_of_days_retention,
                  caller_name='create_safe')
-    header = DEFAULT_HEADER
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session_id})
     create_safe_url = f"https://{pvwa_ip}/PasswordVault/WebServices/PIMServices.svc/Safes"
     # Create new safe, default number of days retention is 7, unless specified otherwise
@@ -169,24 +171,23 @@ def create_safe(pvwa_integration_class, safe_name, cpm_name, pvwa_ip, session_id
             }}
             """
 
-    for i in range(0, 3):
-        create_safe_rest_response = pvwa_integration_class.call_rest_api_post(create_safe_url, data, header)
-
-        if create_safe_rest_response.status_code == requests.codes.conflict:
-            logger.info(f"The Safe {safe_name} already exists")
-            return True
-        elif create_safe_rest_response.status_code == requests.codes.bad_request:
-            logger.error(f"Failed to create Safe {safe_name}, error 400: bad request")
-            return False
-        elif create_safe_rest_response.status_code == requests.codes.created:  # safe created
-            logger.info(f"Safe {safe_name} was successfully created")
-            return True
-        else:  # Error creating safe, retry for 3 times, with 10 seconds between retries
-            logger.error(f"Error creating Safe, status code:{create_safe_rest_response.status_code}, will retry in 10 seconds")
-            if i == 3:
-                logger.error(f"Failed to create safe after several retries, status code:{create_safe_rest_response.status_code}")
-                return False
-        time.sleep(10)
+    # A safe created by a failed attempt is reported as a conflict by the next one
+    create_safe_rest_response = pvwa_integration_class.call_rest_api_post(create_safe_url, data, header,
+                                                                          retry_mechanism.PVWA_RETRY_POLICY)
+    if create_safe_rest_response is None:
+        logger.error(f"Failed to create Safe {safe_name}, PVWA is not reachable")
+        return False
+    if create_safe_rest_response.status_code == requests.codes.conflict:
+        logger.info(f"The Safe {safe_name} already exists")
+        return True
+    elif create_safe_rest_response.status_code == requests.codes.bad_request:
+        logger.error(f"Failed to create Safe {safe_name}, error 400: bad request")
+        return False
+    elif create_safe_rest_response.status_code == requests.codes.created:  # safe created
+        logger.info(f"Safe {safe_name} was successfully created")
+        return True
+    logger.error(f"Failed to create Safe {safe_name}, status code:{create_safe_rest_response.status_code}")
+    return False
 
 
 # Search if Key pair exist, if not - create it, return the pem key, False for error
@@ -215,7 +216,7 @@ def create_key_pair_in_vault(pvwa_integration_class, session, aws_key_name, priv
                              aws_account_id, aws_region_name):
     logger.trace(pvwa_integration_class, session, aws_key_name, pvwa_ip, safe_name, aws_account_id,
                  aws_region_name, caller_name='create_key_pair_in_vault')
-    header = DEFAULT_HEADER
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session})
 
     trimmed_pem_key = str(private_key_value).replace("\n", "\\n")
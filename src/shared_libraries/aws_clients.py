@@ -0,0 +1,56 @@
+import threading
+import boto3
+from botocore.config import Config
+
+MAX_CACHED_OBJECTS = 64  # Objects of expired assumed role credentials are dropped once the registry is full
+# Objects whose calls are retried by a retry policy make a single attempt, the legacy max_attempts counts the retries only
+SINGLE_ATTEMPT_CONFIG = Config(retries={'max_attempts': 0})
+# boto3 clients are thread safe and shared by all threads, resources are not and are kept per thread
+clients = {}
+thread_resources = threading.local()
+# boto3 sessions are not thread safe, objects are created from the default session under this lock
+registry_lock = threading.Lock()
+
+
+# Returns a boto3 client for the service, region and credentials, creating it on first use
+def get_client(service_name, region_name=None, single_attempt=False, **credentials):
+    key = get_registry_key(service_name, region_name, credentials, single_attempt)
+    with registry_lock:
+        if key not in clients:
+            evict_oldest(clients)
+            clients[key] = boto3.client(service_name, region_name=region_name, config=get_config(single_attempt),
+                                        **credentials)
+        return clients[key]
+
+
+# Returns a boto3 resource for the service, region and credentials, creating it on first use in the current thread
+def get_resource(service_name, region_name=None, single_attempt=False, **credentials):
+    key = get_registry_key(service_name, region_name, credentials, single_attempt)
+    resources = getattr(thread_resources, 'resources', None)
+    if resources is None:
+        resources = thread_resources.resources = {}
+    if key not in resources:
+        evict_oldest(resources)
+        with registry_lock:
+            resources[key] = boto3.resource(service_name, region_name=region_name, config=get_config(single_attempt),
+                                            **credentials)
+    return resources[key]
+
+
+def get_registry_key(service_name, region_name, credentials, single_attempt):
+    return service_name, region_name, tuple(sorted(credentials.items())), single_attempt
+
+
+def get_config(single_attempt):
+    return SINGLE_ATTEMPT_CONFIG if single_attempt else None
+
+
+def evict_oldest(registry):
+    while len(registry) >= MAX_CACHED_OBJECTS:
+        del registry[next(iter(registry))]
+
+
+def clear():
+    with registry_lock:
+        clients.clear()
+    thread_resources.resources = {}
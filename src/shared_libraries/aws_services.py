@@ -1,49 +1,95 @@
 import json
+import os
 import time
 import random
-import boto3
+import threading
+import uuid
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+import aws_clients
+import circuit_breaker
+import retry_mechanism
 from log_mechanism import LogMechanism
 from dynamo_lock import LockerClient
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+DEFAULT_PARAMS_CACHE_TTL = 300  # Seconds a warm container reuses the parameters retrieved from parameter store
+MAX_PVWA_CONNECTIONS = 100  # Connection numbers 1-100 are shared by all the lambdas through the Sessions table
+SESSION_LOCK_TIMEOUT = 20000  # Setting the timeout to 20 seconds on a row lock
+SESSION_COUNTER_NAME = 'SessionsCounter'  # Sessions table item handing out the next connection number to try
+SESSION_PROBES = 5  # Connection numbers tried after the counter before waiting
+SESSION_WAIT_TIMEOUT = 100  # Seconds to wait for a free connection when all of them are taken
+ASSUME_ROLE_NAME = 'CyberArk-AOB-AssumeRoleForElasticityLambda'
+CREDENTIALS_EXPIRATION_MARGIN = 300  # Seconds before expiration when assumed role credentials are renewed
+PENDING_PASSWORD_STATUS = 'pending password'  # Windows instances waiting for AWS to publish their password
+BATCH_GET_ITEM_LIMIT = 100
+DEFAULT_AMI_CACHE_TTL = 86400  # Seconds the details of an image are reused, 0 disables the images cache
+MAX_CACHED_IMAGES = 256
+INSTANCE_LEASE_DURATION = 900  # Seconds an instance lease is held at most outside a lambda, the longest a lambda can run
+INSTANCE_LEASE_MARGIN = 30  # Seconds a lease outlives the invocation holding it
+INSTANCE_LEASE_WAIT_TIMEOUT = 30  # Seconds to wait for the lease of an instance held by another event
+INSTANCE_EVENTS_TABLE_NAME = 'InstanceEvents'  # Latest state change event processed for each instance
+INSTANCE_EVENTS_TTL = 14 * 86400  # Seconds an event is remembered, longer than any SNS or EventBridge redelivery
+INSTANCES_STATUS_INDEX_NAME = 'StatusIndex'  # Instances table index on Status, lists the instances of a status without a scan
+AMI_CACHE_TABLE_NAME = 'AmiCache'  # Images details shared by all the lambdas, expired items are removed by DynamoDB TTL
+ACCOUNTS_INDEX_TABLE_NAME = 'AccountsIndex'  # Accounts of the Unix and Windows safes shared by all the lambdas
+ACCOUNTS_INDEX_ADDRESS_INDEX_NAME = 'AddressIndex'  # AccountsIndex local index on the 'address,username' of the accounts
+ACCOUNTS_INDEX_STATE_ID = '#state'  # AccountsIndex item of a safe holding its generation, refresh times and update claim
+# Ordered (description substring, username) rules, the first matching rule gives the username of a Linux instance
+OS_USERNAME_RULES = (('centos', 'centos'), ('ubuntu', 'ubuntu'), ('debian', 'admin'), ('fedora', 'fedora'),
+                     ('opensuse', 'root'))
+DEFAULT_OS_USERNAME = 'ec2-user'
 logger = LogMechanism()
+params_cache = {'store_parameters': None, 'expiration': 0, 'hits': 0, 'misses': 0}
+params_cache_lock = threading.Lock()
+# Assumed role credentials keyed by (account, role, region)
+credentials_cache = {}
+credentials_cache_lock = threading.Lock()
+# Images details keyed by image id, AMIs are immutable and fleets are launched from a handful of them
+ami_cache = {'images': {}, 'hits': 0, 'misses': 0}
+ami_cache_lock = threading.Lock()
 
 
 # return ec2 instance relevant data:
 # keyPair_name, instance_address, platform
 def get_account_details(solution_account_id, event_account_id, event_region):
     logger.trace(solution_account_id, event_region, event_account_id, caller_name='get_account_details')
+    try:
+        credentials = get_account_credentials(solution_account_id, event_account_id, event_region)
+        ec2_resource = aws_clients.get_resource('ec2', region_name=event_region, single_attempt=True, **credentials)
+    except Exception as e:
+        logger.error(f'Error on getting token from account: {event_account_id}')
+        raise e
+    return ec2_resource
+
+
+# Returns the boto3 credentials arguments for the event account, empty for the AOB solution account
+def get_account_credentials(solution_account_id, event_account_id, event_region, role_name=ASSUME_ROLE_NAME):
+    logger.trace(solution_account_id, event_account_id, event_region, role_name, caller_name='get_account_credentials')
     if event_account_id == solution_account_id:
         logger.info('Event occurred in the AOB solution account')
-        try:
-            ec2_resource = boto3.resource('ec2', event_region)
-        except Exception as e:
-            logger.error(f'Error on creating boto3 session: {str(e)}')
-    else:
-        logger.info('Event occurred in different account')
-        try:
+        return {}
+    logger.info('Event occurred in different account')
+    cache_key = (event_account_id, role_name, event_region)
+    with credentials_cache_lock:
+        credentials = credentials_cache.get(cache_key)
+        if credentials and credentials['Expiration'].timestamp() - CREDENTIALS_EXPIRATION_MARGIN > time.time():
+            logger.info(f'Using cached credentials of {role_name} in account {event_account_id}', DEBUG_LEVEL_DEBUG)
+        else:
             logger.info('Assuming Role')
-            sts_connection = boto3.client('sts')
-            acct_b = sts_connection.assume_role(
-                RoleArn=f"arn:aws:iam::{event_account_id}:role/CyberArk-AOB-AssumeRoleForElasticityLambda",
+            sts_connection = aws_clients.get_client('sts', single_attempt=True)
+            acct_b = retry_mechanism.AWS_RETRY_POLICY.call(
+                sts_connection.assume_role,
+                RoleArn=f"arn:aws:iam::{event_account_id}:role/{role_name}",
                 RoleSessionName="cross_acct_lambda"
             )
-
-            access_key = acct_b['Credentials']['AccessKeyId']
-            secret_key = acct_b['Credentials']['SecretAccessKey']
-            session_token = acct_b['Credentials']['SessionToken']
-
-            # create service client using the assumed role credentials, e.g. S3
-            ec2_resource = boto3.resource(
-                'ec2',
-                region_name=event_region,
-                aws_access_key_id=access_key,
-                aws_secret_access_key=secret_key,
-                aws_session_token=session_token,
-            )
-        except Exception as e:
-            logger.error(f'Error on getting token from account: {event_account_id}')
-    return ec2_resource
+            credentials = acct_b['Credentials']
+            credentials_cache[cache_key] = credentials
+    return {
+        'aws_access_key_id': credentials['AccessKeyId'],
+        'aws_secret_access_key': credentials['SecretAccessKey'],
+        'aws_session_token': credentials['SessionToken']
+    }
 
 
 def get_ec2_details(instance_id, ec2_object, event_account_id):
@@ -51,9 +97,9 @@ def get_ec2_details(instance_id, ec2_object, event_account_id):
     logger.info(f'Gathering details about EC2 - {instance_id}')
     try:
         instance_resource = ec2_object.Instance(instance_id)
-        instance_image = ec2_object.Image(instance_resource.image_id)
-        logger.info(f'Image Detected: {str(instance_image)}')
-        image_description = instance_image.description
+        retry_mechanism.AWS_RETRY_POLICY.call(instance_resource.load)
+        image_details = get_image_details(instance_resource.image_id, ec2_object)
+        image_description = image_details['description']
     except Exception as e:
         logger.error(f'Error on getting instance details: {str(e)}')
         raise e
@@ -72,16 +118,209 @@ def get_ec2_details(instance_id, ec2_object, event_account_id):
     details['address'] = address
     details['platform'] = instance_resource.platform
     details['image_description'] = image_description
+    details['username'] = image_details['username']
     details['aws_account_id'] = event_account_id
     return details
 
 
+# Returns the description, platform and Linux username of the image, from the images cache when it was already seen
+def get_image_details(image_id, ec2_object):
+    ami_cache_ttl = get_ami_cache_ttl()
+    with ami_cache_lock:
+        image_details = ami_cache['images'].get(image_id)
+        if image_details and time.time() < image_details['expiration']:
+            ami_cache['hits'] += 1
+            logger.info(f"Images cache hit for {image_id} (hits: {ami_cache['hits']}, misses: {ami_cache['misses']})",
+                        DEBUG_LEVEL_DEBUG)
+            return image_details
+        ami_cache['misses'] += 1
+    image_details = get_shared_image_details(image_id) if ami_cache_ttl else None
+    if not image_details:
+        instance_image = ec2_object.Image(image_id)
+        retry_mechanism.AWS_RETRY_POLICY.call(instance_image.load)
+        logger.info(f'Image Detected: {str(instance_image)}')
+        image_details = {'description': instance_image.description, 'platform': instance_image.platform,
+                         'expiration': int(time.time()) + ami_cache_ttl}
+        if ami_cache_ttl and image_details['description']:
+            put_shared_image_details(image_id, image_details)
+    if image_details['description']:
+        image_details['username'] = get_os_distribution_user(image_details['description'])
+        if ami_cache_ttl:
+            with ami_cache_lock:
+                while len(ami_cache['images']) >= MAX_CACHED_IMAGES:
+                    del ami_cache['images'][next(iter(ami_cache['images']))]
+                ami_cache['images'][image_id] = image_details
+    else:
+        image_details['username'] = None
+    return image_details
+
+
+# Returns the image details saved by any of the lambdas, or None when the image is not in the AmiCache table
+def get_shared_image_details(image_id):
+    try:
+        dynamo_response = aws_clients.get_client('dynamodb').get_item(TableName=AMI_CACHE_TABLE_NAME,
+                                                                      Key={'ImageId': {'S': image_id}})
+    except Exception as e:
+        logger.info(f'Images cache table is not available: {str(e)}')
+        return None
+    item = dynamo_response.get('Item')
+    # Items are removed by DynamoDB TTL up to a few days after their expiration
+    if not item or int(item['ExpirationTime']['N']) <= time.time():
+        return None
+    return {'description': item['Description']['S'], 'platform': item.get('Platform', {}).get('S'),
+            'expiration': int(item['ExpirationTime']['N'])}
+
+
+def put_shared_image_details(image_id, image_details):
+    item = {'ImageId': {'S': image_id}, 'Description': {'S': image_details['description']},
+            'ExpirationTime': {'N': str(image_details['expiration'])}}
+    if image_details['platform']:
+        item['Platform'] = {'S': image_details['platform']}
+    try:
+        aws_clients.get_client('dynamodb').put_item(TableName=AMI_CACHE_TABLE_NAME, Item=item)
+    except Exception as e:
+        logger.info(f'Failed to save {image_id} to the images cache table: {str(e)}')
+
+
+def get_ami_cache_ttl():
+    try:
+        return max(int(os.environ.get('AOB_AMI_CACHE_TTL', DEFAULT_AMI_CACHE_TTL)), 0)
+    except ValueError:
+        return DEFAULT_AMI_CACHE_TTL
+
+
+# Returns the state item of the safe index, empty when the index was never built
+def get_accounts_index_state(safe_name):
+    accounts_index_table = aws_clients.get_resource('dynamodb').Table(ACCOUNTS_INDEX_TABLE_NAME)
+    return accounts_index_table.get_item(Key={'SafeName': safe_name, 'AccountId': ACCOUNTS_INDEX_STATE_ID},
+                                         ConsistentRead=True).get('Item', {})
+
+
+# Claims the update of the safe index, unless another lambda holds the claim or updated the index since the state was read.
+# Returns the owner of the claim, None when it was not claimed
+def claim_accounts_index_update(safe_name, state, claim_time):
+    logger.trace(safe_name, state, claim_time, caller_name='claim_accounts_index_update')
+    accounts_index_table = aws_clients.get_resource('dynamodb').Table(ACCOUNTS_INDEX_TABLE_NAME)
+    claim_owner = str(uuid.uuid4())
+    claim_start = int(time.time())
+    condition_expression = '(attribute_not_exists(ClaimExpiration) OR ClaimExpiration < :claim_start) AND '
+    expression_attribute_values = {':claim_owner': claim_owner, ':claim_expiration': claim_start + claim_time,
+                                   ':claim_start': claim_start}
+    if 'Version' in state:
+        condition_expression += 'Version = :version'
+        expression_attribute_values[':version'] = state['Version']
+    else:
+        condition_expression += 'attribute_not_exists(Version)'
+    try:
+        accounts_index_table.update_item(
+            Key={'SafeName': safe_name, 'AccountId': ACCOUNTS_INDEX_STATE_ID},
+            UpdateExpression='SET ClaimOwner = :claim_owner, ClaimExpiration = :claim_expiration',
+            ConditionExpression=condition_expression,
+            ExpressionAttributeValues=expression_attribute_values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info(f'Accounts index of {safe_name} is updated by another lambda', DEBUG_LEVEL_DEBUG)
+        return None
+    return claim_owner
+
+
+# Saves the state attributes of the safe index and releases the claim.
+# Returns the saved state, None when the claim expired meanwhile
+def complete_accounts_index_update(safe_name, claim_owner, state_updates):
+    logger.trace(safe_name, claim_owner, state_updates, caller_name='complete_accounts_index_update')
+    accounts_index_table = aws_clients.get_resource('dynamodb').Table(ACCOUNTS_INDEX_TABLE_NAME)
+    update_expression = 'SET Version = if_not_exists(Version, :zero) + :one'
+    expression_attribute_names = {}
+    expression_attribute_values = {':claim_owner': claim_owner, ':zero': 0, ':one': 1}
+    for name, value in state_updates.items():
+        update_expression += f', #{name} = :{name}'
+        expression_attribute_names[f'#{name}'] = name
+        expression_attribute_values[f':{name}'] = value
+    update_arguments = {'ExpressionAttributeNames': expression_attribute_names} if expression_attribute_names else {}
+    try:
+        response = accounts_index_table.update_item(
+            Key={'SafeName': safe_name, 'AccountId': ACCOUNTS_INDEX_STATE_ID},
+            UpdateExpression=update_expression + ' REMOVE ClaimOwner, ClaimExpiration',
+            ConditionExpression='ClaimOwner = :claim_owner',
+            ExpressionAttributeValues=expression_attribute_values,
+            ReturnValues='ALL_NEW',
+            **update_arguments
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.error(f'Accounts index update of {safe_name} took longer than its claim')
+        return None
+    return response['Attributes']
+
+
+# Saves the accounts listed by the accounts API in the generation of the safe index
+def put_indexed_accounts(safe_name, accounts, generation, expiration_time):
+    accounts_index_table = aws_clients.get_resource('dynamodb').Table(ACCOUNTS_INDEX_TABLE_NAME)
+    with accounts_index_table.batch_writer(overwrite_by_pkeys=['SafeName', 'AccountId']) as batch:
+        for account in accounts:
+            batch.put_item(Item={
+                'SafeName': safe_name,
+                'AccountId': account['id'],
+                'AddressKey': f"{account.get('address')},{account.get('userName')}",
+                'Name': account.get('name', ''),
+                'Generation': generation,
+                'ExpirationTime': expiration_time
+            })
+
+
+# Returns the accounts of the address and username in the generation of the safe index, like the accounts API lists them
+def get_indexed_accounts(safe_name, address, username, generation):
+    accounts_index_table = aws_clients.get_resource('dynamodb').Table(ACCOUNTS_INDEX_TABLE_NAME)
+    query_arguments = {
+        'IndexName': ACCOUNTS_INDEX_ADDRESS_INDEX_NAME,
+        'KeyConditionExpression': Key('SafeName').eq(safe_name) & Key('AddressKey').eq(f'{address},{username}'),
+        'FilterExpression': Attr('Generation').eq(generation)
+    }
+    accounts = []
+    while True:
+        response = accounts_index_table.query(**query_arguments)
+        accounts.extend({'id': item['AccountId'], 'name': item.get('Name', '')} for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return accounts
+        query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def delete_indexed_account(safe_name, account_id):
+    accounts_index_table = aws_clients.get_resource('dynamodb').Table(ACCOUNTS_INDEX_TABLE_NAME)
+    accounts_index_table.delete_item(Key={'SafeName': safe_name, 'AccountId': account_id})
+
+
+# Returns the username of the first rule matching the image description
+def get_os_distribution_user(image_description):
+    image_description = image_description.lower()
+    for description_pattern, username in get_os_username_rules():
+        if description_pattern in image_description:
+            return username
+    return DEFAULT_OS_USERNAME
+
+
+# Custom rules are a JSON list of [description substring, username] pairs, checked before the default rules
+def get_os_username_rules():
+    custom_rules = os.environ.get('AOB_OS_USERNAME_RULES')
+    if not custom_rules:
+        return OS_USERNAME_RULES
+    try:
+        return tuple((description_pattern.lower(), username)
+                     for description_pattern, username in json.loads(custom_rules)) + OS_USERNAME_RULES
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error(f'Invalid AOB_OS_USERNAME_RULES, using the default rules: {str(e)}')
+        return OS_USERNAME_RULES
+
+
 # Check on DynamoDB if instance exists
 # Return False when not found, or row data from table
 def get_instance_data_from_dynamo_table(instance_id):
     logger.trace(instance_id, caller_name='get_instance_data_from_dynamo_table')
     logger.info(f'Check with DynamoDB if instance {instance_id} exists')
-    dynamo_resource = boto3.client('dynamodb')
+    dynamo_resource = aws_clients.get_client('dynamodb')
 
     try:
         dynamo_response = dynamo_resource.get_item(TableName='Instances', Key={"InstanceId": {"S": instance_id}})
@@ -90,14 +329,66 @@ def get_instance_data_from_dynamo_table(instance_id):
         return False
     # DynamoDB "Item" response: {'Address': {'S': 'xxx.xxx.xxx.xxx'}, 'instance_id': {'S': 'i-xxxxxyyyyzzz'},
     #               'Status': {'S': 'on-boarded'}, 'Error': {'S': 'Some Error'}}
-    if 'Item' in dynamo_response:
+    if 'Item' in dynamo_response and 'Status' in dynamo_response['Item']:  # Items holding only a lease are not on DB
         if dynamo_response["Item"]["InstanceId"]["S"] == instance_id:
             logger.info(f'{instance_id} exists in DynamoDB')
             return dynamo_response["Item"]
     return False
 
 
-def get_params_from_param_store():
+# Returns the Instances table status of each of the instances found in the table
+def get_instances_status_from_dynamo_table(instance_ids):
+    logger.trace(instance_ids, caller_name='get_instances_status_from_dynamo_table')
+    dynamo_client = aws_clients.get_client('dynamodb')
+    instances_status = {}
+    for i in range(0, len(instance_ids), BATCH_GET_ITEM_LIMIT):
+        request_items = {'Instances': {
+            'Keys': [{'InstanceId': {'S': instance_id}} for instance_id in instance_ids[i:i + BATCH_GET_ITEM_LIMIT]],
+            'ProjectionExpression': 'InstanceId, #status',
+            'ExpressionAttributeNames': {'#status': 'Status'}
+        }}
+        while request_items:
+            dynamo_response = dynamo_client.batch_get_item(RequestItems=request_items)
+            for item in dynamo_response['Responses'].get('Instances', []):
+                if 'Status' in item:
+                    instances_status[item['InstanceId']['S']] = item['Status']['S']
+            request_items = dynamo_response.get('UnprocessedKeys')
+            if request_items:  # Throttled keys are requested again
+                time.sleep(random.uniform(0.05, 0.2))
+    return instances_status
+
+
+# Returns the cached parameters while they are valid, otherwise retrieves them through TrustMechanism
+def get_params_from_param_store(use_cache=True):
+    with params_cache_lock:
+        if use_cache and params_cache['store_parameters'] and time.time() < params_cache['expiration']:
+            params_cache['hits'] += 1
+            logger.info(f"Parameters cache hit (hits: {params_cache['hits']}, misses: {params_cache['misses']})",
+                        DEBUG_LEVEL_DEBUG)
+            return params_cache['store_parameters']
+        params_cache['misses'] += 1
+        logger.info(f"Parameters cache miss (hits: {params_cache['hits']}, misses: {params_cache['misses']})")
+        store_parameters_class = retrieve_params_from_param_store()
+        params_cache['store_parameters'] = store_parameters_class
+        params_cache['expiration'] = time.time() + get_params_cache_ttl()
+        return store_parameters_class
+
+
+def invalidate_params_cache():
+    logger.info('Invalidating parameters cache')
+    with params_cache_lock:
+        params_cache['store_parameters'] = None
+        params_cache['expiration'] = 0
+
+
+def get_params_cache_ttl():
+    try:
+        return int(os.environ.get('AOB_PARAMS_CACHE_TTL', DEFAULT_PARAMS_CACHE_TTL))
+    except ValueError:
+        return DEFAULT_PARAMS_CACHE_TTL
+
+
+def retrieve_params_from_param_store():
     # Parameters that will be retrieved from parameter store
     logger.info('Getting parameters from parameter store')
     UNIX_SAFE_NAME_PARAM = "AOB_Unix_Safe_Name"
@@ -110,15 +401,15 @@ def get_params_from_param_store():
     AOB_MODE = "AOB_mode"
     AOB_DEBUG_LEVEL = "AOB_Debug_Level"
 
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_clients.get_client('lambda', single_attempt=True)
     lambda_request_data = dict()
     lambda_request_data["Parameters"] = [UNIX_SAFE_NAME_PARAM, WINDOWS_SAFE_NAME_PARAM, VAULT_USER_PARAM, PVWA_IP_PARAM,
                                          AWS_KEYPAIR_SAFE, VAULT_PASSWORD_PARAM_, PVWA_VERIFICATION_KEY, AOB_MODE,
                                          AOB_DEBUG_LEVEL]
     try:
-        response = lambda_client.invoke(FunctionName='TrustMechanism',
-                                        InvocationType='RequestResponse',
-                                        Payload=json.dumps(lambda_request_data))
+        response = retry_mechanism.AWS_RETRY_POLICY.call(lambda_client.invoke, FunctionName='TrustMechanism',
+                                                         InvocationType='RequestResponse',
+                                                         Payload=json.dumps(lambda_request_data))
     except Exception as e:
         logger.error(f"Error retrieving parameters from parameter parameter store:\n{str(e)}")
         raise Exception(f"Error retrieving parameters from parameter parameter store: {str(e)}")
@@ -153,24 +444,42 @@ def get_params_from_param_store():
     return store_parameters_class
 
 
-def put_instance_to_dynamo_table(instance_id, ip_address, on_board_status, on_board_error="None", log_name="None"):
-    logger.trace(instance_id, ip_address, on_board_status, on_board_error, log_name, caller_name='put_instance_to_dynamo_table')
+# vault_account holds the VaultAccountId, Platform, SafeName and Username of the onboarded account,
+# so its termination does not need to describe the instance or search the vault.
+# The account and region of failed instances are saved for the sweeper
+def put_instance_to_dynamo_table(instance_id, ip_address, on_board_status, on_board_error="None", log_name="None",
+                                 vault_account=None, lease=None, event_account_id=None, event_region=None):
+    logger.trace(instance_id, ip_address, on_board_status, on_board_error, log_name, vault_account, lease,
+                 event_account_id, event_region, caller_name='put_instance_to_dynamo_table')
     logger.info(f'Adding  {instance_id} to DynamoDB')
-    dynamodb_resource = boto3.resource('dynamodb')
+    dynamodb_resource = aws_clients.get_resource('dynamodb')
     instances_table = dynamodb_resource.Table("Instances")
+    item = {
+        'InstanceId': instance_id,
+        'Address': ip_address,
+        'Status': on_board_status,
+        'Error': on_board_error,
+        'LogId': log_name
+    }
+    if vault_account:
+        item.update(vault_account)
+    if event_account_id:
+        item.update({'AccountId': event_account_id, 'Region': event_region})
+    lease_condition = {}
+    if lease:  # The item keeps the lease of the event writing it
+        item.update({'LeaseOwner': lease.owner, 'LeaseExpiration': lease.expiration, 'Version': lease.version + 1})
+        lease_condition = lease.get_condition()
     try:
         instances_table.put_item(
-            Item={
-                'InstanceId': instance_id,
-                'Address': ip_address,
-                'Status': on_board_status,
-                'Error': on_board_error,
-                'LogId': log_name
-            }
+            Item=item,
+            **lease_condition
         )
-    except Exception:
-        logger.error('Exception occurred on add item to DynamoDB')
+    except Exception as e:
+        logger.error(f'Exception occurred on add item to DynamoDB: {get_lease_error(e, lease)}')
         return False
+    if lease:
+        lease.version += 1
+        lease.has_status = True
 
     logger.info(f'Item {instance_id} added successfully to DynamoDB')
     return True
@@ -179,9 +488,10 @@ def put_instance_to_dynamo_table(instance_id, ip_address, on_board_status, on_bo
 def release_session_on_dynamo(session_id, session_guid, sessions_table_lock_client=False):
     logger.trace(session_id, session_guid, caller_name='release_session_on_dynamo')
     logger.info('Releasing session lock from DynamoDB')
+    retry_mechanism.set_pvwa_lock_deadline(None)
     try:
         if not sessions_table_lock_client:
-            sessions_table_lock_client = LockerClient('Sessions')
+            sessions_table_lock_client = SessionsLockClient('Sessions')
         sessions_table_lock_client.locked = True
         sessions_table_lock_client.guid = session_guid
         sessions_table_lock_client.release(session_id)
@@ -192,79 +502,457 @@ def release_session_on_dynamo(session_id, session_guid, sessions_table_lock_clie
     return True
 
 
-def remove_instance_from_dynamo_table(instance_id):
-    logger.trace(instance_id, caller_name='remove_instance_from_dynamo_table')
+def remove_instance_from_dynamo_table(instance_id, lease=None):
+    logger.trace(instance_id, lease, caller_name='remove_instance_from_dynamo_table')
     logger.info(f'Removing {instance_id} from DynamoDB')
-    dynamodb_resource = boto3.resource('dynamodb')
+    dynamodb_resource = aws_clients.get_resource('dynamodb')
     instances_table = dynamodb_resource.Table("Instances")
     try:
         instances_table.delete_item(
             Key={
                 'InstanceId': instance_id
-            }
+            },
+            **(lease.get_condition() if lease else {})
         )
     except Exception as e:
-        logger.error(f'Exception occurred on deleting {instance_id} on dynamodb:\n{str(e)}')
+        logger.error(f'Exception occurred on deleting {instance_id} on dynamodb:\n{get_lease_error(e, lease)}')
         return False
+    if lease:  # The lease was deleted with the item
+        lease.removed = True
 
     logger.info(f'Item {instance_id} successfully deleted from DB')
     return True
 
 
-def get_session_from_dynamo(sessions_table_lock_client=False):
+# Returns a free PVWA connection number and the guid of its lock.
+# Connections this container already holds a PVWA session for are tried first, then the connections following
+# an atomic counter, so concurrent lambdas start from different connection numbers
+def get_session_from_dynamo(sessions_table_lock_client=False, preferred_sessions=()):
     logger.info("Getting available Session from DynamoDB")
     if not sessions_table_lock_client:
-        sessions_table_lock_client = LockerClient('Sessions')
-
-    timeout = 20000  # Setting the timeout to 20 seconds on a row lock
-    random_session_number = str(random.randint(1, 100))  # A number between 1 and 100
+        sessions_table_lock_client = SessionsLockClient('Sessions')
 
+    start_time = time.time()
+    retry_interval = 0.2
     try:
-        for i in range(0, 20):
-
-            lock_response = sessions_table_lock_client.acquire(random_session_number, timeout)
-            if lock_response:  # no lock on connection number, return it
-                logger.info("Successfully retrieved session from DynamoDB")
-                return random_session_number, sessions_table_lock_client.guid
-            else:  # connection number is locked, retry in 5 seconds
-                time.sleep(5)
-                continue
-        #  if reached here, 20 retries with 5 seconds between retry - ended
+        while True:
+            for session_number in get_session_candidates(sessions_table_lock_client, preferred_sessions):
+                if acquire_session(sessions_table_lock_client, session_number, SESSION_LOCK_TIMEOUT):
+                    logger.info("Successfully retrieved session from DynamoDB")
+                    logger.metric('SessionAcquisitionLatency', int((time.time() - start_time) * 1000), 'Milliseconds')
+                    return session_number, sessions_table_lock_client.guid
+            if time.time() - start_time + retry_interval > SESSION_WAIT_TIMEOUT:
+                break
+            if circuit_breaker.is_pvwa_open():  # The connection would not be used before the PVWA is back
+                logger.info("PVWA circuit opened while waiting for a connection")
+                return False, ""
+            # all the tried connections are taken, wait for one to be released
+            time.sleep(retry_interval + random.uniform(0, retry_interval))
+            retry_interval = min(retry_interval * 2, 5)
         logger.info("Connection limit has been reached")
+        logger.metric('SessionAcquisitionTimeout', 1)
         return False, ""
     except Exception as e:
         print(f"Failed to retrieve session from DynamoDB: {str(e)}")
         raise Exception(f"Exception on get_session_from_dynamo:{str(e)}")
 
 
-def update_instances_table_status(instance_id, status, error="None"):
-    logger.trace(instance_id, status, error, caller_name='update_instances_table_status')
+def get_session_candidates(sessions_table_lock_client, preferred_sessions=()):
+    candidates = [str(session_number) for session_number in preferred_sessions]
+    random.shuffle(candidates)  # concurrent events of this container hold some of them
+    candidates = candidates[:SESSION_PROBES]
+    try:
+        counter_response = sessions_table_lock_client.db.update_item(
+            TableName=sessions_table_lock_client.lock_table_name,
+            Key={'name': {'S': SESSION_COUNTER_NAME}},
+            UpdateExpression='ADD #value :one',
+            ExpressionAttributeNames={'#value': 'value'},
+            ExpressionAttributeValues={':one': {'N': '1'}},
+            ReturnValues='UPDATED_NEW'
+        )
+        first_session = int(counter_response['Attributes']['value']['N']) % MAX_PVWA_CONNECTIONS
+    except Exception as e:
+        logger.error(f'Failed to get the next session number from DynamoDB, using a random one: {str(e)}')
+        first_session = random.randint(0, MAX_PVWA_CONNECTIONS - 1)
+    for i in range(0, SESSION_PROBES):
+        session_number = str((first_session + i) % MAX_PVWA_CONNECTIONS + 1)  # A number between 1 and 100
+        if session_number not in candidates:
+            candidates.append(session_number)
+    return candidates
+
+
+# Locks the connection number with a single conditional write, compatible with LockerClient.release
+def acquire_session(sessions_table_lock_client, session_number, timeout):
+    guid = str(uuid.uuid4())
+    now = time.time()
+    try:
+        sessions_table_lock_client.db.put_item(
+            TableName=sessions_table_lock_client.lock_table_name,
+            Item={
+                'name': {'S': session_number},
+                'guid': {'S': guid},
+                'expiresOn': {'N': str(now + timeout / 1000.0)}
+            },
+            ConditionExpression='attribute_not_exists(guid) OR expiresOn < :now',
+            ExpressionAttributeValues={':now': {'N': str(now)}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':  # connection number is locked
+            return False
+        raise e
+    sessions_table_lock_client.locked = True
+    sessions_table_lock_client.guid = guid
+    retry_mechanism.set_pvwa_lock_deadline(now + timeout / 1000.0)
+    return True
+
+
+def update_instances_table_status(instance_id, status, error="None", lease=None, event_account_id=None, event_region=None):
+    logger.trace(instance_id, status, error, lease, event_account_id, event_region, caller_name='update_instances_table_status')
     logger.info(f'Updating DynamoDB with {instance_id} onboarding status. \nStatus: {status}')
+    update_arguments = {
+        'UpdateExpression': 'SET #status = :status, #error = :error',
+        'ExpressionAttributeNames': {'#status': 'Status', '#error': 'Error'},
+        'ExpressionAttributeValues': {':status': status, ':error': error}
+    }
+    if event_account_id:
+        update_arguments['UpdateExpression'] += ', AccountId = :account_id, #region = :region'
+        update_arguments['ExpressionAttributeNames']['#region'] = 'Region'
+        update_arguments['ExpressionAttributeValues'].update({':account_id': event_account_id, ':region': event_region})
+    if lease:
+        lease_condition = lease.get_condition()
+        update_arguments['UpdateExpression'] += ', Version = :next_version'
+        update_arguments['ConditionExpression'] = lease_condition['ConditionExpression']
+        update_arguments['ExpressionAttributeValues'].update(lease_condition['ExpressionAttributeValues'])
+        update_arguments['ExpressionAttributeValues'][':next_version'] = lease.version + 1
     try:
-        dynamodb_resource = boto3.resource('dynamodb')
+        dynamodb_resource = aws_clients.get_resource('dynamodb')
         instances_table = dynamodb_resource.Table("Instances")
         instances_table.update_item(
             Key={
                 'InstanceId': instance_id
             },
-            AttributeUpdates={
-                'Status': {
-                    "Value": status,
-                    "Action": "PUT"
-                },
-                'Error': {
-                    "Value": error,
-                    "Action": "PUT"
-                }
-            }
+            **update_arguments
         )
     except Exception as e:
-        logger.error(f'Exception occurred on updating session on DynamoDB {e}')
+        logger.error(f'Exception occurred on updating session on DynamoDB {get_lease_error(e, lease)}')
         return False
+    if lease:
+        lease.version += 1
+        lease.has_status = True
     logger.info("Instance data updated successfully")
     return True
 
 
+# Saves a Windows instance whose password is not available yet, it is onboarded by the pending password poll
+def put_instance_pending_password(instance_id, ip_address, event_account_id, event_region, next_poll_time, log_name="None",
+                                  lease=None):
+    logger.trace(instance_id, ip_address, event_account_id, event_region, next_poll_time, log_name, lease,
+                 caller_name='put_instance_pending_password')
+    logger.info(f'Adding {instance_id} to DynamoDB until its password is available')
+    dynamodb_resource = aws_clients.get_resource('dynamodb')
+    instances_table = dynamodb_resource.Table("Instances")
+    item = {
+        'InstanceId': instance_id,
+        'Address': ip_address,
+        'Status': PENDING_PASSWORD_STATUS,
+        'Error': "None",
+        'LogId': log_name,
+        'AccountId': event_account_id,
+        'Region': event_region,
+        'PollAttempts': 0,
+        'NextPollTime': int(next_poll_time)
+    }
+    lease_condition = {}
+    if lease:
+        item.update({'LeaseOwner': lease.owner, 'LeaseExpiration': lease.expiration, 'Version': lease.version + 1})
+        lease_condition = lease.get_condition()
+    try:
+        instances_table.put_item(
+            Item=item,
+            **lease_condition
+        )
+    except Exception as e:
+        logger.error(f'Exception occurred on add item to DynamoDB: {get_lease_error(e, lease)}')
+        return False
+    if lease:
+        lease.version += 1
+        lease.has_status = True
+    return True
+
+
+# Returns the instances waiting for their password whose next poll time has come
+def get_pending_password_instances(poll_time):
+    logger.trace(poll_time, caller_name='get_pending_password_instances')
+    dynamodb_resource = aws_clients.get_resource('dynamodb')
+    instances_table = dynamodb_resource.Table("Instances")
+    # The index is eventually consistent, overlapping polls of an instance are resolved by claim_pending_password_poll
+    query_arguments = {
+        'IndexName': INSTANCES_STATUS_INDEX_NAME,
+        'KeyConditionExpression': Key('Status').eq(PENDING_PASSWORD_STATUS),
+        'FilterExpression': Attr('NextPollTime').lte(int(poll_time))
+    }
+    pending_instances = []
+    while True:
+        response = instances_table.query(**query_arguments)
+        pending_instances.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return pending_instances
+        query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Returns the instances in the status whose next sweep time has come and that were swept less than max_sweep_attempts
+def get_instances_to_sweep(status, sweep_time, max_sweep_attempts):
+    logger.trace(status, sweep_time, max_sweep_attempts, caller_name='get_instances_to_sweep')
+    dynamodb_resource = aws_clients.get_resource('dynamodb')
+    instances_table = dynamodb_resource.Table("Instances")
+    query_arguments = {
+        'IndexName': INSTANCES_STATUS_INDEX_NAME,
+        'KeyConditionExpression': Key('Status').eq(status),
+        'FilterExpression': (Attr('NextSweepTime').not_exists() | Attr('NextSweepTime').lte(int(sweep_time))) &
+                            (Attr('SweepAttempts').not_exists() | Attr('SweepAttempts').lt(max_sweep_attempts))
+    }
+    instances = []
+    while True:
+        response = instances_table.query(**query_arguments)
+        instances.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return instances
+        query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Records the sweeps of an instance that is still in the failed status, and when it is swept next
+def put_instance_sweep_backoff(instance_id, status, sweep_attempts, next_sweep_time):
+    logger.trace(instance_id, status, sweep_attempts, next_sweep_time, caller_name='put_instance_sweep_backoff')
+    dynamodb_resource = aws_clients.get_resource('dynamodb')
+    instances_table = dynamodb_resource.Table("Instances")
+    try:
+        instances_table.update_item(
+            Key={
+                'InstanceId': instance_id
+            },
+            UpdateExpression='SET SweepAttempts = :sweep_attempts, NextSweepTime = :next_sweep_time',
+            ConditionExpression='#status = :status',
+            ExpressionAttributeNames={'#status': 'Status'},
+            ExpressionAttributeValues={
+                ':sweep_attempts': sweep_attempts,
+                ':next_sweep_time': int(next_sweep_time),
+                ':status': status
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':  # Processed by an event meanwhile
+            logger.info(f'{instance_id} is no longer in status {status}', DEBUG_LEVEL_DEBUG)
+        else:
+            logger.error(f'Exception occurred on updating {instance_id} on DynamoDB: {str(e)}')
+        return False
+    except Exception as e:
+        logger.error(f'Exception occurred on updating {instance_id} on DynamoDB: {str(e)}')
+        return False
+    return True
+
+
+# Moves the next poll time of a pending instance, only one poll of the instance wins when polls overlap
+def claim_pending_password_poll(instance_id, poll_attempts, next_poll_time):
+    logger.trace(instance_id, poll_attempts, next_poll_time, caller_name='claim_pending_password_poll')
+    dynamodb_resource = aws_clients.get_resource('dynamodb')
+    instances_table = dynamodb_resource.Table("Instances")
+    try:
+        instances_table.update_item(
+            Key={
+                'InstanceId': instance_id
+            },
+            UpdateExpression='SET PollAttempts = :poll_attempts, NextPollTime = :next_poll_time',
+            ConditionExpression='#status = :pending AND PollAttempts = :previous_poll_attempts',
+            ExpressionAttributeNames={'#status': 'Status'},
+            ExpressionAttributeValues={
+                ':poll_attempts': poll_attempts,
+                ':next_poll_time': int(next_poll_time),
+                ':pending': PENDING_PASSWORD_STATUS,
+                ':previous_poll_attempts': poll_attempts - 1
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f'{instance_id} is already polled', DEBUG_LEVEL_DEBUG)
+        else:
+            logger.error(f'Exception occurred on updating {instance_id} on DynamoDB: {str(e)}')
+        return False
+    return True
+
+
+# Records the event as the latest one of the instance, returns (False, latest event) for duplicate and stale events,
+# otherwise (True, previous event). Events are processed when the InstanceEvents table is not available
+def claim_instance_event(instance_id, state, event_time):
+    logger.trace(instance_id, state, event_time, caller_name='claim_instance_event')
+    instance_events_table = aws_clients.get_resource('dynamodb').Table(INSTANCE_EVENTS_TABLE_NAME)
+    condition_expression = 'attribute_not_exists(InstanceId) OR LastEventTime < :event_time'
+    if state == 'terminated':  # A termination wins over a running event of the same second
+        condition_expression += ' OR (LastEventTime = :event_time AND LastState <> :state)'
+    try:
+        response = instance_events_table.update_item(
+            Key={
+                'InstanceId': instance_id
+            },
+            UpdateExpression='SET LastState = :state, LastEventTime = :event_time, ExpirationTime = :expiration_time',
+            ConditionExpression=condition_expression,
+            ExpressionAttributeValues={
+                ':state': state,
+                ':event_time': event_time,
+                ':expiration_time': int(time.time()) + INSTANCE_EVENTS_TTL
+            },
+            ReturnValues='ALL_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.error(f'Failed to record the {state} event of {instance_id}, processing it anyway: {str(e)}')
+            return True, {}
+        latest_event = instance_events_table.get_item(Key={'InstanceId': instance_id}, ConsistentRead=True).get('Item', {})
+        return False, latest_event
+    except Exception as e:
+        logger.error(f'Failed to record the {state} event of {instance_id}, processing it anyway: {str(e)}')
+        return True, {}
+    return True, response.get('Attributes', {})
+
+
+# Restores the previous event of the instance so the redelivery of a failed event is not dropped as a duplicate
+def release_instance_event(instance_id, state, event_time, previous_event):
+    logger.trace(instance_id, state, event_time, previous_event, caller_name='release_instance_event')
+    instance_events_table = aws_clients.get_resource('dynamodb').Table(INSTANCE_EVENTS_TABLE_NAME)
+    claim_condition = {
+        'ConditionExpression': 'LastState = :state AND LastEventTime = :event_time',
+        'ExpressionAttributeValues': {':state': state, ':event_time': event_time}
+    }
+    try:
+        if 'LastEventTime' in previous_event:
+            claim_condition['ExpressionAttributeValues'].update({
+                ':previous_state': previous_event['LastState'],
+                ':previous_event_time': previous_event['LastEventTime']
+            })
+            instance_events_table.update_item(
+                Key={
+                    'InstanceId': instance_id
+                },
+                UpdateExpression='SET LastState = :previous_state, LastEventTime = :previous_event_time',
+                **claim_condition
+            )
+        else:
+            instance_events_table.delete_item(Key={'InstanceId': instance_id}, **claim_condition)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':  # A newer event was recorded meanwhile
+            logger.error(f'Failed to release the {state} event of {instance_id}: {str(e)}')
+    except Exception as e:
+        logger.error(f'Failed to release the {state} event of {instance_id}: {str(e)}')
+
+
+# Leases the Instances item of the instance, so the events of an instance are processed one at a time.
+# Waits while another event holds the lease, returns None when it is still held after the timeout
+def acquire_instance_lease(instance_id, timeout=INSTANCE_LEASE_WAIT_TIMEOUT):
+    logger.trace(instance_id, timeout, caller_name='acquire_instance_lease')
+    dynamo_client = aws_clients.get_client('dynamodb')
+    lease_owner = str(uuid.uuid4())
+    start_time = time.time()
+    wait_time = 0.1
+    while True:
+        lease_time = int(time.time())
+        lease_expiration = lease_time + get_instance_lease_duration()
+        try:
+            dynamo_response = dynamo_client.update_item(
+                TableName='Instances',
+                Key={'InstanceId': {'S': instance_id}},
+                UpdateExpression='SET LeaseOwner = :lease_owner, LeaseExpiration = :lease_expiration, '
+                                 'Version = if_not_exists(Version, :initial_version)',
+                ConditionExpression='attribute_not_exists(LeaseOwner) OR LeaseExpiration < :lease_time',
+                ExpressionAttributeValues={
+                    ':lease_owner': {'S': lease_owner},
+                    ':lease_expiration': {'N': str(lease_expiration)},
+                    ':lease_time': {'N': str(lease_time)},
+                    ':initial_version': {'N': '0'}
+                },
+                ReturnValues='ALL_NEW'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.error(f'Failed to acquire the lease of {instance_id}: {str(e)}')
+                return None
+            if time.time() - start_time > timeout:
+                logger.error(f'{instance_id} is still processed by another event after {timeout} seconds')
+                return None
+            logger.info(f'{instance_id} is processed by another event, waiting', DEBUG_LEVEL_DEBUG)
+            time.sleep(random.uniform(wait_time / 2, wait_time))
+            wait_time = min(wait_time * 2, 2)
+            continue
+        item = dynamo_response['Attributes']
+        # Items holding only a lease are not on DB
+        return InstanceLease(instance_id, lease_owner, lease_expiration, int(item['Version']['N']),
+                             item if 'Status' in item else False)
+
+
+# A lease expires shortly after the invocation holding it times out, a crashed invocation blocks its instance only briefly
+def get_instance_lease_duration():
+    remaining_lambda_time = retry_mechanism.get_remaining_lambda_time()
+    if remaining_lambda_time is None:
+        return INSTANCE_LEASE_DURATION
+    return max(int(remaining_lambda_time) + retry_mechanism.RESERVED_LAMBDA_TIME, 0) + INSTANCE_LEASE_MARGIN
+
+
+# Removes the lease from the item, or the item itself when it holds only the lease
+def release_instance_lease(lease):
+    logger.trace(lease, caller_name='release_instance_lease')
+    if lease.removed:
+        return
+    instances_table = aws_clients.get_resource('dynamodb').Table("Instances")
+    try:
+        if lease.has_status:
+            instances_table.update_item(
+                Key={'InstanceId': lease.instance_id},
+                UpdateExpression='REMOVE LeaseOwner, LeaseExpiration',
+                ConditionExpression='LeaseOwner = :lease_owner',
+                ExpressionAttributeValues={':lease_owner': lease.owner}
+            )
+        else:
+            instances_table.delete_item(
+                Key={'InstanceId': lease.instance_id},
+                ConditionExpression='LeaseOwner = :lease_owner AND attribute_not_exists(#status)',
+                ExpressionAttributeNames={'#status': 'Status'},
+                ExpressionAttributeValues={':lease_owner': lease.owner}
+            )
+    except Exception as e:
+        logger.error(f'Failed to release the lease of {lease.instance_id}: {get_lease_error(e, lease)}')
+
+
+def get_lease_error(error, lease):
+    if lease and isinstance(error, ClientError) and error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+        return f'{lease.instance_id} lease expired or the item was changed by another event'
+    return str(error)
+
+
+# LockerClient using the shared DynamoDB client instead of creating a new one for every lock
+class SessionsLockClient(LockerClient):
+    def __init__(self, lock_table_name):
+        self.lock_table_name = lock_table_name
+        self.db = aws_clients.get_client('dynamodb')
+        self.locked = False
+        self.guid = ""
+
+
+class InstanceLease:
+    def __init__(self, instance_id, owner, expiration, version, instance_data):
+        self.instance_id = instance_id
+        self.owner = owner
+        self.expiration = expiration
+        self.version = version  # Incremented by each status transition written with the lease
+        self.instance_data = instance_data  # Instances item when the lease was acquired, False when not on DB
+        self.has_status = bool(instance_data)
+        self.removed = False
+
+    # Writes are applied only while the lease is held and the item is at the version seen by its holder
+    def get_condition(self):
+        return {
+            'ConditionExpression': 'LeaseOwner = :lease_owner AND Version = :lease_version',
+            'ExpressionAttributeValues': {':lease_owner': self.owner, ':lease_version': self.version}
+        }
+
+
 class StoreParameters:
     unix_safe_name = ""
     windows_safe_name = ""
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from botocore.exceptions import ClientError
+import aws_clients
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+CIRCUIT_TABLE_NAME = 'Sessions'  # The circuit is an item of the Sessions table, shared by all the lambdas
+CIRCUIT_ITEM_NAME = 'PvwaCircuitBreaker'
+DEFAULT_FAILURE_THRESHOLD = 5  # Consecutive PVWA failures opening the circuit
+DEFAULT_OPEN_TIME = 60  # Seconds events fail fast before an event is sent to probe the PVWA
+PROBE_TIMEOUT = 60  # Seconds the probe event has to report its outcome before another event probes
+CIRCUIT_STATE_CACHE_TTL = 5  # Seconds a container reuses the circuit item before reading it again
+logger = LogMechanism()
+# Latest circuit item read or written by this container
+circuit_state = {'item': {}, 'expiration': 0}
+circuit_state_lock = threading.Lock()
+
+
+# The circuit is closed while the item has no OpenUntil attribute, open until OpenUntil, then half open:
+# a single event at a time claims the probe, its success closes the circuit and its failure opens it again.
+# Returns True when the event can call the PVWA
+def is_pvwa_available():
+    item = get_circuit_state()
+    if 'OpenUntil' not in item:
+        return True
+    now = int(time.time())
+    if int(item['OpenUntil']) > now or int(item.get('ProbeExpiration', 0)) >= now:
+        return False
+    return claim_probe(now)
+
+
+# Returns True while the circuit is open, without claiming the probe
+def is_pvwa_open():
+    item = get_circuit_state()
+    return 'OpenUntil' in item and int(item['OpenUntil']) > time.time()
+
+
+def claim_probe(now):
+    logger.trace(now, caller_name='claim_probe')
+    try:
+        response = get_circuit_table().update_item(
+            Key={'name': CIRCUIT_ITEM_NAME},
+            UpdateExpression='SET ProbeExpiration = :probe_expiration',
+            ConditionExpression='OpenUntil <= :now AND (attribute_not_exists(ProbeExpiration) OR ProbeExpiration < :now)',
+            ExpressionAttributeValues={':probe_expiration': now + PROBE_TIMEOUT, ':now': now},
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.error(f'Failed to claim the PVWA circuit probe, calling the PVWA: {str(e)}')
+            return True
+        # Another event is probing, or the circuit was closed or opened again meanwhile
+        return 'OpenUntil' not in refresh_circuit_state()
+    except Exception as e:
+        logger.error(f'Failed to claim the PVWA circuit probe, calling the PVWA: {str(e)}')
+        return True
+    set_circuit_state(response['Attributes'])
+    logger.info('PVWA circuit is half open, this event probes the PVWA')
+    return True
+
+
+def record_pvwa_failure():
+    logger.trace(caller_name='record_pvwa_failure')
+    circuit_table = get_circuit_table()
+    now = int(time.time())
+    try:
+        response = circuit_table.update_item(
+            Key={'name': CIRCUIT_ITEM_NAME},
+            UpdateExpression='ADD Failures :one',
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='ALL_NEW'
+        )
+        item = response['Attributes']
+        set_circuit_state(item)
+        if int(item['Failures']) < get_failure_threshold() or int(item.get('OpenUntil', 0)) > now:
+            return
+        open_time = get_open_time()
+        response = circuit_table.update_item(
+            Key={'name': CIRCUIT_ITEM_NAME},
+            UpdateExpression='SET OpenUntil = :open_until REMOVE ProbeExpiration',
+            ConditionExpression='attribute_not_exists(OpenUntil) OR OpenUntil <= :now',
+            ExpressionAttributeValues={':open_until': now + open_time, ':now': now},
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':  # Opened by another lambda
+            logger.error(f'Failed to record the PVWA failure on the circuit: {str(e)}')
+        return
+    except Exception as e:
+        logger.error(f'Failed to record the PVWA failure on the circuit: {str(e)}')
+        return
+    set_circuit_state(response['Attributes'])
+    logger.error(f'PVWA circuit opened after {item["Failures"]} consecutive failure(s), '
+                 f'events are saved as failed for the sweeper without calling the PVWA for {open_time} seconds')
+    logger.metric('PvwaCircuitOpened', 1)
+
+
+# Writes only when this container saw failures, a healthy PVWA costs no DynamoDB write
+def record_pvwa_success():
+    item = get_circuit_state()
+    if 'Failures' not in item and 'OpenUntil' not in item:
+        return
+    logger.trace(caller_name='record_pvwa_success')
+    try:
+        response = get_circuit_table().update_item(
+            Key={'name': CIRCUIT_ITEM_NAME},
+            UpdateExpression='REMOVE Failures, OpenUntil, ProbeExpiration',
+            ReturnValues='ALL_OLD'
+        )
+    except Exception as e:
+        logger.error(f'Failed to record the PVWA success on the circuit: {str(e)}')
+        return
+    set_circuit_state({'name': CIRCUIT_ITEM_NAME})
+    if 'OpenUntil' in response.get('Attributes', {}):
+        logger.info('PVWA is available again, circuit closed')
+        logger.metric('PvwaCircuitClosed', 1)
+
+
+def get_circuit_state():
+    with circuit_state_lock:
+        if time.time() < circuit_state['expiration']:
+            return circuit_state['item']
+    return refresh_circuit_state()
+
+
+# The PVWA is called when the circuit state cannot be read, the circuit must not stop the solution by itself
+def refresh_circuit_state():
+    try:
+        item = get_circuit_table().get_item(Key={'name': CIRCUIT_ITEM_NAME}, ConsistentRead=True).get('Item', {})
+    except Exception as e:
+        logger.error(f'Failed to read the PVWA circuit state, assuming it is closed: {str(e)}')
+        item = {}
+    set_circuit_state(item)
+    return item
+
+
+def set_circuit_state(item):
+    with circuit_state_lock:
+        circuit_state['item'] = item
+        circuit_state['expiration'] = time.time() + CIRCUIT_STATE_CACHE_TTL
+    logger.info(f'PVWA circuit state: {item}', DEBUG_LEVEL_DEBUG)
+
+
+def get_circuit_table():
+    return aws_clients.get_resource('dynamodb').Table(CIRCUIT_TABLE_NAME)
+
+
+def get_failure_threshold():
+    try:
+        return max(int(os.environ.get('AOB_PVWA_CIRCUIT_FAILURES', DEFAULT_FAILURE_THRESHOLD)), 1)
+    except ValueError:
+        return DEFAULT_FAILURE_THRESHOLD
+
+
+def get_open_time():
+    try:
+        return max(int(os.environ.get('AOB_PVWA_CIRCUIT_OPEN_TIME', DEFAULT_OPEN_TIME)), 1)
+    except ValueError:
+        return DEFAULT_OPEN_TIME
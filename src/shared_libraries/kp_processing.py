@@ -1,47 +1,138 @@
-import subprocess
-import sys
-import rsa
+import threading
+import hashlib
+import hmac
+import json
+import struct
 import base64
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from log_mechanism import LogMechanism
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+PPK_VERSION = 2  # Version of the PPK files written by the puttygen release that was bundled with the lambda
+PPK_COMMENT = 'imported-openssh-key'
+PPK_LINE_LENGTH = 64
+MAX_CACHED_KEYS = 32  # Parsed key pairs kept by the container, the oldest is dropped once full
+MAX_CACHED_PPKS = 64  # Converted keys kept by the container, a 4096 bits key is about 3KB
 logger = LogMechanism()
+# Parsed private keys, keyed by the SHA-256 fingerprint of the pem value
+private_keys = {}
+private_keys_lock = threading.Lock()
+# Converted keys keyed by (fingerprint, ppk version), instances launched with the same key pair share the conversion
+ppk_cache = {'ppk_values': {}, 'hits': 0, 'misses': 0}
+ppk_cache_lock = threading.Lock()
 
 
-def save_key_pair(pemKey):
-    # Save pem to file
-    logger.trace(caller_name='save_key_pair')
-    logger.info('Saving key pair to file')
-    savePemToFileCommand = 'echo {0} > /tmp/pemValue.pem'.format(pemKey)
-    subprocess.call([savePemToFileCommand], shell=True)
-    subprocess.call(["chmod 777 /tmp/pemValue.pem"], shell=True)
-
-
-def convert_pem_to_ppk(pemKey):
+def convert_pem_to_ppk(pemKey, ppk_version=PPK_VERSION):
     logger.trace(caller_name='convert_pem_to_ppk')
     logger.info('Converting pem to ppk')
-    #  convert pem file, get ppk value
-    #  Uses Puttygen sent to the lambda
-    save_key_pair(pemKey=pemKey)
-    subprocess.call(["cp ./puttygen /tmp/puttygen"], shell=True)
-    subprocess.call(["chmod 777 /tmp/puttygen "], shell=True)
-    subprocess.check_output("ls /tmp -l", shell=True)
-    subprocess.check_output("cat /tmp/pemValue.pem", shell=True)
-    conversionResult = subprocess.call(["/tmp/puttygen /tmp/pemValue.pem -O private -o /tmp/ppkValue.ppk"], shell=True)
-    if conversionResult == 0:
-        ppkKey = subprocess.check_output("cat /tmp/ppkValue.ppk", shell=True).decode("utf-8")
-        if 'Private-Lines' in ppkKey:
-            print("Pem key successfully converted")
-        else:
-            print("Failed to convert pem key to ppk")
-            raise Exception("Failed to convert pem key to ppk")
-    return ppkKey
-
-
-def decrypt_password(instance_password_data):
+    try:
+        cache_key = (get_fingerprint(get_pem_value(pemKey)), ppk_version)
+        with ppk_cache_lock:
+            ppk_key = ppk_cache['ppk_values'].get(cache_key)
+            ppk_cache['hits' if ppk_key else 'misses'] += 1
+        if ppk_key:
+            logger.info('Pem key already converted', DEBUG_LEVEL_DEBUG)
+            return ppk_key
+        private_key = get_private_key(pemKey)
+        if not isinstance(private_key, rsa.RSAPrivateKey):
+            raise Exception("Only RSA keys are supported")
+    except Exception as e:
+        logger.error(f'Failed to load pem key: {str(e)}')
+        raise Exception("Failed to convert pem key to ppk")
+    ppk_key = encode_ppk(private_key, ppk_version)
+    with ppk_cache_lock:
+        while len(ppk_cache['ppk_values']) >= MAX_CACHED_PPKS:
+            del ppk_cache['ppk_values'][next(iter(ppk_cache['ppk_values']))]
+        ppk_cache['ppk_values'][cache_key] = ppk_key
+    logger.info('Pem key successfully converted', DEBUG_LEVEL_DEBUG)
+    return ppk_key
+
+
+# Returns the PPK file of the RSA key, identical to 'puttygen key.pem -O private'
+def encode_ppk(private_key, ppk_version):
+    private_numbers = private_key.private_numbers()
+    public_numbers = private_numbers.public_numbers
+    public_blob = ppk_string(b'ssh-rsa') + ppk_mpint(public_numbers.e) + ppk_mpint(public_numbers.n)
+    private_blob = ppk_mpint(private_numbers.d) + ppk_mpint(private_numbers.p) + ppk_mpint(private_numbers.q) + \
+                   ppk_mpint(private_numbers.iqmp)
+    mac_data = ppk_string(b'ssh-rsa') + ppk_string(b'none') + ppk_string(PPK_COMMENT.encode()) + \
+               ppk_string(public_blob) + ppk_string(private_blob)
+    if ppk_version == 2:
+        # Unencrypted files are signed with the key derived from an empty passphrase
+        private_mac = hmac.new(hashlib.sha1(b'putty-private-key-file-mac-key').digest(), mac_data, hashlib.sha1)
+    elif ppk_version == 3:
+        private_mac = hmac.new(b'', mac_data, hashlib.sha256)
+    else:
+        raise Exception(f"Unsupported ppk version {ppk_version}")
+    public_lines = ppk_base64_lines(public_blob)
+    private_lines = ppk_base64_lines(private_blob)
+    ppk_lines = [f'PuTTY-User-Key-File-{ppk_version}: ssh-rsa', 'Encryption: none', f'Comment: {PPK_COMMENT}',
+                 f'Public-Lines: {len(public_lines)}'] + public_lines + [f'Private-Lines: {len(private_lines)}'] + \
+                private_lines + [f'Private-MAC: {private_mac.hexdigest()}']
+    return '\n'.join(ppk_lines) + '\n'
+
+
+# Returns the (hits, misses) of the conversion cache since the previous call
+def pop_ppk_cache_statistics():
+    with ppk_cache_lock:
+        statistics = ppk_cache['hits'], ppk_cache['misses']
+        ppk_cache['hits'] = ppk_cache['misses'] = 0
+    return statistics
+
+
+# Returns the pem value as bytes, the vault returns it as a JSON string
+def get_pem_value(pemKey):
+    pem_value = pemKey.strip()
+    if pem_value.startswith('"'):
+        pem_value = json.loads(pem_value)
+    return pem_value.encode()
+
+
+def ppk_string(value):
+    return struct.pack('>I', len(value)) + value
+
+
+def ppk_mpint(value):
+    # Big endian, with a leading zero byte when the high bit is set
+    return ppk_string(value.to_bytes((value.bit_length() + 8) // 8, 'big'))
+
+
+def ppk_base64_lines(blob):
+    value = base64.b64encode(blob).decode()
+    return [value[i:i + PPK_LINE_LENGTH] for i in range(0, len(value), PPK_LINE_LENGTH)]
+
+
+def decrypt_password(instance_password_data, pemKey):
     logger.trace(caller_name='decrypt_password')
     passwd = base64.b64decode(instance_password_data)
-    with open ("/tmp/pemValue.pem", 'r') as f:
-        private = rsa.PrivateKey.load_pkcs1(f.read())
-    decrypted_password = rsa.decrypt(passwd,private).decode("utf-8")
+    decrypted_password = get_private_key(pemKey).decrypt(passwd, padding.PKCS1v15()).decode("utf-8")
     return decrypted_password
+
+
+# Returns the parsed private key of the pem value, each key pair is parsed once per container
+def get_private_key(pemKey):
+    pem_value = get_pem_value(pemKey)
+    fingerprint = get_fingerprint(pem_value)
+    with private_keys_lock:
+        private_key = private_keys.get(fingerprint)
+    if private_key is None:
+        private_key = load_private_key(pem_value)
+        with private_keys_lock:
+            while len(private_keys) >= MAX_CACHED_KEYS:
+                del private_keys[next(iter(private_keys))]
+            private_keys[fingerprint] = private_key
+    return private_key
+
+
+def get_fingerprint(pem_value):
+    return hashlib.sha256(pem_value).hexdigest()
+
+
+def load_private_key(pem_value):
+    try:
+        # Key pairs come from the vault, the slow RSA key check of recent cryptography releases is skipped
+        return load_pem_private_key(pem_value, password=None, backend=default_backend(), unsafe_skip_rsa_key_validation=True)
+    except TypeError:  # Releases older than 39 do not check the key
+        return load_pem_private_key(pem_value, password=None, backend=default_backend())
@@ -1,12 +1,26 @@
-import boto3
+import json
+import os
+import threading
+import time
+import aws_clients
 
 DEBUG_LEVEL_INFO = 'info' # Outputs erros and info only.
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+METRICS_NAMESPACE = 'CyberArkAOB'
+# The debug level is read from the parameter store on the first log call and shared by all the loggers of the container
+debug_level_cache = {'value': None}
+debug_level_lock = threading.Lock()
 
 
 class LogMechanism:
+    # No AWS call is made here, loggers are created at import time and must not slow down the cold start
     def __init__(self):
-        self.debug_level = get_debug_level()
+        pass
+
+
+    @property
+    def debug_level(self):
+        return get_debug_level()
 
 
     def info(self, message, debug_level=DEBUG_LEVEL_INFO):
@@ -27,8 +41,31 @@ class LogMechanism:
             print(f'[TRACE] {caller_name}: ', args, sep=' | ')
 
 
+    # Prints the metric in CloudWatch embedded metric format, regardless of the debug level
+    def metric(self, name, value, unit='Count'):
+        function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'AOB')
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['FunctionName']],
+                                       'Metrics': [{'Name': name, 'Unit': unit}]}]
+            },
+            'FunctionName': function_name,
+            name: value
+        }))
+
+
+# Returns the debug level, retrieving it from the parameter store at most once per container
 def get_debug_level():
-    ssm = boto3.client('ssm')
+    if debug_level_cache['value'] is None:
+        with debug_level_lock:
+            if debug_level_cache['value'] is None:
+                debug_level_cache['value'] = retrieve_debug_level()
+    return debug_level_cache['value']
+
+
+def retrieve_debug_level():
+    ssm = aws_clients.get_client('ssm')
     ssm_parameter = ssm.get_parameter(
         Name='AOB_Debug_Level'
     )
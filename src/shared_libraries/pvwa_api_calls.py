@@ -1,46 +1,83 @@
+import json
+import os
+import threading
+import time
+from types import MappingProxyType
 import requests
+from cryptography.fernet import Fernet
+import aws_services
+import retry_mechanism
 from pvwa_integration import PvwaIntegration
 from log_mechanism import LogMechanism
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
-DEFAULT_HEADER = {"content-type": "application/json"}
+DEFAULT_HEADER = MappingProxyType({"content-type": "application/json"})  # Read only, calls copy it before adding their token
+DEFAULT_KEY_PAIR_CACHE_TTL = 0  # The key pair cache is disabled unless AOB_KEY_PAIR_CACHE_TTL is set
+MAX_KEY_PAIR_CACHE_TTL = 900
+DEFAULT_ACCOUNTS_INDEX_TTL = 0  # The accounts index is disabled unless AOB_ACCOUNTS_INDEX_TTL is set
+ACCOUNTS_INDEX_REFRESH_INTERVAL = 60  # Seconds between two incremental refreshes of a safe index
+ACCOUNTS_INDEX_REFRESH_MARGIN = 300  # Seconds of modifications fetched again, the vault and lambda clocks may differ
+ACCOUNTS_INDEX_REBUILD_INTERVAL = 3600  # Maximum age of a safe index, only a rebuild drops the accounts deleted by other means
+ACCOUNTS_INDEX_STATE_CHECK_INTERVAL = 10  # Seconds a container reuses the state of a safe index before reading it again
+ACCOUNTS_INDEX_CLAIM_TIME = 300  # Seconds a lambda has to update a safe index before another one can take over
+ACCOUNTS_PAGE_SIZE = 1000  # Maximal page size of the accounts API
 pvwa_integration_class = PvwaIntegration()
 logger = LogMechanism()
+# Key pair accounts keyed by account name, the key pair value is kept encrypted with a key that never leaves the container
+key_pair_cache = {'fernet': None, 'key_pairs': {}, 'fill_locks': {}}
+key_pair_cache_lock = threading.Lock()
+# State of the safe indexes kept in the AccountsIndex table, keyed by safe name. The accounts themselves are read from the
+# table, so a cold container neither lists the safe nor holds the accounts in memory
+accounts_index = {}
+accounts_index_lock = threading.Lock()
 
 
 def create_account_on_vault(session, account_name, account_password, store_parameters_class, platform_id, address,
-                            instance_id, username, safe_name):
+                            instance_id, username, safe_name, secret_type='password'):
     logger.trace(session, account_name, store_parameters_class, platform_id, address,
-                 instance_id, username, safe_name, caller_name='create_account_on_vault')
+                 instance_id, username, safe_name, secret_type, caller_name='create_account_on_vault')
     logger.info(f'Creating account in vault for {instance_id}')
-    header = DEFAULT_HEADER
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session})
-    url = f"{store_parameters_class.pvwa_url}/WebServices/PIMServices.svc/Account"
-    data = f"""
-    {{
-        "account" : {{
-            "safe":"{safe_name}",
-            "platformID":"{platform_id}",
-            "address":"{address}",
-            "accountName":"{account_name}",
-            "password":"{account_password}",
-            "username":"{username}",
-            "disableAutoMgmt":"false"
-        }}
-    }}
-    """
+    url = f"{store_parameters_class.pvwa_url}/API/Accounts"
+    data = json.dumps({
+        "name": account_name,
+        "address": address,
+        "userName": username,
+        "platformId": platform_id,
+        "safeName": safe_name,
+        "secretType": secret_type,
+        "secret": account_password,
+        "secretManagement": {"automaticManagementEnabled": True}
+    })
     rest_response = pvwa_integration_class.call_rest_api_post(url, data, header)
-    if rest_response.status_code == requests.codes.created:
+    if rest_response is not None and rest_response.status_code == requests.codes.created:
         logger.info(f"Account for {instance_id} was successfully created")
-        return True, ""
-    logger.error(f'Failed to create the account for {instance_id} from the vault. status code:{rest_response.status_code}')
-    return False, f"Error Creating Account, Status Code:{rest_response.status_code}"
+        account_id = get_created_account_id(rest_response)
+        if not account_id:
+            logger.info(f'Account id of {instance_id} is missing from the response, searching the vault')
+            account_id = retrieve_account_id_from_account_name(session, f"{address},{username}", safe_name, instance_id,
+                                                               store_parameters_class.pvwa_url)
+        elif safe_name and get_accounts_index_ttl():
+            add_indexed_account(safe_name, address, username, account_id, account_name)
+        return account_id, ""
+    status_code = rest_response.status_code if rest_response is not None else None
+    logger.error(f'Failed to create the account for {instance_id} from the vault. status code:{status_code}')
+    return False, f"Error Creating Account, Status Code:{status_code}"
+
+
+# Returns the id of the account created by the accounts API, or None when the response has no account
+def get_created_account_id(rest_response):
+    try:
+        return rest_response.json().get('id')
+    except (ValueError, AttributeError):
+        return None
 
 
 def rotate_credentials_immediately(session, pvwa_url, account_id, instance_id):
     logger.trace(session, pvwa_url, account_id, instance_id, caller_name='rotate_credentials_immediately')
     logger.info(f'Rotating {instance_id} credentials')
-    header = DEFAULT_HEADER
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session})
     url = f"{pvwa_url}/API/Accounts/{account_id}/Change"
     data = ""
@@ -48,6 +85,8 @@ def rotate_credentials_immediately(session, pvwa_url, account_id, instance_id):
     if rest_response.status_code == requests.codes.ok:
         logger.info(f"Call for immediate key change for {instance_id} performed successfully")
         return True
+    if rest_response.status_code == requests.codes.not_found:
+        remove_indexed_account(account_id)
     logger.error(f'Failed to call key change for {instance_id}. an error occurred')
     return False
 
@@ -55,15 +94,18 @@ def rotate_credentials_immediately(session, pvwa_url, account_id, instance_id):
 def get_account_value(session, account, instance_id, rest_url):
     logger.trace(session, account, instance_id, rest_url, caller_name='get_account_value')
     logger.info(f'Getting {instance_id} account from vault')
-    header = DEFAULT_HEADER
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session})
     pvwa_url = f"{rest_url}/api/Accounts/{account}/Password/Retrieve"
     rest_logon_data = """{ "reason":"AWS Auto On-Boarding Solution" }"""
-    rest_response = pvwa_integration_class.call_rest_api_post(pvwa_url, rest_logon_data, header)
+    # Retrieving the password again does not change it
+    rest_response = pvwa_integration_class.call_rest_api_post(pvwa_url, rest_logon_data, header,
+                                                              retry_mechanism.PVWA_RETRY_POLICY)
     if rest_response.status_code == requests.codes.ok:
         return rest_response.text
     elif rest_response.status_code == requests.codes.not_found:
         logger.info(f"Account {account} for instance {instance_id}, not found on vault")
+        remove_indexed_account(account)
         return False
     logger.error(f"Unexpected result from rest service - get account value, status code: {rest_response.status_code}")
     return False
@@ -72,7 +114,7 @@ def get_account_value(session, account, instance_id, rest_url):
 def delete_account_from_vault(session, account_id, instance_id, pvwa_url):
     logger.trace(session, account_id, instance_id, pvwa_url, caller_name='delete_account_from_vault')
     logger.info(f'Deleting {instance_id} from vault')
-    header = DEFAULT_HEADER
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session})
     rest_url = f"{pvwa_url}/WebServices/PIMServices.svc/Accounts/{account_id}"
     rest_response = pvwa_integration_class.call_rest_api_delete(rest_url, header)
@@ -80,18 +122,20 @@ def delete_account_from_vault(session, account_id, instance_id, pvwa_url):
     if rest_response.status_code != requests.codes.ok:
         if rest_response.status_code == requests.codes.not_found:
             logger.error(f"Failed to delete the account for {instance_id} from the vault. The account does not exists")
+            remove_indexed_account(account_id)
             raise Exception(f"Failed to delete the account for {instance_id} from the vault. The account does not exists")
         logger.error(f"Failed to delete the account for {instance_id} from the vault. an error occurred")
         raise Exception(f"Unknown status code received {rest_response.status_code}")
 
     logger.info(f"The account for {instance_id} was successfully deleted")
+    remove_indexed_account(account_id)
     return True
 
 
 def check_if_kp_exists(session, account_name, safe_name, instance_id, rest_url):
     logger.trace(session, account_name, safe_name, instance_id, rest_url, caller_name='check_if_kp_exists')
     logger.info('Checking if key pair is onboarded')
-    header = DEFAULT_HEADER
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session})
     # 2 options of search - if safe name not empty, add it to query, if not - search without it
 
@@ -116,10 +160,93 @@ def check_if_kp_exists(session, account_name, safe_name, instance_id, rest_url):
     raise Exception(f"Status code {rest_response.status_code}, received from REST service")
 
 
+# Returns the (account id, value) of the key pair account, served from the key pair cache when it is enabled
+def get_key_pair(session, account_name, safe_name, instance_id, rest_url):
+    logger.trace(session, account_name, safe_name, instance_id, rest_url, caller_name='get_key_pair')
+    cache_ttl = get_key_pair_cache_ttl()
+    if not cache_ttl:
+        return retrieve_key_pair(session, account_name, safe_name, instance_id, rest_url)
+    # Concurrent records of the same key pair wait for a single retrieval, the lock is dropped once no record uses it
+    with key_pair_cache_lock:
+        fill_lock = key_pair_cache['fill_locks'].setdefault(account_name, {'lock': threading.Lock(), 'users': 0})
+        fill_lock['users'] += 1
+    try:
+        with fill_lock['lock']:
+            return get_cached_key_pair(session, account_name, safe_name, instance_id, rest_url, cache_ttl)
+    finally:
+        with key_pair_cache_lock:
+            fill_lock['users'] -= 1
+            if not fill_lock['users']:
+                del key_pair_cache['fill_locks'][account_name]
+
+
+# Entries live until their TTL, they are dropped earlier when an onboarding fails or the Parameter Store changes
+def get_cached_key_pair(session, account_name, safe_name, instance_id, rest_url, cache_ttl):
+    with key_pair_cache_lock:
+        cached_key_pair = key_pair_cache['key_pairs'].get(account_name)
+        fernet = key_pair_cache['fernet']
+    if cached_key_pair and time.time() < cached_key_pair['expiration']:
+        logger.info(f'Key pair {account_name} served from cache', DEBUG_LEVEL_DEBUG)
+        return cached_key_pair['account_id'], fernet.decrypt(cached_key_pair['value']).decode()
+    account_id, key_pair_value = retrieve_key_pair(session, account_name, safe_name, instance_id, rest_url)
+    if not account_id or key_pair_value is False:
+        invalidate_key_pair_cache(account_name)
+        return account_id, key_pair_value
+    if cached_key_pair and cached_key_pair['account_id'] != account_id:
+        logger.info(f'Key pair account {account_name} changed from {cached_key_pair["account_id"]} to {account_id}')
+    with key_pair_cache_lock:
+        if not key_pair_cache['fernet']:
+            key_pair_cache['fernet'] = Fernet(Fernet.generate_key())
+        key_pair_cache['key_pairs'][account_name] = {
+            'account_id': account_id,
+            'value': key_pair_cache['fernet'].encrypt(key_pair_value.encode()),
+            'expiration': time.time() + cache_ttl
+        }
+    # One vault retrieval per cache fill, the instances served from the cache are not audited by the vault
+    logger.info(f'Key pair {account_name} retrieved from the vault for {instance_id}, cached for {cache_ttl} seconds')
+    return account_id, key_pair_value
+
+
+def retrieve_key_pair(session, account_name, safe_name, instance_id, rest_url):
+    account_id = check_if_kp_exists(session, account_name, safe_name, instance_id, rest_url)
+    if not account_id:
+        return False, False
+    return account_id, get_account_value(session, account_id, instance_id, rest_url)
+
+
+# Drops the cached key pair, or all of them when no account name is given
+def invalidate_key_pair_cache(account_name=None):
+    with key_pair_cache_lock:
+        if account_name:
+            key_pair_cache['key_pairs'].pop(account_name, None)
+        else:
+            key_pair_cache['key_pairs'].clear()
+
+
+def get_key_pair_cache_ttl():
+    try:
+        return min(max(int(os.environ.get('AOB_KEY_PAIR_CACHE_TTL', DEFAULT_KEY_PAIR_CACHE_TTL)), 0), MAX_KEY_PAIR_CACHE_TTL)
+    except ValueError:
+        return DEFAULT_KEY_PAIR_CACHE_TTL
+
+
 def retrieve_account_id_from_account_name(session, account_name, safe_name, instance_id, rest_url):
     logger.trace(session, account_name, safe_name, instance_id, rest_url, caller_name='retrieve_account_id_from_account_name')
     logger.info('Retrieving account_id from account_name')
-    header = DEFAULT_HEADER
+    if safe_name and get_accounts_index_ttl():
+        account_id = get_indexed_account_id(session, account_name, safe_name, instance_id, rest_url)
+        if account_id:
+            return account_id
+    account_id = search_account_id(session, account_name, safe_name, instance_id, rest_url)
+    if account_id and safe_name and get_accounts_index_ttl():
+        address, username = get_account_name_parts(account_name)
+        add_indexed_account(safe_name, address, username, account_id, f'AWS.{instance_id}')
+    return account_id
+
+
+# Searches the vault, following the result pages until the account of the instance is found
+def search_account_id(session, account_name, safe_name, instance_id, rest_url):
+    header = dict(DEFAULT_HEADER)
     header.update({"Authorization": session})
     # 2 options of search - if safe name not empty, add it to query, if not - search without it
 
@@ -127,22 +254,184 @@ def retrieve_account_id_from_account_name(session, account_name, safe_name, inst
         pvwa_url = f"{rest_url}/api/accounts?search={account_name}&filter=safeName eq {safe_name}"
     else:  # has no value
         pvwa_url = f"{rest_url}/api/accounts?search={account_name}"
+    while pvwa_url:
+        try:
+            rest_response = pvwa_integration_class.call_rest_api_get(pvwa_url, header)
+            if not rest_response:
+                raise Exception("Unknown Error when calling rest service - retrieve account_id")
+        except Exception as e:
+            logger.error(f'An error occurred:\n{str(e)}')
+            raise Exception(e)
+        if rest_response.status_code != requests.codes.ok:
+            logger.error(f"Status code {rest_response.status_code}, received from REST service")
+            raise Exception(f"Status code {rest_response.status_code}, received from REST service")
+        # if response received, check account is not empty {"Count": 0,"accounts": []}
+        parsed_json_response = rest_response.json()
+        if 'value' in parsed_json_response and parsed_json_response["value"]:
+            account_id = filter_get_accounts_result(parsed_json_response['value'], instance_id)
+            if account_id:
+                return account_id
+        pvwa_url = get_next_page_url(parsed_json_response, rest_url)
+    logger.info(f'No match for account: {account_name}')
+    return False
+
+
+# Returns the account id from the index of the safe, refreshing the index when it is due
+def get_indexed_account_id(session, account_name, safe_name, instance_id, rest_url):
+    address, username = get_account_name_parts(account_name)
     try:
-        rest_response = pvwa_integration_class.call_rest_api_get(pvwa_url, header)
-        if not rest_response:
-            raise Exception("Unknown Error when calling rest service - retrieve account_id")
+        generation = refresh_accounts_index(session, safe_name, rest_url)
+        if generation is None:  # Not built yet, the lambda building it lists the safe
+            return False
+        indexed_accounts = aws_services.get_indexed_accounts(safe_name, address, username, generation)
     except Exception as e:
-        logger.error(f'An error occurred:\n{str(e)}')
-        raise Exception(e)
-    if rest_response.status_code == requests.codes.ok:
-        # if response received, check account is not empty {"Count": 0,"accounts": []}
-        if 'value' in rest_response.json() and rest_response.json()["value"]:
-            parsed_json_response = rest_response.json()['value']
-            return filter_get_accounts_result(parsed_json_response, instance_id)
-        logger.info(f'No match for account: {account_name}')
+        logger.error(f'Failed to read the accounts index of {safe_name}, searching the vault instead: {str(e)}')
         return False
-    logger.error(f"Status code {rest_response.status_code}, received from REST service")
-    raise Exception(f"Status code {rest_response.status_code}, received from REST service")
+    account_id = filter_get_accounts_result(indexed_accounts, instance_id)
+    logger.info(f'Accounts index of {safe_name} {"hit" if account_id else "miss"} for {account_name}', DEBUG_LEVEL_DEBUG)
+    return account_id
+
+
+# Builds the index of the safe when it is missing or expired, otherwise adds the accounts modified since the last refresh.
+# A single lambda at a time updates a safe index, the others keep reading its current generation meanwhile.
+# Returns the generation of the index to read, None when the index was never built
+def refresh_accounts_index(session, safe_name, rest_url):
+    state = get_accounts_index_state(safe_name)
+    generation = int(state['Generation']) if 'Generation' in state else None
+    refresh_time = time.time()
+    if refresh_time - float(state.get('BuiltTime', 0)) > min(get_accounts_index_ttl(), ACCOUNTS_INDEX_REBUILD_INTERVAL):
+        claim_owner = aws_services.claim_accounts_index_update(safe_name, state, ACCOUNTS_INDEX_CLAIM_TIME)
+        if claim_owner:
+            generation = build_accounts_index(session, safe_name, rest_url, state, claim_owner, refresh_time)
+    elif state.get('Incremental', True) and refresh_time - float(state['RefreshedTime']) > ACCOUNTS_INDEX_REFRESH_INTERVAL:
+        claim_owner = aws_services.claim_accounts_index_update(safe_name, state, ACCOUNTS_INDEX_CLAIM_TIME)
+        if claim_owner:
+            update_accounts_index(session, safe_name, rest_url, state, claim_owner, refresh_time)
+    return generation
+
+
+# Lists the whole safe into a new generation, the accounts of the previous generations are removed by DynamoDB TTL
+def build_accounts_index(session, safe_name, rest_url, state, claim_owner, build_time):
+    logger.info(f'Building the accounts index of {safe_name}')
+    generation = int(state.get('Generation', 0)) + 1
+    try:
+        accounts = get_safe_accounts(session, f'safeName eq {safe_name}', rest_url)
+        aws_services.put_indexed_accounts(safe_name, accounts, generation, get_indexed_account_expiration())
+    except Exception:
+        aws_services.complete_accounts_index_update(safe_name, claim_owner, {})
+        raise
+    remember_accounts_index_state(safe_name, aws_services.complete_accounts_index_update(
+        safe_name, claim_owner, {'Generation': generation, 'BuiltTime': int(build_time), 'RefreshedTime': int(build_time),
+                                 'Incremental': True}))
+    logger.info(f'{len(accounts)} account(s) indexed in {safe_name}')
+    return generation
+
+
+def update_accounts_index(session, safe_name, rest_url, state, claim_owner, refresh_time):
+    modification_time = int(float(state['RefreshedTime']) - ACCOUNTS_INDEX_REFRESH_MARGIN)
+    try:
+        accounts = get_safe_accounts(session, f'safeName eq {safe_name} and modificationTime gte {modification_time}',
+                                     rest_url)
+    except Exception as e:
+        # Vaults not supporting the modificationTime filter rebuild the index when it expires
+        logger.info(f'Incremental refresh of the accounts index is not available: {str(e)}')
+        remember_accounts_index_state(safe_name, aws_services.complete_accounts_index_update(safe_name, claim_owner,
+                                                                                             {'Incremental': False}))
+        return
+    try:
+        aws_services.put_indexed_accounts(safe_name, accounts, int(state['Generation']), get_indexed_account_expiration())
+    except Exception:
+        aws_services.complete_accounts_index_update(safe_name, claim_owner, {})
+        raise
+    remember_accounts_index_state(safe_name, aws_services.complete_accounts_index_update(
+        safe_name, claim_owner, {'RefreshedTime': int(refresh_time)}))
+
+
+# Returns the state of the safe index, read again from the AccountsIndex table every few seconds
+def get_accounts_index_state(safe_name):
+    with accounts_index_lock:
+        cached_state = accounts_index.get(safe_name)
+    if cached_state and time.time() - cached_state['read'] < ACCOUNTS_INDEX_STATE_CHECK_INTERVAL:
+        return cached_state['state']
+    state = aws_services.get_accounts_index_state(safe_name)
+    with accounts_index_lock:
+        accounts_index[safe_name] = {'state': state, 'read': time.time()}
+    return state
+
+
+# Caches the state saved by this lambda, a lost claim makes the next lookup read the state again.
+# The safe stays known so its deleted accounts are still removed from the index
+def remember_accounts_index_state(safe_name, state):
+    with accounts_index_lock:
+        if state:
+            accounts_index[safe_name] = {'state': state, 'read': time.time()}
+        elif safe_name in accounts_index:
+            accounts_index[safe_name]['read'] = 0
+
+
+# Indexed accounts outlive the rebuild interval, so the index of a safe is never read after its accounts expired
+def get_indexed_account_expiration():
+    return int(time.time()) + 2 * ACCOUNTS_INDEX_REBUILD_INTERVAL
+
+
+# Returns all the accounts matching the filter, page by page
+def get_safe_accounts(session, accounts_filter, rest_url):
+    header = dict(DEFAULT_HEADER)
+    header.update({"Authorization": session})
+    pvwa_url = f"{rest_url}/api/accounts?filter={accounts_filter}&limit={ACCOUNTS_PAGE_SIZE}"
+    accounts = []
+    while pvwa_url:
+        rest_response = pvwa_integration_class.call_rest_api_get(pvwa_url, header)
+        if rest_response is None or rest_response.status_code != requests.codes.ok:
+            raise Exception(f"Failed to list the accounts, REST response: {rest_response}")
+        parsed_json_response = rest_response.json()
+        accounts.extend(parsed_json_response.get('value', []))
+        pvwa_url = get_next_page_url(parsed_json_response, rest_url)
+    return accounts
+
+
+def get_next_page_url(parsed_json_response, rest_url):
+    if parsed_json_response.get('nextLink'):
+        return f"{rest_url}/{parsed_json_response['nextLink']}"
+    return None
+
+
+# Adds an account found by a search or just created to the current generation of the safe index
+def add_indexed_account(safe_name, address, username, account_id, name):
+    with accounts_index_lock:
+        state = accounts_index.get(safe_name, {}).get('state', {})
+    if 'Generation' not in state:
+        return
+    try:
+        aws_services.put_indexed_accounts(safe_name, [{'id': account_id, 'name': name, 'address': address,
+                                                       'userName': username}],
+                                          int(state['Generation']), get_indexed_account_expiration())
+    except Exception as e:
+        logger.error(f'Failed to add {account_id} to the accounts index of {safe_name}: {str(e)}')
+
+
+# Drops the deleted account from the indexes, also called when the vault returns 404 for an indexed id
+def remove_indexed_account(account_id):
+    with accounts_index_lock:
+        safe_names = list(accounts_index)
+    for safe_name in safe_names:
+        try:
+            aws_services.delete_indexed_account(safe_name, account_id)
+        except Exception as e:
+            logger.error(f'Failed to remove {account_id} from the accounts index of {safe_name}: {str(e)}')
+
+
+# Splits the 'address,username' search pattern of the instance account
+def get_account_name_parts(account_name):
+    address, _, username = account_name.partition(',')
+    return address, username
+
+
+def get_accounts_index_ttl():
+    try:
+        return max(int(os.environ.get('AOB_ACCOUNTS_INDEX_TTL', DEFAULT_ACCOUNTS_INDEX_TTL)), 0)
+    except ValueError:
+        return DEFAULT_ACCOUNTS_INDEX_TTL
 
 
 def filter_get_accounts_result(parsed_json_response, instance_id):
@@ -1,100 +1,155 @@
+import base64
+import os
+import ssl
+import threading
+import time
+from types import MappingProxyType
 import requests
+from requests.adapters import HTTPAdapter
 import aws_services
+import circuit_breaker
+import retry_mechanism
 from log_mechanism import LogMechanism
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
-DEFAULT_HEADER = {"content-type": "application/json"}
+DEFAULT_HEADER = MappingProxyType({"content-type": "application/json"})  # Read only, calls copy it before adding their token
+DEFAULT_SESSION_TTL = 900  # Seconds of inactivity before a pooled session is considered expired
+DEFAULT_HTTP_POOL_SIZE = 10  # Keep-alive connections to the PVWA per container
+# HTTP sessions shared by all PvwaIntegration objects, keyed by the certificate used to verify the PVWA
+http_sessions = {}
+http_sessions_lock = threading.Lock()
 # RestApiCalls:
 
 
 class PvwaIntegration:
+    # PVWA sessions kept alive across warm invocations, keyed by connection number
+    session_pool = {}
+    # Latest token replaced by a new logon, keyed by connection number so the dict is bounded by the connections
+    replaced_tokens = {}
+    session_pool_lock = threading.RLock()
+
+    # Parameters are only retrieved on the first request, objects can be created at import time without AWS calls
     def __init__(self, is_safe_handler=False, safe_handler_environment=None):
         self.logger = LogMechanism()
-        self.logger.trace(is_safe_handler, safe_handler_environment, caller_name='__init__')
         self.is_safe_handler = is_safe_handler
         self.safe_handler_environment = safe_handler_environment
-        try:
-            self.logger.info('Getting parameters from parameter store')
-            if not is_safe_handler:
-                parameters = aws_services.get_params_from_param_store()
-                environment = parameters.aob_mode
-            else:
-                environment = self.safe_handler_environment
-            if environment == 'Production':
-                self.logger.info(f'{environment} Environment Detected', DEBUG_LEVEL_DEBUG)
-                self.certificate = "/tmp/server.crt"
-            else:
-                self.certificate = False
-                self.logger.info(f'{environment} Environment Detected', DEBUG_LEVEL_DEBUG)
-        except Exception as e:
-            self.logger.error(f'Failed to retrieve aob_mode parameter: {str(e)}')
-            raise Exception("Error occurred while retrieving aob_mode parameter")
+        self.certificate = None
+        if is_safe_handler:
+            self.logger.trace(is_safe_handler, safe_handler_environment, caller_name='__init__')
+            self.certificate = self.get_certificate()
 
 
-    def call_rest_api_get(self, url, header):
+    def call_rest_api_get(self, url, header, retry_policy=retry_mechanism.PVWA_RETRY_POLICY):
         self.logger.trace(url, header, caller_name='call_rest_api_get')
-        self.url = url
-        self.header = header
         try:
             self.logger.info(f'Invoking get request url:{url}, header: {header}', DEBUG_LEVEL_DEBUG)
-            rest_response = requests.get(self.url, timeout=30, verify=self.certificate, headers=self.header)
+            header = self.get_current_header(header)
+            rest_response = retry_policy.call(self.get_http_session().get, url, timeout=30, headers=header)
+            if rest_response.status_code == requests.codes.unauthorized:
+                header = self.refresh_session_header(header)
+                if header:
+                    rest_response = retry_policy.call(self.get_http_session().get, url, timeout=30, headers=header)
         except Exception as e:
             self.logger.error(f"An error occurred on calling PVWA REST service: {str(e)}")
+            self.record_outcome(None, e)
             return None
+        self.record_outcome(rest_response)
         return rest_response
 
 
-    def call_rest_api_delete(self, url, header):
+    def call_rest_api_delete(self, url, header, retry_policy=retry_mechanism.PVWA_RETRY_POLICY):
         self.logger.trace(url, header, caller_name='call_rest_api_delete')
-        self.url = url
-        self.header = header
         try:
             self.logger.info(f'Invoking delete request url {url}, header: {header}', DEBUG_LEVEL_DEBUG)
-            response = requests.delete(self.url, timeout=30, verify=self.certificate, headers=self.header)
+            header = self.get_current_header(header)
+            response = retry_policy.call(self.get_http_session().delete, url, timeout=30, headers=header)
+            if response.status_code == requests.codes.unauthorized:
+                header = self.refresh_session_header(header)
+                if header:
+                    response = retry_policy.call(self.get_http_session().delete, url, timeout=30, headers=header)
         except Exception as e:
             self.logger.error(f'Failed to Invoke delete request: {str(e)}')
+            self.record_outcome(None, e)
             return None
+        self.record_outcome(response)
         return response
 
 
-    def call_rest_api_post(self, url, request, header):
+    # Requests are sent again on throttling and server errors, posts only when the vault did not process them
+    def call_rest_api_post(self, url, request, header, retry_policy=retry_mechanism.PVWA_UNPROCESSED_RETRY_POLICY):
         self.logger.trace(url, header, caller_name='call_rest_api_post')
-        self.url = url
-        self.request = request
-        self.header = header
         try:
             self.logger.info(f'Invoking post request url: {url} , header: {header}', DEBUG_LEVEL_DEBUG)
-            rest_response = requests.post(self.url, data=self.request, timeout=30, verify=self.certificate, headers=self.header,
-                                          stream=True)
+            header = self.get_current_header(header)
+            rest_response = retry_policy.call(self.get_http_session().post, url, data=request, timeout=30, headers=header)
+            if rest_response.status_code == requests.codes.unauthorized:
+                header = self.refresh_session_header(header)
+                if header:
+                    rest_response = retry_policy.call(self.get_http_session().post, url, data=request, timeout=30, headers=header)
         except Exception as e:
             self.logger.error(f"Error occurred during POST request to PVWA: {str(e)}")
+            self.record_outcome(None, e)
             return None
+        self.record_outcome(rest_response)
         return rest_response
 
 
+    # Unreachable PVWA and server errors open the circuit shared by the lambdas, the safe handler runs before the
+    # Sessions table holding the circuit is created
+    def record_outcome(self, response, error=None):
+        if self.is_safe_handler:
+            return
+        if response is not None and response.status_code < 500:
+            circuit_breaker.record_pvwa_success()
+        elif response is not None or isinstance(error, requests.exceptions.RequestException):
+            circuit_breaker.record_pvwa_failure()
+
+
+    # Returns the shared keep-alive session matching the current PVWA verification key
+    def get_http_session(self):
+        if not self.is_safe_handler:
+            # Parameters are cached, a changed verification key is picked up once the cache is refreshed
+            self.certificate = self.get_certificate()
+        return get_http_session(self.certificate)
+
+
+    # Returns the certificate used to verify the PVWA, or False when not running in Production
+    def get_certificate(self):
+        try:
+            if not self.is_safe_handler:
+                parameters = aws_services.get_params_from_param_store()
+                environment = parameters.aob_mode
+            else:
+                environment = self.safe_handler_environment
+            if environment == 'Production':
+                # The safe handler downloads the verification key file, the other lambdas get it from parameter store
+                return "/tmp/server.crt" if self.is_safe_handler else parameters.pvwa_verification_key
+            return False
+        except Exception as e:
+            self.logger.error(f'Failed to retrieve aob_mode parameter: {str(e)}')
+            raise Exception("Error occurred while retrieving aob_mode parameter")
+
+
     # PvwaIntegration:
     # performs logon to PVWA and return the session token
     def logon_pvwa(self, username, password, pvwa_url, connection_session_id):
         self.logger.trace(pvwa_url, connection_session_id, caller_name='logon_pvwa')
-        self.username = username
-        self.password = password
-        self.pvwa_url = pvwa_url
-        self.connection_session_id = connection_session_id
         self.logger.info('Logging to PVWA')
-        logon_url = f'{self.pvwa_url}/WebServices/auth/Cyberark/CyberArkAuthenticationService.svc/Logon'
+        logon_url = f'{pvwa_url}/WebServices/auth/Cyberark/CyberArkAuthenticationService.svc/Logon'
         rest_log_on_data = f"""
                             {{
-                                "username": "{self.username}",
-                                "password": "{self.password}",
-                                "connectionNumber": "{self.connection_session_id}"
+                                "username": "{username}",
+                                "password": "{password}",
+                                "connectionNumber": "{connection_session_id}"
                             }}
                             """
         try:
-            rest_response = self.call_rest_api_post(logon_url, rest_log_on_data, DEFAULT_HEADER)
+            rest_response = self.call_rest_api_post(logon_url, rest_log_on_data, DEFAULT_HEADER,
+                                                    retry_mechanism.PVWA_RETRY_POLICY)
         except Exception as e:
             raise Exception(f"Error occurred on Logon to PVWA: {str(e)}")
 
-        if not rest_response:
+        if rest_response is None:
             self.logger.error("Connection to PVWA reached timeout")
             raise Exception("Connection to PVWA reached timeout")
         if rest_response.status_code == requests.codes.ok:
@@ -102,17 +157,23 @@ class PvwaIntegration:
             self.logger.info("User authenticated")
             return json_parsed_response['CyberArkLogonResult']
         self.logger.error(f"Authentication failed with response:\n{rest_response}")
+        if rest_response.status_code in (requests.codes.unauthorized, requests.codes.forbidden):
+            # The vault password may have been changed since the parameters were cached
+            aws_services.invalidate_params_cache()
         raise Exception("PVWA authentication failed")
 
 
     def logoff_pvwa(self, pvwa_url, connection_session_token):
         self.logger.trace(pvwa_url, connection_session_token, caller_name='logoff_pvwa')
-        self.pvwa_url = pvwa_url
-        self.connection_session_token = connection_session_token
         self.logger.info('Logging off from PVWA')
-        header = DEFAULT_HEADER
-        header.update({"Authorization": self.connection_session_token})
-        log_off_url = f'{self.pvwa_url}/WebServices/auth/Cyberark/CyberArkAuthenticationService.svc/Logoff'
+        with self.session_pool_lock:
+            for connection_session_id, pooled_session in list(self.session_pool.items()):
+                if pooled_session['token'] == connection_session_token:
+                    del self.session_pool[connection_session_id]
+                    self.replaced_tokens.pop(connection_session_id, None)
+        header = dict(DEFAULT_HEADER)
+        header.update({"Authorization": connection_session_token})
+        log_off_url = f'{pvwa_url}/WebServices/auth/Cyberark/CyberArkAuthenticationService.svc/Logoff'
         rest_log_off_data = ""
         try:
             rest_response = self.call_rest_api_post(log_off_url, rest_log_off_data, header)
@@ -125,3 +186,138 @@ class PvwaIntegration:
             return True
         self.logger.error("Logoff failed")
         return False
+
+
+    # Returns a pooled session token for the connection number, logging on only when there is no valid one
+    def get_session(self, username, password, pvwa_url, connection_session_id):
+        self.logger.trace(pvwa_url, connection_session_id, caller_name='get_session')
+        with self.session_pool_lock:
+            pooled_session = self.session_pool.get(connection_session_id)
+            if pooled_session and pooled_session['pvwa_url'] == pvwa_url and pooled_session['username'] == username \
+                    and pooled_session['password'] == password and time.time() < pooled_session['expiration']:
+                self.logger.info(f'Reusing PVWA session of connection {connection_session_id}')
+                pooled_session['expiration'] = time.time() + get_session_ttl()
+                return pooled_session['token']
+        session_token = self.logon_pvwa(username, password, pvwa_url, connection_session_id)
+        with self.session_pool_lock:
+            if pooled_session:
+                self.replaced_tokens[connection_session_id] = pooled_session['token']
+            self.session_pool[connection_session_id] = {'token': session_token, 'pvwa_url': pvwa_url, 'username': username,
+                                                        'password': password, 'expiration': time.time() + get_session_ttl()}
+        return session_token
+
+
+    # Connection numbers with a valid pooled session, preferred when acquiring a connection
+    def get_pooled_connections(self):
+        with self.session_pool_lock:
+            return [connection_session_id for connection_session_id, pooled_session in self.session_pool.items()
+                    if time.time() < pooled_session['expiration']]
+
+
+    def invalidate_session(self, connection_session_id):
+        self.logger.trace(connection_session_id, caller_name='invalidate_session')
+        with self.session_pool_lock:
+            self.session_pool.pop(connection_session_id, None)
+
+
+    # Replaces a token that was refreshed earlier in the pipeline with the current one of its connection
+    def get_current_header(self, header):
+        with self.session_pool_lock:
+            for connection_session_id, replaced_token in self.replaced_tokens.items():
+                if replaced_token == header.get("Authorization") and connection_session_id in self.session_pool:
+                    header = dict(header)
+                    header["Authorization"] = self.session_pool[connection_session_id]['token']
+                    break
+        return header
+
+
+    # Logs on again when PVWA rejected a pooled token, returns the header to retry with or None
+    def refresh_session_header(self, header):
+        session_token = header.get("Authorization")
+        with self.session_pool_lock:
+            for connection_session_id, pooled_session in self.session_pool.items():
+                if pooled_session['token'] == session_token:
+                    break
+            else:
+                return None
+        self.logger.info(f'PVWA session of connection {connection_session_id} expired, logging on again')
+        self.invalidate_session(connection_session_id)
+        try:
+            new_session_token = self.get_session(pooled_session['username'], pooled_session['password'],
+                                                 pooled_session['pvwa_url'], connection_session_id)
+        except Exception as e:
+            self.logger.error(f'Failed to refresh PVWA session: {str(e)}')
+            return None
+        with self.session_pool_lock:
+            self.replaced_tokens[connection_session_id] = session_token
+        header = dict(header)
+        header["Authorization"] = new_session_token
+        return header
+
+
+def get_session_ttl():
+    try:
+        return int(os.environ.get('AOB_PVWA_SESSION_TTL', DEFAULT_SESSION_TTL))
+    except ValueError:
+        return DEFAULT_SESSION_TTL
+
+
+# certificate is False (no verification), a path to a certificate file or the verification key itself
+def get_http_session(certificate):
+    with http_sessions_lock:
+        if certificate in http_sessions:
+            return http_sessions[certificate]
+        ssl_context = get_ssl_context(certificate) if certificate else None
+        adapter = PvwaHttpAdapter(verify=certificate if not ssl_context else True, ssl_context=ssl_context,
+                                  pool_connections=1, pool_maxsize=get_http_pool_size(),
+                                  max_retries=0)  # Failed connections are retried by the retry policy of the call
+        http_session = requests.Session()
+        http_session.mount('https://', adapter)
+        http_sessions[certificate] = http_session
+        return http_session
+
+
+# Returns the SSL context verifying the PVWA with the verification key, None for a certificate file.
+# The key is either a PEM certificate or its base64 body without the BEGIN and END lines
+def get_ssl_context(certificate):
+    if '-----BEGIN' in certificate:
+        return ssl.create_default_context(cadata=certificate)
+    if certificate.startswith('/'):
+        return None
+    try:
+        der_certificate = base64.b64decode(''.join(certificate.split()), validate=True)
+        if not der_certificate:
+            raise ValueError('empty verification key')
+        return ssl.create_default_context(cadata=der_certificate)
+    except (ValueError, ssl.SSLError) as e:
+        raise Exception(f'The PVWA verification key is neither a PEM nor a base64 encoded certificate: {str(e)}')
+
+
+def get_http_pool_size():
+    try:
+        return max(int(os.environ.get('AOB_PVWA_POOL_SIZE', DEFAULT_HTTP_POOL_SIZE)), 1)
+    except ValueError:
+        return DEFAULT_HTTP_POOL_SIZE
+
+
+# HTTPS adapter verifying the PVWA with an SSL context built once from the verification key
+class PvwaHttpAdapter(HTTPAdapter):
+    def __init__(self, verify=True, ssl_context=None, **kwargs):
+        self.verify = verify
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):  # Verification must not be overridden by environment CA bundles
+        kwargs['verify'] = self.verify
+        return super().send(request, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context:
+            kwargs['ssl_context'] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if self.ssl_context:  # Trust only the verification key, not the default CA bundle
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+import requests
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+from log_mechanism import LogMechanism
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+UNPROCESSED_STATUS_CODES = (429, 503)  # The request was not processed, non idempotent requests can be sent again
+RETRYABLE_AWS_ERROR_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                             'RequestThrottledException', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+                             'ServiceUnavailable', 'InternalError', 'InternalFailure', 'InternalServerError')
+RESERVED_LAMBDA_TIME = 10  # Seconds left to the lambda for recording the outcome once the retries are given up
+PVWA_LOCK_MARGIN = 5  # Seconds left on the PVWA connection lock for the retried request to be answered
+logger = LogMechanism()
+# Epoch time at which the running lambda invocation times out, None when not running in a lambda
+lambda_deadline = {'value': None}
+# Epoch time at which the Sessions lock on the PVWA connection of the thread expires, the events of a lambda
+# run concurrently on different connections
+pvwa_lock_deadline = threading.local()
+
+
+# Retries stop early when the remaining time of the invocation would not be enough to wait and record the outcome
+def set_lambda_deadline(context):
+    try:
+        lambda_deadline['value'] = time.time() + context.get_remaining_time_in_millis() / 1000
+    except (AttributeError, TypeError):
+        lambda_deadline['value'] = None
+
+
+def get_remaining_lambda_time():
+    if lambda_deadline['value'] is None:
+        return None
+    return lambda_deadline['value'] - time.time() - RESERVED_LAMBDA_TIME
+
+
+# PVWA retries stop before the connection lock expires, another lambda could take the connection meanwhile
+def set_pvwa_lock_deadline(deadline):
+    pvwa_lock_deadline.value = deadline
+
+
+def get_remaining_pvwa_lock_time():
+    deadline = getattr(pvwa_lock_deadline, 'value', None)
+    if deadline is None:
+        return None
+    return deadline - time.time() - PVWA_LOCK_MARGIN
+
+
+# Exponential backoff with full jitter, limited by attempts and by a time budget per operation
+class RetryPolicy:
+    def __init__(self, name, max_attempts, budget, base_delay=0.5, max_delay=8, retry_status_codes=RETRYABLE_STATUS_CODES,
+                 retry_unsent_only=False, connection_locked=False):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_status_codes = retry_status_codes
+        self.retry_unsent_only = retry_unsent_only  # Non idempotent requests are sent again only when they were not sent
+        self.connection_locked = connection_locked  # Requests sent on a PVWA connection locked in the Sessions table
+
+
+    # Returns the result of the first attempt that is not retryable, raises the error of the last attempt
+    def call(self, function, *args, **kwargs):
+        start_time = time.time()
+        attempt = 1
+        while True:
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable_error(e) or not self.wait(attempt, start_time, str(e)):
+                    raise
+            else:
+                status_code = getattr(result, 'status_code', None)
+                if status_code not in self.retry_status_codes or \
+                        not self.wait(attempt, start_time, f'status code {status_code}', get_retry_after(result)):
+                    return result
+            attempt += 1
+
+
+    # Sleeps before the next attempt, returns False when the attempts, the budget, the lambda time
+    # or the connection lock time are exhausted
+    def wait(self, attempt, start_time, reason, retry_after=None):
+        if attempt >= self.max_attempts:
+            logger.error(f'{self.name} failed after {attempt} attempt(s): {reason}')
+            return False
+        delay = retry_after if retry_after is not None else \
+            random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        remaining_times = [get_remaining_lambda_time(), get_remaining_pvwa_lock_time() if self.connection_locked else None]
+        if time.time() - start_time + delay > self.budget or \
+                any(remaining_time is not None and delay > remaining_time for remaining_time in remaining_times):
+            logger.error(f'{self.name} failed, no time left to retry: {reason}')
+            return False
+        logger.info(f'{self.name} failed ({reason}), attempt {attempt} out of {self.max_attempts}, '
+                    f'retrying in {delay:.1f} seconds')
+        time.sleep(delay)
+        return True
+
+
+    def is_retryable_error(self, error):
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return not self.retry_unsent_only
+        if isinstance(error, (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError)):
+            return True
+        if isinstance(error, ClientError):
+            return error.response.get('Error', {}).get('Code') in RETRYABLE_AWS_ERROR_CODES or \
+                error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+        return False
+
+
+# Seconds requested by the server before the next attempt, None when not specified
+def get_retry_after(response):
+    try:
+        return max(float(response.headers['Retry-After']), 0)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+# PVWA requests that can be sent again safely, the vault keeps a single result for repeated requests
+PVWA_RETRY_POLICY = RetryPolicy('PVWA request', max_attempts=4, budget=30, connection_locked=True)
+# PVWA requests creating or changing data, sent again only when the vault did not process them
+PVWA_UNPROCESSED_RETRY_POLICY = RetryPolicy('PVWA request', max_attempts=4, budget=30,
+                                            retry_status_codes=UNPROCESSED_STATUS_CODES, retry_unsent_only=True,
+                                            connection_locked=True)
+AWS_RETRY_POLICY = RetryPolicy('AWS request', max_attempts=5, budget=20, base_delay=0.2)
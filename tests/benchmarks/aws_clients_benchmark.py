@@ -0,0 +1,50 @@
+# Compares the boto3 objects construction cost of one event with and without the shared clients registry
+# No AWS call is made, only clients and resources are created
+import argparse
+import os
+import sys
+import time
+import boto3
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/shared_libraries'))
+import aws_clients
+from dynamo_lock import LockerClient
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--events", type=int, default=20, help="number of simulated events")
+parser.add_argument("--region", default="eu-west-2", help="region of the created clients")
+args = parser.parse_args()
+os.environ.setdefault('AWS_DEFAULT_REGION', args.region)
+
+
+# boto3 objects an onboarding event created before the registry
+def event_without_registry():
+    boto3.client('ssm')
+    boto3.client('lambda')
+    boto3.client('dynamodb')
+    boto3.resource('dynamodb')
+    boto3.resource('ec2', region_name=args.region)
+    LockerClient('Sessions')
+
+
+def event_with_registry():
+    aws_clients.get_client('ssm')
+    aws_clients.get_client('lambda')
+    aws_clients.get_client('dynamodb')
+    aws_clients.get_resource('dynamodb')
+    aws_clients.get_resource('ec2', region_name=args.region)
+    aws_clients.get_client('dynamodb')  # SessionsLockClient
+
+
+def measure(event_function):
+    start_time = time.perf_counter()
+    for _ in range(args.events):
+        event_function()
+    return (time.perf_counter() - start_time) * 1000 / args.events
+
+
+event_without_registry()  # botocore loads and caches the service models on first use
+without_registry = measure(event_without_registry)
+with_registry = measure(event_with_registry)
+print(f"Without registry: {without_registry:.2f} ms per event")
+print(f"With registry: {with_registry:.2f} ms per event")
+print(f"Saved: {without_registry - with_registry:.2f} ms per event")
@@ -0,0 +1,75 @@
+# Measures the cold start import time of the lambda against the import of its third party dependencies alone,
+# measured in the same run. Fails when the lambda import exceeds its dependencies by more than --max-ratio, a ratio
+# stays comparable across build agents. Every AWS API call made while importing is blocked and counted, importing must
+# not make any
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src')
+# Runs in a fresh interpreter so nothing is already imported
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+start_time = time.perf_counter()
+import botocore.client
+api_calls = []
+
+
+def blocked_api_call(self, operation_name, api_params):
+    api_calls.append(f'{self.meta.service_model.service_name}.{operation_name}')
+    raise Exception('AWS API call made at import time')
+
+
+botocore.client.BaseClient._make_api_call = blocked_api_call
+sys.path[:0] = sys.argv[2:]
+try:
+    for module_name in sys.argv[1].split(','):
+        __import__(module_name)
+except Exception:
+    pass  # The blocked call is reported below
+print(json.dumps({'duration': (time.perf_counter() - start_time) * 1000, 'api_calls': api_calls}))
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--runs", type=int, default=5, help="number of cold imports")
+parser.add_argument("--region", default="eu-west-2", help="region of the created clients")
+parser.add_argument("--max-ratio", type=float, default=1.25,
+                    help="maximum import time of the lambda over the import time of its dependencies")
+args = parser.parse_args()
+
+
+# The libraries the lambda imports, which the lambda code cannot make faster
+DEPENDENCIES = 'boto3,requests,urllib3,cryptography.hazmat.primitives.serialization'
+
+
+def cold_import(module_names):
+    env = dict(os.environ, AWS_DEFAULT_REGION=args.region)
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT, module_names, os.path.join(SRC_PATH, 'shared_libraries'),
+                             os.path.join(SRC_PATH, 'aws_ec2_auto_onboarding')],
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+# Runs are interleaved so both imports see the same machine load
+baseline_results, results = [], []
+for _ in range(args.runs):
+    baseline_results.append(cold_import(DEPENDENCIES))
+    results.append(cold_import('aws_ec2_auto_onboarding'))
+baseline_duration = statistics.median(result['duration'] for result in baseline_results)
+median_duration = statistics.median(result['duration'] for result in results)
+api_calls = sorted(set(call for result in results for call in result['api_calls']))
+print(f"Median import time of the dependencies: {baseline_duration:.2f} ms over {args.runs} runs")
+print(f"Median import time of the lambda: {median_duration:.2f} ms, {median_duration - baseline_duration:.2f} ms "
+      f"({median_duration / baseline_duration:.2f}x) over its dependencies")
+print(f"AWS API calls at import: {', '.join(api_calls) if api_calls else 'none'}")
+if api_calls:
+    print("Cold start regression, the import must make no AWS call")
+    sys.exit(1)
+if median_duration > baseline_duration * args.max_ratio:
+    print(f"Cold start regression, the lambda import exceeds {args.max_ratio:.2f}x the import of its dependencies")
+    sys.exit(1)
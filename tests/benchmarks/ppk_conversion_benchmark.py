@@ -0,0 +1,54 @@
+# Compares the pem to ppk conversion of kp_processing with the former puttygen pipeline and checks the outputs are identical
+# Requires openssl to generate the RSA keys
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/shared_libraries'))
+import log_mechanism
+import kp_processing
+
+PUTTYGEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../puttygen')
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--keys", type=int, default=20, help="number of converted keys")
+parser.add_argument("--bits", type=int, default=2048, help="size of the generated RSA keys")
+args = parser.parse_args()
+log_mechanism.debug_level_cache['value'] = 'Info'  # No parameter store call
+
+
+# The shell commands the lambda ran for every Linux instance before the conversion was done in memory
+def convert_with_puttygen(work_dir, pem_path):
+    subprocess.call([f"cat {pem_path} > {work_dir}/pemValue.pem"], shell=True)
+    subprocess.call([f"chmod 777 {work_dir}/pemValue.pem"], shell=True)
+    subprocess.call([f"cp {PUTTYGEN_PATH} {work_dir}/puttygen"], shell=True)
+    subprocess.call([f"chmod 777 {work_dir}/puttygen"], shell=True)
+    subprocess.check_output(f"ls {work_dir} -l", shell=True)
+    subprocess.check_output(f"cat {work_dir}/pemValue.pem", shell=True)
+    subprocess.call([f"{work_dir}/puttygen {work_dir}/pemValue.pem -O private -o {work_dir}/ppkValue.ppk"], shell=True)
+    return subprocess.check_output(f"cat {work_dir}/ppkValue.ppk", shell=True).decode("utf-8")
+
+
+with tempfile.TemporaryDirectory() as work_dir:
+    puttygen_duration = native_duration = 0
+    for key_number in range(args.keys):
+        pem_path = os.path.join(work_dir, f'key{key_number}.pem')
+        subprocess.run(['openssl', 'genrsa', '-traditional', '-out', pem_path, str(args.bits)], check=True,
+                       stderr=subprocess.DEVNULL)
+        with open(pem_path, 'r') as pem_file:
+            pem_value = pem_file.read()
+        start_time = time.perf_counter()
+        puttygen_ppk = convert_with_puttygen(work_dir, pem_path)
+        puttygen_duration += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        native_ppk = kp_processing.convert_pem_to_ppk(pem_value)
+        native_duration += time.perf_counter() - start_time
+        if native_ppk != puttygen_ppk:
+            print(f"Conversion of key {key_number} differs from puttygen")
+            sys.exit(1)
+
+print(f"puttygen pipeline: {puttygen_duration * 1000 / args.keys:.2f} ms per key")
+print(f"kp_processing: {native_duration * 1000 / args.keys:.2f} ms per key")
+print(f"All {args.keys} conversions are identical")
@@ -3,16 +3,38 @@ from unittest.mock import Mock
 from unittest.mock import MagicMock
 from unittest.mock import patch
 import sys
+import os
+import shutil
+import subprocess
+import tempfile
+import datetime
+import threading
+import time
+import base64
 import boto3
+import certifi
 import requests
 import json
+from botocore.exceptions import ClientError
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from moto import mock_ec2, mock_iam, mock_dynamodb2, mock_sts, mock_ssm
 sys.path.append('../src/shared_libraries')
+sys.path.append('../src/aws_ec2_auto_onboarding')
 import aws_services
+import log_mechanism
 import kp_processing
 import instance_processing
 import pvwa_api_calls as pvwa_api
+import pvwa_integration
 from pvwa_integration import PvwaIntegration
+import aws_ec2_auto_onboarding
+import aws_clients
+import reconciliation
+import sweeper
+import retry_mechanism
+import circuit_breaker
 
 MOTO_ACCOUNT = '123456789012'
 UNIX_PLATFORM = "UnixSSHKeys"
@@ -42,6 +64,24 @@ class AwsServicesTest(unittest.TestCase):
         self.assertEqual('ec2.ServiceResource()', str(diff_accounts))
         self.assertEqual('ec2.ServiceResource()', str(same_account))
 
+    def test_get_account_credentials_cache(self):
+        print('test_get_account_credentials_cache')
+        sts_client = Mock()
+        sts_client.assume_role.return_value = {'Credentials': {
+            'AccessKeyId': 'key', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}}
+        aws_services.credentials_cache.clear()
+        with patch('aws_clients.get_client', return_value=sts_client):
+            same_account = aws_services.get_account_credentials(MOTO_ACCOUNT, MOTO_ACCOUNT, 'eu-west-2')
+            first = aws_services.get_account_credentials(MOTO_ACCOUNT, '138339392836', 'eu-west-2')
+            second = aws_services.get_account_credentials(MOTO_ACCOUNT, '138339392836', 'eu-west-2')
+            aws_services.get_account_credentials(MOTO_ACCOUNT, '138339392836', 'us-east-1')
+        self.assertEqual({}, same_account)
+        self.assertEqual(first, second)
+        self.assertEqual('token', first['aws_session_token'])
+        self.assertEqual(2, sts_client.assume_role.call_count)
+        aws_services.credentials_cache.clear()
+
     def test_get_ec2_details(self):
         print('test_get_ec2_details')
         ec2_resource = boto3.resource('ec2')
@@ -51,6 +91,22 @@ class AwsServicesTest(unittest.TestCase):
         self.assertIn('Amazon Linux', linux['image_description'])
         self.assertIn('Windows', windows['image_description'])
 
+    def test_get_image_details_cache(self):
+        ec2_object = Mock()
+        ec2_object.Image.return_value.description = 'Ubuntu Server 20.04 LTS'
+        ec2_object.Image.return_value.platform = None
+        aws_services.ami_cache['images'].clear()
+        with patch('aws_services.get_shared_image_details', return_value=None) as get_shared_image_details, \
+             patch('aws_services.put_shared_image_details') as put_shared_image_details:
+            first = aws_services.get_image_details('ami-12c6146b', ec2_object)
+            second = aws_services.get_image_details('ami-12c6146b', ec2_object)
+        aws_services.ami_cache['images'].clear()
+        self.assertEqual('ubuntu', first['username'])
+        self.assertEqual(first, second)
+        ec2_object.Image.assert_called_once_with('ami-12c6146b')
+        get_shared_image_details.assert_called_once_with('ami-12c6146b')
+        put_shared_image_details.assert_called_once()
+
     def test_get_instance_data_from_dynamo_table(self):
         print('test_get_instance_data_from_dynamo_table')
         ec2_resource = boto3.resource('ec2')
@@ -101,21 +157,43 @@ class AwsServicesTest(unittest.TestCase):
     def test_get_session_from_dynamo(self):
         print('test_get_session_from_dynamo')
         sessions_table_lock_client = Mock()
-        def fake_acquire(a, b):
-            return 'ab-1232'
-        @patch.object(sessions_table_lock_client, 'acquire', fake_acquire)
-        def invoke():
-            session_number, guid = aws_services.get_session_from_dynamo(sessions_table_lock_client)
-            return session_number, guid
-        session_number, guid = invoke()
-        self.assertIn('mock.guid', str(guid))
-        self.assertEqual(type('1'), type(session_number))
-        @patch.object(sessions_table_lock_client, 'acquire', fake_exc)
-        def invoke2():
-            with self.assertRaises(Exception) as context:
-                aws_services.get_session_from_dynamo(sessions_table_lock_client)
-            self.assertTrue('fake_exc' in str(context.exception))
-        invoke2()
+        sessions_table_lock_client.db.update_item.return_value = {'Attributes': {'value': {'N': '141'}}}
+        session_number, guid = aws_services.get_session_from_dynamo(sessions_table_lock_client)
+        self.assertEqual('42', session_number)
+        self.assertEqual(sessions_table_lock_client.guid, guid)
+        self.assertTrue(sessions_table_lock_client.locked)
+        sessions_table_lock_client.db.put_item.side_effect = Exception('fake_exc')
+        with self.assertRaises(Exception) as context:
+            aws_services.get_session_from_dynamo(sessions_table_lock_client)
+        self.assertTrue('fake_exc' in str(context.exception))
+
+    def test_get_session_from_dynamo_locked_sessions(self):
+        print('test_get_session_from_dynamo_locked_sessions')
+        sessions_table_lock_client = Mock()
+        sessions_table_lock_client.db.update_item.return_value = {'Attributes': {'value': {'N': '99'}}}
+        def fake_put_item(**kwargs):
+            if kwargs['Item']['name']['S'] in ['7', '100']:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        sessions_table_lock_client.db.put_item.side_effect = fake_put_item
+        session_number, guid = aws_services.get_session_from_dynamo(sessions_table_lock_client, preferred_sessions=['7'])
+        self.assertEqual('1', session_number)
+        tried = [call[1]['Item']['name']['S'] for call in sessions_table_lock_client.db.put_item.call_args_list]
+        self.assertEqual(['7', '100', '1'], tried)
+
+    def test_get_params_from_param_store_cache(self):
+        print('test_get_params_from_param_store_cache')
+        ec2_class = EC2Details()
+        aws_services.invalidate_params_cache()
+        with patch('aws_services.retrieve_params_from_param_store', return_value=ec2_class.sp_class) as retrieve:
+            first = aws_services.get_params_from_param_store()
+            second = aws_services.get_params_from_param_store()
+            self.assertEqual(1, retrieve.call_count)
+            aws_services.invalidate_params_cache()
+            aws_services.get_params_from_param_store()
+            aws_services.get_params_from_param_store(use_cache=False)
+            self.assertEqual(3, retrieve.call_count)
+        self.assertIs(first, second)
+        aws_services.invalidate_params_cache()
 
     def test_update_instances_table_status(self):
         print('test_update_instances_table_status')
@@ -127,19 +205,62 @@ class AwsServicesTest(unittest.TestCase):
         self.assertTrue(status)
         table.delete()
 
+@mock_dynamodb2
+class InstanceLeaseTest(unittest.TestCase):
+    def setUp(self):
+        boto3.client('dynamodb').create_table(
+            TableName='Instances', BillingMode='PAY_PER_REQUEST',
+            KeySchema=[{'AttributeName': 'InstanceId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'InstanceId', 'AttributeType': 'S'}])
+        self.instances_table = boto3.resource('dynamodb').Table('Instances')
+        retry_mechanism.lambda_deadline['value'] = None
+
+    def test_instance_lease_duration(self):
+        self.assertEqual(aws_services.INSTANCE_LEASE_DURATION, aws_services.get_instance_lease_duration())
+        retry_mechanism.set_lambda_deadline(generate_lambda_context(360000))
+        lease = aws_services.acquire_instance_lease(INSTANCE_ID)
+        retry_mechanism.lambda_deadline['value'] = None
+        # The lease expires shortly after the invocation times out
+        self.assertAlmostEqual(time.time() + 360 + aws_services.INSTANCE_LEASE_MARGIN, lease.expiration, delta=2)
+
+    def test_acquire_instance_lease_not_on_db(self):
+        lease = aws_services.acquire_instance_lease(INSTANCE_ID)
+        self.assertFalse(lease.instance_data)
+        self.assertEqual(0, lease.version)
+        self.assertIsNone(aws_services.acquire_instance_lease(INSTANCE_ID, timeout=0))
+        aws_services.release_instance_lease(lease)
+        self.assertNotIn('Item', self.instances_table.get_item(Key={'InstanceId': INSTANCE_ID}))
+
+    def test_release_instance_lease_keeps_item(self):
+        self.instances_table.put_item(Item={'InstanceId': INSTANCE_ID, 'Status': 'on boarded', 'Address': '1.1.1.1'})
+        lease = aws_services.acquire_instance_lease(INSTANCE_ID)
+        self.assertEqual('on boarded', lease.instance_data['Status']['S'])
+        aws_services.release_instance_lease(lease)
+        item = self.instances_table.get_item(Key={'InstanceId': INSTANCE_ID})['Item']
+        self.assertNotIn('LeaseOwner', item)
+        self.assertEqual('on boarded', item['Status'])
+        self.assertIsNotNone(aws_services.acquire_instance_lease(INSTANCE_ID, timeout=0))
+
+    def test_instance_lease_takeover(self):
+        self.instances_table.put_item(Item={'InstanceId': INSTANCE_ID, 'Status': 'on board failed', 'Address': '1.1.1.1'})
+        expired_lease = aws_services.acquire_instance_lease(INSTANCE_ID)
+        self.instances_table.update_item(Key={'InstanceId': INSTANCE_ID}, UpdateExpression='SET LeaseExpiration = :expiration',
+                                         ExpressionAttributeValues={':expiration': 0})
+        lease = aws_services.acquire_instance_lease(INSTANCE_ID, timeout=0)
+        self.assertNotEqual(expired_lease.owner, lease.owner)
+        self.assertFalse(aws_services.update_instances_table_status(INSTANCE_ID, 'delete failed', 'stale', expired_lease))
+        aws_services.release_instance_lease(expired_lease)
+        self.assertTrue(aws_services.update_instances_table_status(INSTANCE_ID, 'on boarded', 'None', lease))
+        item = self.instances_table.get_item(Key={'InstanceId': INSTANCE_ID})['Item']
+        self.assertEqual(('on boarded', lease.owner, 1), (item['Status'], item['LeaseOwner'], item['Version']))
+
+
 @mock_iam
 @mock_dynamodb2
 @mock_sts
 @mock_ec2
 @mock_ssm
 class KpProcessingTest(unittest.TestCase):
-    def test_save_key_pair(self):
-        print('test_save_key_pair')
-        with open('pemValue.pem', 'r') as file:
-            keyf = file.read()
-        kp = kp_processing.save_key_pair(keyf)
-        self.assertEqual(None, kp)
-
     def test_convert_pem_to_ppk(self):
         print('test_convert_pem_to_ppk')
         with open('pemValueM.pem', 'r') as file:
@@ -150,21 +271,62 @@ class KpProcessingTest(unittest.TestCase):
             kp_processing.convert_pem_to_ppk('3')
         self.assertEqual(Exception, type(context.exception))
 
+    def test_convert_pem_to_ppk_matches_puttygen(self):
+        pem_key = generate_pem_key()
+        with tempfile.TemporaryDirectory() as work_dir:
+            shutil.copy('puttygen', work_dir)
+            os.chmod(f'{work_dir}/puttygen', 0o700)
+            with open(f'{work_dir}/key.pem', 'w') as pem_file:
+                pem_file.write(pem_key)
+            subprocess.check_call([f'{work_dir}/puttygen', f'{work_dir}/key.pem', '-O', 'private', '-o', f'{work_dir}/key.ppk'])
+            with open(f'{work_dir}/key.ppk', 'r') as ppk_file:
+                puttygen_ppk = ppk_file.read()
+        self.assertEqual(puttygen_ppk, kp_processing.convert_pem_to_ppk(pem_key))
+        self.assertEqual(puttygen_ppk, kp_processing.convert_pem_to_ppk(json.dumps(pem_key)))
+        ppk_v3 = kp_processing.convert_pem_to_ppk(pem_key, ppk_version=3)
+        self.assertTrue(ppk_v3.startswith('PuTTY-User-Key-File-3: ssh-rsa\n'))
+        self.assertEqual(64, len(ppk_v3.splitlines()[-1].split(': ')[1]))
+
+    def test_convert_pem_to_ppk_cache(self):
+        pem_key = generate_pem_key()
+        kp_processing.pop_ppk_cache_statistics()
+        with patch('kp_processing.encode_ppk', return_value='ppk') as encode_ppk:
+            ppk_keys = [kp_processing.convert_pem_to_ppk(pem_key) for _ in range(3)]
+            kp_processing.convert_pem_to_ppk(generate_pem_key())
+        self.assertEqual(['ppk'] * 3, ppk_keys)
+        self.assertEqual(2, encode_ppk.call_count)
+        self.assertEqual((2, 2), kp_processing.pop_ppk_cache_statistics())
+        self.assertEqual((0, 0), kp_processing.pop_ppk_cache_statistics())
+
     def test_decrypt_password(self):
         print('test_decrypt_password')
+        with open('pemValue.pem', 'r') as file:
+            keyf = file.read()
         command = kp_processing.decrypt_password(
             'V2KFpNbdQM5x90z7KCSqU2Iw8t/kA+8WhWpngtbrZ737Jax9Hj6RBPqyB+qrT0kpVAiAJ9+oXHIU8d7y2OlGdYWjPGB/FFJ'\
             'aVDcOsX+kwQBzeVswv+aD2GgnhvoSRX3feanN7jjbBOLpE+BpqV6a97qYiDSEoEU6l22Vh1TVlMUQ+rytt7c8oUnT3s/nJc01xFSmE1tVx6QNCeJLY'\
             'yfAJCkj6dWYJj7SxpReuBuqmyqvGiPe3pEFDqpl+Tvkz2qg62f8WYWv2dYdQ+/NLFL6nwEKQnyQjBfYoZfmrJev9kejHqLf3zjNWxYK+L62F8g1gZS'\
-            'TNkB3U4IDrg/vLiB4YQ==')
+            'TNkB3U4IDrg/vLiB4YQ==', keyf)
         self.assertEqual('Ziw$B-HC-9cLEZ?ypza$PUdWQdliW-i9', command[1])
 
+    def test_decrypt_password_parses_key_once(self):
+        pem_key = generate_pem_key()
+        public_key = kp_processing.get_private_key(pem_key).public_key()
+        with patch('kp_processing.load_pem_private_key') as load_pem_private_key:
+            for password in ['first', 'second']:
+                password_data = base64.b64encode(public_key.encrypt(password.encode(), padding.PKCS1v15()))
+                self.assertEqual(password, kp_processing.decrypt_password(password_data, pem_key))
+        load_pem_private_key.assert_not_called()
+
 @mock_iam
 @mock_dynamodb2
 @mock_sts
 @mock_ec2
 @mock_ssm
 class InstanceProcessingTest(unittest.TestCase):
+    def setUp(self):
+        close_circuit(self)
+
     pvwa_integration_class = PvwaIntegration()
     def test_delete_instance(self):
         print('test_delete_instance')
@@ -190,6 +352,18 @@ class InstanceProcessingTest(unittest.TestCase):
         self.assertTrue(return_linux)
         table.delete()
 
+    def test_delete_instance_saved_vault_account(self):
+        ec2_class = EC2Details()
+        ec2_class.instance_data['VaultAccountId'] = {'S': '30_4'}
+        with patch('pvwa_api_calls.retrieve_account_id_from_account_name') as retrieve_account_id, \
+             patch('pvwa_api_calls.delete_account_from_vault') as delete_account_from_vault, \
+             patch('aws_services.remove_instance_from_dynamo_table'):
+            response = instance_processing.delete_instance(INSTANCE_ID, 'session', ec2_class.sp_class,
+                                                           ec2_class.instance_data, None)
+        self.assertTrue(response)
+        retrieve_account_id.assert_not_called()
+        self.assertEqual('30_4', delete_account_from_vault.call_args[0][1])
+
     def test_get_instance_password_data(self):
         print('test_get_instance_password_data')
         ec2_resource = boto3.resource('ec2')
@@ -206,6 +380,18 @@ class InstanceProcessingTest(unittest.TestCase):
         response = func_create_instance(ec2_class, windows)
         self.assertTrue(response)
 
+    def test_create_instance_windows_pending_password(self):
+        ec2_class = EC2Details()
+        with patch('instance_processing.get_instance_password_data', return_value=''), \
+             patch('aws_services.put_instance_pending_password') as put_instance_pending_password, \
+             patch('aws_services.get_session_from_dynamo') as get_session_from_dynamo:
+            response = instance_processing.create_instance(INSTANCE_ID, ec2_class.details, ec2_class.sp_class, 'log',
+                                                           MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'pem')
+        self.assertFalse(response)
+        self.assertEqual((INSTANCE_ID, '192.192.192.192', MOTO_ACCOUNT, 'eu-west-2'),
+                         put_instance_pending_password.call_args[0][:4])
+        get_session_from_dynamo.assert_not_called()
+
     def test_create_instance_linux(self):
         print('test_create_instance_linux')
         ec2_resource = boto3.resource('ec2')
@@ -216,6 +402,24 @@ class InstanceProcessingTest(unittest.TestCase):
         response = func_create_instance(ec2_class, windows)
         self.assertTrue(response)
 
+    def test_create_instance_uses_created_account_id(self):
+        ec2_class = EC2Details()
+        ec2_class.set_platform('linix')
+        ec2_class.set_image_description('Linix')
+        with patch('kp_processing.convert_pem_to_ppk', return_value='PuTTY-User-Key-File-2: ssh-rsa\n'), \
+             patch('pvwa_api_calls.retrieve_account_id_from_account_name', return_value=False) as retrieve_account_id, \
+             patch('pvwa_api_calls.create_account_on_vault', return_value=('30_4', '')) as create_account_on_vault, \
+             patch('pvwa_api_calls.rotate_credentials_immediately') as rotate_credentials_immediately, \
+             patch('aws_services.put_instance_to_dynamo_table') as put_instance_to_dynamo_table:
+            response = instance_processing.create_instance(INSTANCE_ID, ec2_class.details, ec2_class.sp_class, 'log',
+                                                           MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'pem', 'session')
+        self.assertTrue(response)
+        retrieve_account_id.assert_called_once()
+        self.assertEqual('PuTTY-User-Key-File-2: ssh-rsa\n', create_account_on_vault.call_args[0][2])
+        self.assertEqual('key', create_account_on_vault.call_args[0][9])
+        self.assertEqual('30_4', rotate_credentials_immediately.call_args[0][2])
+        self.assertEqual('30_4', put_instance_to_dynamo_table.call_args[0][5]['VaultAccountId'])
+
     def test_get_os_distribution_user(self):
         user = instance_processing.get_os_distribution_user('centos')
         self.assertEqual(user, 'centos')
@@ -230,14 +434,44 @@ class InstanceProcessingTest(unittest.TestCase):
         user = instance_processing.get_os_distribution_user('Lemon')
         self.assertEqual(user, 'ec2-user')
 
+    def test_get_os_distribution_user_custom_rules(self):
+        with patch.dict(os.environ, {'AOB_OS_USERNAME_RULES': '[["Ubuntu Pro", "admin"], ["rhel", "ec2-user"]]'}):
+            self.assertEqual('admin', instance_processing.get_os_distribution_user('ubuntu pro 20.04'))
+            self.assertEqual('ubuntu', instance_processing.get_os_distribution_user('ubuntu 20.04'))
+            self.assertEqual('centos', instance_processing.get_os_distribution_user('CentOS 7'))
+        with patch.dict(os.environ, {'AOB_OS_USERNAME_RULES': 'centos'}):
+            self.assertEqual('ec2-user', instance_processing.get_os_distribution_user('Lemon'))
+
 class PvwaApiCallsTest(unittest.TestCase):
+    def setUp(self):
+        close_circuit(self)
+
     def test_create_account_on_vault(self):
         ec2_class = EC2Details()
         method = 'create_account_on_vault'
         parameters = ['1', 'my_account','password', ec2_class.sp_class, UNIX_PLATFORM, '1.1.1.1',
                       INSTANCE_ID, 'user', 'safe']
-        response = mock_pvwa_integration(method, parameters, 201)
-        self.assertTrue(response)
+        response = requests.Response()
+        response.status_code = 201
+        response._content = b'{"id": "30_4", "name": "my_account"}'
+        with patch('pvwa_integration.PvwaIntegration.call_rest_api_post', return_value=response) as call_rest_api_post:
+            account_id, error_message = pvwa_api.create_account_on_vault(*parameters)
+        self.assertEqual('30_4', account_id)
+        self.assertTrue(call_rest_api_post.call_args[0][0].endswith('/API/Accounts'))
+        self.assertEqual({'name': 'my_account', 'address': '1.1.1.1', 'userName': 'user', 'platformId': UNIX_PLATFORM,
+                          'safeName': 'safe', 'secretType': 'password', 'secret': 'password',
+                          'secretManagement': {'automaticManagementEnabled': True}},
+                         json.loads(call_rest_api_post.call_args[0][1]))
+
+    def test_create_account_on_vault_without_account_id(self):
+        ec2_class = EC2Details()
+        parameters = ['1', 'my_account','password', ec2_class.sp_class, UNIX_PLATFORM, '1.1.1.1',
+                      INSTANCE_ID, 'user', 'safe']
+        with patch('pvwa_integration.PvwaIntegration.call_rest_api_post', return_value=mock_requests_response(201)), \
+             patch('pvwa_api_calls.retrieve_account_id_from_account_name', return_value='30_4') as retrieve_account_id:
+            account_id, error_message = pvwa_api.create_account_on_vault(*parameters)
+        self.assertEqual('30_4', account_id)
+        self.assertEqual(('1', '1.1.1.1,user', 'safe'), retrieve_account_id.call_args[0][:3])
 
     def test_create_account_on_vault_exception(self):
         ec2_class = EC2Details()
@@ -277,6 +511,47 @@ class PvwaApiCallsTest(unittest.TestCase):
         response = mock_pvwa_integration(method, parameters, 400)
         self.assertFalse(response)
 
+    def test_get_key_pair_cache(self):
+        parameters = ['1', 'AWS.123.eu-west-2.myKey', 'kp', INSTANCE_ID, 'https://pvwa']
+        with patch.dict(os.environ, {'AOB_KEY_PAIR_CACHE_TTL': '60'}), \
+             patch('pvwa_api_calls.check_if_kp_exists', return_value='42_1') as check_if_kp_exists, \
+             patch('pvwa_api_calls.get_account_value', return_value='pem') as get_account_value:
+            key_pairs = [pvwa_api.get_key_pair(*parameters) for _ in range(3)]
+            self.assertNotIn(b'pem', pvwa_api.key_pair_cache['key_pairs'][parameters[1]]['value'])
+            pvwa_api.invalidate_key_pair_cache(parameters[1])
+            pvwa_api.get_key_pair(*parameters)
+        pvwa_api.invalidate_key_pair_cache()
+        self.assertEqual([('42_1', 'pem')] * 3, key_pairs)
+        self.assertEqual(2, check_if_kp_exists.call_count)
+        self.assertEqual(2, get_account_value.call_count)
+
+    def test_get_key_pair_cache_account_replaced(self):
+        parameters = ['1', 'AWS.123.eu-west-2.myKey', 'kp', INSTANCE_ID, 'https://pvwa']
+        other_parameters = ['1', 'AWS.123.eu-west-2.otherKey', 'kp', INSTANCE_ID, 'https://pvwa']
+        with patch.dict(os.environ, {'AOB_KEY_PAIR_CACHE_TTL': '60'}), \
+             patch('pvwa_api_calls.check_if_kp_exists', side_effect=['42_1', '42_9', '42_7']) as check_if_kp_exists, \
+             patch('pvwa_api_calls.get_account_value', side_effect=['pem', 'other pem', 'new pem']):
+            pvwa_api.get_key_pair(*parameters)
+            pvwa_api.get_key_pair(*other_parameters)
+            pvwa_api.invalidate_key_pair_cache(parameters[1])  # Onboarding failed with the cached key pair
+            replaced_key_pair = pvwa_api.get_key_pair(*parameters)
+            cached_key_pairs = [pvwa_api.get_key_pair(*parameters), pvwa_api.get_key_pair(*other_parameters)]
+            fill_locks = dict(pvwa_api.key_pair_cache['fill_locks'])
+        pvwa_api.invalidate_key_pair_cache()
+        self.assertEqual(('42_7', 'new pem'), replaced_key_pair)
+        self.assertEqual([('42_7', 'new pem'), ('42_9', 'other pem')], cached_key_pairs)
+        self.assertEqual(3, check_if_kp_exists.call_count)
+        self.assertEqual({}, fill_locks)
+
+    def test_get_key_pair_cache_disabled(self):
+        parameters = ['1', 'AWS.123.eu-west-2.myKey', 'kp', INSTANCE_ID, 'https://pvwa']
+        with patch('pvwa_api_calls.check_if_kp_exists', return_value='42_1') as check_if_kp_exists, \
+             patch('pvwa_api_calls.get_account_value', return_value='pem'):
+            pvwa_api.get_key_pair(*parameters)
+            pvwa_api.get_key_pair(*parameters)
+        self.assertEqual(2, check_if_kp_exists.call_count)
+        self.assertFalse(pvwa_api.key_pair_cache['key_pairs'])
+
     def test_delete_account_from_vault(self):
         method = "delete_account_from_vault"
         parameters = ['1', MOTO_ACCOUNT, INSTANCE_ID, 'https://pvwa']
@@ -340,6 +615,76 @@ class PvwaApiCallsTest(unittest.TestCase):
         response = invoke()
         self.assertEqual(Exception, type(response))
 
+    def test_retrieve_account_id_from_account_name_next_page(self):
+        pages = [Mock(status_code=200, json=Mock(return_value={'value': [{'id': '1_1', 'name': 'AWS.i-other.Unix'}],
+                                                               'nextLink': 'api/accounts?offset=1'})),
+                 Mock(status_code=200, json=Mock(return_value={'value': [{'id': '1_2', 'name': f'AWS.{INSTANCE_ID}.Unix'}]}))]
+        with patch('pvwa_integration.PvwaIntegration.call_rest_api_get', side_effect=pages) as call_rest_api_get:
+            account_id = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID,
+                                                                        'https://pvwa')
+        self.assertEqual('1_2', account_id)
+        self.assertEqual('https://pvwa/api/accounts?offset=1', call_rest_api_get.call_args[0][0])
+
+    @mock_dynamodb2
+    def test_retrieve_account_id_from_account_name_index(self):
+        create_accounts_index_table()
+        accounts = [{'id': '1_1', 'name': f'AWS.{INSTANCE_ID}.Unix', 'address': '1.1.1.1', 'userName': 'ec2-user'},
+                    {'id': '1_2', 'name': 'AWS.i-other.Unix', 'address': '1.1.1.2', 'userName': 'ec2-user'}]
+        search = Mock(status_code=200, json=Mock(return_value={'value': [{'id': '1_3', 'name': f'AWS.{INSTANCE_ID}.Unix'}]}))
+        with patch.dict(os.environ, {'AOB_ACCOUNTS_INDEX_TTL': '900'}), patch.dict(pvwa_api.accounts_index, clear=True), \
+             patch('pvwa_integration.PvwaIntegration.call_rest_api_get',
+                   side_effect=[Mock(status_code=200, json=Mock(return_value={'value': accounts})), search]) as call_rest_api_get:
+            first = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID, 'https://pvwa')
+            pvwa_api.accounts_index.clear()  # Another container reads the index built by the first one
+            second = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID, 'https://pvwa')
+            pvwa_api.remove_indexed_account('1_1')
+            third = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID, 'https://pvwa')
+            fourth = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID, 'https://pvwa')
+        self.assertEqual(['1_1', '1_1', '1_3', '1_3'], [first, second, third, fourth])
+        self.assertEqual(2, call_rest_api_get.call_count)
+        self.assertIn('/api/accounts?filter=safeName eq safe&limit=1000', call_rest_api_get.call_args_list[0][0][0])
+
+    @mock_dynamodb2
+    def test_accounts_index_evicted_and_rebuilt(self):
+        accounts_index_table = create_accounts_index_table()
+        accounts = [{'id': '1_1', 'name': f'AWS.{INSTANCE_ID}.Unix', 'address': '1.1.1.1', 'userName': 'ec2-user'}]
+        search = Mock(status_code=200, json=Mock(return_value={'value': [{'id': '1_3', 'name': f'AWS.{INSTANCE_ID}.Unix'}]}))
+        with patch.dict(os.environ, {'AOB_ACCOUNTS_INDEX_TTL': '86400'}), patch.dict(pvwa_api.accounts_index, clear=True), \
+             patch('pvwa_integration.PvwaIntegration.call_rest_api_get',
+                   side_effect=[Mock(status_code=200, json=Mock(return_value={'value': accounts})), search,
+                                Mock(status_code=200, json=Mock(return_value={'value': []}))]) as call_rest_api_get, \
+             patch('pvwa_integration.PvwaIntegration.call_rest_api_post', return_value=mock_requests_response(404)):
+            indexed = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID,
+                                                                     'https://pvwa')
+            account_value = pvwa_api.get_account_value('1', indexed, INSTANCE_ID, 'https://pvwa')
+            searched = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID,
+                                                                      'https://pvwa')
+            accounts_index_table.update_item(Key={'SafeName': 'safe', 'AccountId': aws_services.ACCOUNTS_INDEX_STATE_ID},
+                                             UpdateExpression='SET BuiltTime = :built_time',
+                                             ExpressionAttributeValues={':built_time': 0})
+            pvwa_api.accounts_index.clear()
+            generation = pvwa_api.refresh_accounts_index('1', 'safe', 'https://pvwa')
+            rebuilt_accounts = aws_services.get_indexed_accounts('safe', '1.1.1.1', 'ec2-user', generation)
+        self.assertEqual(['1_1', False, '1_3'], [indexed, account_value, searched])
+        self.assertEqual(3, call_rest_api_get.call_count)
+        self.assertEqual(2, generation)
+        self.assertEqual([], rebuilt_accounts)
+
+    @mock_dynamodb2
+    def test_accounts_index_built_by_another_lambda(self):
+        accounts_index_table = create_accounts_index_table()
+        accounts_index_table.put_item(Item={'SafeName': 'safe', 'AccountId': aws_services.ACCOUNTS_INDEX_STATE_ID,
+                                            'ClaimOwner': 'other', 'ClaimExpiration': int(time.time()) + 300})
+        search = Mock(status_code=200, json=Mock(return_value={'value': [{'id': '1_3', 'name': f'AWS.{INSTANCE_ID}.Unix'}]}))
+        with patch.dict(os.environ, {'AOB_ACCOUNTS_INDEX_TTL': '900'}), patch.dict(pvwa_api.accounts_index, clear=True), \
+             patch('pvwa_integration.PvwaIntegration.call_rest_api_get', return_value=search) as call_rest_api_get:
+            account_id = pvwa_api.retrieve_account_id_from_account_name('1', '1.1.1.1,ec2-user', 'safe', INSTANCE_ID,
+                                                                        'https://pvwa')
+        # The safe is not listed while another lambda builds its index
+        self.assertEqual('1_3', account_id)
+        call_rest_api_get.assert_called_once()
+        self.assertIn('search=1.1.1.1,ec2-user', call_rest_api_get.call_args[0][0])
+
     def test_filter_get_accounts_result(self):
         with open('json_response.json') as json_resp:
             json_str = json.load(json_resp)
@@ -354,10 +699,574 @@ class PvwaApiCallsTest(unittest.TestCase):
         response = pvwa_api.filter_get_accounts_result(parsed_json_response, INSTANCE_ID)
         self.assertFalse(response)
 
+class RetryMechanismTest(unittest.TestCase):
+    def setUp(self):
+        retry_mechanism.lambda_deadline['value'] = None
+        retry_mechanism.set_pvwa_lock_deadline(None)
+
+    @patch('retry_mechanism.time.sleep')
+    def test_retry_on_service_unavailable(self, sleep):
+        responses = [mock_requests_response(503), mock_requests_response(503), mock_requests_response(200)]
+        send = Mock(side_effect=responses)
+        result = retry_mechanism.PVWA_RETRY_POLICY.call(send, 'url', timeout=30)
+        self.assertEqual(200, result.status_code)
+        self.assertEqual(3, send.call_count)
+        self.assertEqual(2, sleep.call_count)
+
+    @patch('retry_mechanism.time.sleep')
+    def test_retry_after_header(self, sleep):
+        throttled = mock_requests_response(429)
+        throttled.headers['Retry-After'] = '2'
+        send = Mock(side_effect=[throttled, mock_requests_response(201)])
+        result = retry_mechanism.PVWA_UNPROCESSED_RETRY_POLICY.call(send)
+        self.assertEqual(201, result.status_code)
+        sleep.assert_called_once_with(2.0)
+
+    @patch('retry_mechanism.time.sleep')
+    def test_unprocessed_policy_does_not_resend(self, sleep):
+        send = Mock(side_effect=[mock_requests_response(500), mock_requests_response(201)])
+        result = retry_mechanism.PVWA_UNPROCESSED_RETRY_POLICY.call(send)
+        self.assertEqual(500, result.status_code)
+        send.assert_called_once()
+        send = Mock(side_effect=requests.exceptions.ReadTimeout('read timeout'))
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            retry_mechanism.PVWA_UNPROCESSED_RETRY_POLICY.call(send)
+        send.assert_called_once()
+        sleep.assert_not_called()
+
+    @patch('retry_mechanism.time.sleep')
+    def test_max_attempts(self, sleep):
+        send = Mock(return_value=mock_requests_response(502))
+        result = retry_mechanism.PVWA_RETRY_POLICY.call(send)
+        self.assertEqual(502, result.status_code)
+        self.assertEqual(retry_mechanism.PVWA_RETRY_POLICY.max_attempts, send.call_count)
+
+    @patch('retry_mechanism.time.sleep')
+    def test_aws_throttling(self, sleep):
+        throttling = ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'DescribeInstances')
+        denied = ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Denied'}}, 'DescribeInstances')
+        load = Mock(side_effect=[throttling, None])
+        retry_mechanism.AWS_RETRY_POLICY.call(load)
+        self.assertEqual(2, load.call_count)
+        load = Mock(side_effect=denied)
+        with self.assertRaises(ClientError):
+            retry_mechanism.AWS_RETRY_POLICY.call(load)
+        load.assert_called_once()
+
+    def test_single_retry_layer(self):
+        client = aws_clients.get_client('sts', region_name='eu-west-2', single_attempt=True)
+        self.assertIsNot(client, aws_clients.get_client('sts', region_name='eu-west-2'))
+        self.assertEqual(1, client.meta.config.retries['total_max_attempts'])
+        adapter = pvwa_integration.get_http_session(False).get_adapter('https://pvwa')
+        self.assertEqual(0, adapter.max_retries.total)
+
+    @patch('retry_mechanism.time.sleep')
+    def test_no_retry_near_lambda_timeout(self, sleep):
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = (retry_mechanism.RESERVED_LAMBDA_TIME + 1) * 1000
+        retry_mechanism.set_lambda_deadline(context)
+        throttled = mock_requests_response(503)
+        throttled.headers['Retry-After'] = '5'
+        send = Mock(return_value=throttled)
+        result = retry_mechanism.PVWA_RETRY_POLICY.call(send)
+        self.assertEqual(503, result.status_code)
+        send.assert_called_once()
+        sleep.assert_not_called()
+        retry_mechanism.set_lambda_deadline(None)
+        self.assertIsNone(retry_mechanism.get_remaining_lambda_time())
+
+    @patch('retry_mechanism.time.sleep')
+    def test_no_pvwa_retry_after_connection_lock(self, sleep):
+        sessions_lock_client = Mock(lock_table_name='Sessions')
+        self.assertTrue(aws_services.acquire_session(sessions_lock_client, '1', (retry_mechanism.PVWA_LOCK_MARGIN + 1) * 1000))
+        throttled = mock_requests_response(503)
+        throttled.headers['Retry-After'] = '5'
+        send = Mock(return_value=throttled)
+        result = retry_mechanism.PVWA_RETRY_POLICY.call(send)
+        self.assertEqual(503, result.status_code)
+        send.assert_called_once()
+        # AWS requests do not use the PVWA connection
+        load = Mock(side_effect=[ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'GetItem'), None])
+        retry_mechanism.AWS_RETRY_POLICY.call(load)
+        self.assertEqual(2, load.call_count)
+        aws_services.release_session_on_dynamo('1', sessions_lock_client.guid, sessions_lock_client)
+        self.assertIsNone(retry_mechanism.get_remaining_pvwa_lock_time())
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.circuit_table = close_circuit(self)
+
+    def test_failures_open_circuit(self):
+        self.circuit_table.update_item.side_effect = [
+            {'Attributes': {'name': 'PvwaCircuitBreaker', 'Failures': 4}},
+            {'Attributes': {'name': 'PvwaCircuitBreaker', 'Failures': 5}},
+            {'Attributes': {'name': 'PvwaCircuitBreaker', 'Failures': 5, 'OpenUntil': int(time.time()) + 60}}]
+        circuit_breaker.record_pvwa_failure()
+        self.assertTrue(circuit_breaker.is_pvwa_available())
+        circuit_breaker.record_pvwa_failure()
+        self.assertEqual(3, self.circuit_table.update_item.call_count)
+        self.assertIn('OpenUntil <= :now', self.circuit_table.update_item.call_args[1]['ConditionExpression'])
+        self.assertTrue(circuit_breaker.is_pvwa_open())
+        self.assertFalse(circuit_breaker.is_pvwa_available())
+        self.circuit_table.get_item.assert_not_called()
+
+    def test_half_open_probe(self):
+        circuit_breaker.set_circuit_state({'name': 'PvwaCircuitBreaker', 'Failures': 5, 'OpenUntil': int(time.time()) - 1})
+        self.circuit_table.update_item.return_value = {'Attributes': {
+            'name': 'PvwaCircuitBreaker', 'Failures': 5, 'OpenUntil': int(time.time()) - 1,
+            'ProbeExpiration': int(time.time()) + circuit_breaker.PROBE_TIMEOUT}}
+        self.assertTrue(circuit_breaker.is_pvwa_available())
+        self.assertFalse(circuit_breaker.is_pvwa_available())  # Only the probe event calls the PVWA
+        self.assertEqual(1, self.circuit_table.update_item.call_count)
+        self.circuit_table.update_item.return_value = {'Attributes': {'name': 'PvwaCircuitBreaker', 'OpenUntil': 1}}
+        circuit_breaker.record_pvwa_success()
+        self.assertEqual('REMOVE Failures, OpenUntil, ProbeExpiration',
+                         self.circuit_table.update_item.call_args[1]['UpdateExpression'])
+        self.assertTrue(circuit_breaker.is_pvwa_available())
+
+    def test_probe_claimed_by_another_lambda(self):
+        circuit_breaker.set_circuit_state({'name': 'PvwaCircuitBreaker', 'Failures': 5, 'OpenUntil': int(time.time()) - 1})
+        self.circuit_table.update_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'failed'}}, 'UpdateItem')
+        self.circuit_table.get_item.return_value = {'Item': {
+            'name': 'PvwaCircuitBreaker', 'Failures': 5, 'OpenUntil': int(time.time()) - 1,
+            'ProbeExpiration': int(time.time()) + circuit_breaker.PROBE_TIMEOUT}}
+        self.assertFalse(circuit_breaker.is_pvwa_available())
+
+    def test_success_without_failures_is_not_written(self):
+        circuit_breaker.record_pvwa_success()
+        self.circuit_table.update_item.assert_not_called()
+
+    def test_circuit_state_not_available(self):
+        self.circuit_table.get_item.side_effect = Exception('DynamoDB is not available')
+        self.assertTrue(circuit_breaker.is_pvwa_available())
+
+
+class PvwaIntegrationTest(unittest.TestCase):
+    pvwa_integration_class = PvwaIntegration(True, 'POC')
+
+    def tearDown(self):
+        PvwaIntegration.session_pool.clear()
+        PvwaIntegration.replaced_tokens.clear()
+
+    def test_get_session_reuses_pooled_session(self):
+        with patch('pvwa_integration.PvwaIntegration.logon_pvwa', side_effect=['token1', 'token2']) as logon:
+            first = self.pvwa_integration_class.get_session('user', 'password', 'https://pvwa', '7')
+            second = self.pvwa_integration_class.get_session('user', 'password', 'https://pvwa', '7')
+            other = self.pvwa_integration_class.get_session('user', 'password', 'https://pvwa', '8')
+        self.assertEqual(['token1', 'token1', 'token2'], [first, second, other])
+        self.assertEqual(2, logon.call_count)
+
+    def test_get_session_expired(self):
+        with patch('pvwa_integration.PvwaIntegration.logon_pvwa', side_effect=['token1', 'token2']):
+            self.pvwa_integration_class.get_session('user', 'password', 'https://pvwa', '7')
+            PvwaIntegration.session_pool['7']['expiration'] = 0
+            session_token = self.pvwa_integration_class.get_session('user', 'password', 'https://pvwa', '7')
+        self.assertEqual('token2', session_token)
+
+    def test_call_rest_api_refreshes_session_on_unauthorized(self):
+        with patch('pvwa_integration.PvwaIntegration.logon_pvwa', side_effect=['token1', 'token2']):
+            self.pvwa_integration_class.get_session('user', 'password', 'https://pvwa', '7')
+            with patch('requests.Session.get', side_effect=[mock_requests_response(401), mock_requests_response(200),
+                                                            mock_requests_response(200)]) as get:
+                first = self.pvwa_integration_class.call_rest_api_get('https://pvwa/api', {'Authorization': 'token1'})
+                second = self.pvwa_integration_class.call_rest_api_get('https://pvwa/api', {'Authorization': 'token1'})
+        self.assertEqual(200, first.status_code)
+        self.assertEqual(200, second.status_code)
+        self.assertEqual(['token1', 'token2', 'token2'], [call[1]['headers']['Authorization'] for call in get.call_args_list])
+
+    def test_call_rest_api_records_circuit_outcome(self):
+        pvwa_integration_class = PvwaIntegration()
+        pvwa_integration_class.certificate = False
+        with patch('pvwa_integration.PvwaIntegration.get_http_session', return_value=requests.Session()), \
+             patch('retry_mechanism.time.sleep'), \
+             patch('circuit_breaker.record_pvwa_success') as record_pvwa_success, \
+             patch('circuit_breaker.record_pvwa_failure') as record_pvwa_failure:
+            with patch('requests.Session.get', return_value=mock_requests_response(404)):
+                pvwa_integration_class.call_rest_api_get('https://pvwa/api', {'Authorization': 'token'})
+            record_pvwa_success.assert_called_once_with()
+            with patch('requests.Session.get', return_value=mock_requests_response(503)):
+                pvwa_integration_class.call_rest_api_get('https://pvwa/api', {'Authorization': 'token'})
+            with patch('requests.Session.delete', side_effect=requests.exceptions.ConnectTimeout('timeout')):
+                self.assertIsNone(pvwa_integration_class.call_rest_api_delete('https://pvwa/api', {'Authorization': 'token'}))
+            self.assertEqual(2, record_pvwa_failure.call_count)
+            with patch('requests.Session.post', return_value=mock_requests_response(503)):
+                self.pvwa_integration_class.call_rest_api_post('https://pvwa/api', '{}', {'Authorization': 'token'})
+            self.assertEqual(2, record_pvwa_failure.call_count)  # The safe handler does not use the circuit
+            record_pvwa_success.assert_called_once_with()
+
+    def test_replaced_tokens_bounded_by_connections(self):
+        with patch('pvwa_integration.PvwaIntegration.logon_pvwa', side_effect=['token1', 'token2', 'token3']), \
+             patch('pvwa_integration.PvwaIntegration.call_rest_api_post', return_value=mock_requests_response(500)):
+            self.pvwa_integration_class.get_session('user', 'password', 'https://pvwa', '7')
+            self.pvwa_integration_class.refresh_session_header({'Authorization': 'token1'})
+            self.pvwa_integration_class.refresh_session_header({'Authorization': 'token2'})
+            self.assertEqual({'7': 'token2'}, PvwaIntegration.replaced_tokens)
+            self.assertEqual('token3', self.pvwa_integration_class.get_current_header({'Authorization': 'token2'})['Authorization'])
+            self.pvwa_integration_class.logoff_pvwa('https://pvwa', 'token3')
+        self.assertEqual({}, PvwaIntegration.replaced_tokens)
+
+    def test_init_retrieves_parameters_lazily(self):
+        with patch('aws_services.get_params_from_param_store', return_value=Mock(aob_mode='POC')) as get_params:
+            pvwa_integration_class = PvwaIntegration()
+            get_params.assert_not_called()
+            pvwa_integration_class.get_http_session()
+        self.assertEqual(1, get_params.call_count)
+        self.assertFalse(pvwa_integration_class.certificate)
+
+    def test_get_http_session(self):
+        poc_session = pvwa_integration.get_http_session(False)
+        self.assertIs(poc_session, pvwa_integration.get_http_session(False))
+        adapter = poc_session.get_adapter('https://pvwa')
+        self.assertIsInstance(adapter, pvwa_integration.PvwaHttpAdapter)
+        self.assertFalse(adapter.verify)
+        self.assertIsNone(adapter.ssl_context)
+        file_session = pvwa_integration.get_http_session('/tmp/server.crt')
+        self.assertIsNot(poc_session, file_session)
+        self.assertEqual('/tmp/server.crt', file_session.get_adapter('https://pvwa').verify)
+
+    def test_get_http_session_base64_certificate(self):
+        with open(certifi.where()) as certificates:
+            pem_certificate = certificates.read().split('-----END CERTIFICATE-----')[0] + '-----END CERTIFICATE-----\n'
+        base64_certificate = pem_certificate.split('-----')[2]
+        adapter = pvwa_integration.get_http_session(base64_certificate).get_adapter('https://pvwa')
+        pem_adapter = pvwa_integration.get_http_session(pem_certificate).get_adapter('https://pvwa')
+        self.assertTrue(adapter.verify)
+        self.assertEqual(pem_adapter.ssl_context.get_ca_certs(), adapter.ssl_context.get_ca_certs())
+        with self.assertRaisesRegex(Exception, 'neither a PEM nor a base64 encoded certificate'):
+            pvwa_integration.get_http_session('server.crt')
+        with self.assertRaisesRegex(Exception, 'neither a PEM nor a base64 encoded certificate'):
+            pvwa_integration.get_http_session('\n')
+
+
+class LogMechanismTest(unittest.TestCase):
+    def test_get_debug_level_once(self):
+        with patch.dict(log_mechanism.debug_level_cache, {'value': None}), \
+             patch('log_mechanism.retrieve_debug_level', return_value='Trace') as retrieve_debug_level:
+            logger = log_mechanism.LogMechanism()
+            retrieve_debug_level.assert_not_called()
+            logger.info('first')
+            logger.trace('second', caller_name='test_get_debug_level_once')
+        self.assertEqual(1, retrieve_debug_level.call_count)
+
+class AwsEc2AutoOnboardingTest(unittest.TestCase):
+    def setUp(self):
+        close_circuit(self)
+
+    def test_get_event_records_sns(self):
+        event = {'Records': [{'Sns': {'MessageId': 'sns-1', 'Message': json.dumps(generate_state_event('running'))}},
+                             {'Sns': {'MessageId': 'sns-2', 'Message': json.dumps(generate_state_event('terminated'))}}]}
+        records = aws_ec2_auto_onboarding.get_event_records(event)
+        self.assertEqual(['sns-1', 'sns-2'], [message_id for message_id, data in records])
+        self.assertEqual('terminated', records[1][1]['detail']['state'])
+
+    def test_get_event_records_sqs(self):
+        sns_notification = {'Type': 'Notification', 'Message': json.dumps(generate_state_event('running'))}
+        event = {'Records': [{'messageId': 'sqs-1', 'body': json.dumps(generate_state_event('running'))},
+                             {'messageId': 'sqs-2', 'body': json.dumps(sns_notification)},
+                             {'messageId': 'sqs-3', 'body': 'not a json'}]}
+        records = aws_ec2_auto_onboarding.get_event_records(event)
+        self.assertEqual(['sqs-1', 'sqs-2'], [message_id for message_id, data in records])
+        self.assertEqual(INSTANCE_ID, records[1][1]['detail']['instance-id'])
+
+    def test_get_event_records_eventbridge(self):
+        records = aws_ec2_auto_onboarding.get_event_records(generate_state_event('running'))
+        self.assertEqual([('event-1', generate_state_event('running'))], records)
+
+    def test_lambda_handler_batch_item_failures(self):
+        event = {'Records': [{'messageId': f'sqs-{state}', 'body': json.dumps(generate_state_event(state))}
+                             for state in ['running', 'terminated', 'stopped']]}
+        context = Mock()
+        context.invoked_function_arn = f'arn:aws:lambda:eu-west-2:{MOTO_ACCOUNT}:function:Elasticity'
+        def fake_elasticity(instance_id, action_type, *args):
+            if action_type == 'terminated':
+                raise Exception('fake_exc')
+            return None if action_type == 'stopped' else True
+        with patch('aws_ec2_auto_onboarding.elasticity_function', side_effect=fake_elasticity) as elasticity:
+            response = aws_ec2_auto_onboarding.lambda_handler(event, context)
+        self.assertEqual(3, elasticity.call_count)
+        self.assertEqual({'batchItemFailures': [{'itemIdentifier': 'sqs-terminated'}]}, response)
+
+    def test_lambda_handler_sns_failure_raises(self):
+        event = {'Records': [{'Sns': {'MessageId': 'sns-1', 'Message': json.dumps(generate_state_event('running'))}}]}
+        with patch('aws_ec2_auto_onboarding.elasticity_function', return_value=False):
+            with self.assertRaises(Exception):
+                aws_ec2_auto_onboarding.lambda_handler(event, generate_lambda_context(900000))
+        with patch('aws_ec2_auto_onboarding.elasticity_function', return_value=False):
+            with self.assertRaises(Exception):
+                aws_ec2_auto_onboarding.lambda_handler(generate_state_event('running'), generate_lambda_context(900000))
+        with patch('aws_ec2_auto_onboarding.elasticity_function', return_value=None):
+            self.assertEqual({'batchItemFailures': []}, aws_ec2_auto_onboarding.lambda_handler(event, generate_lambda_context(900000)))
+
+    def test_process_record_duplicate_event(self):
+        data = dict(generate_state_event('running'), time='2020-05-01T10:00:00Z')
+        latest_event = {'InstanceId': INSTANCE_ID, 'LastState': 'running', 'LastEventTime': 1588327200}
+        with patch('aws_services.claim_instance_event', return_value=(False, latest_event)) as claim_instance_event, \
+             patch('aws_ec2_auto_onboarding.elasticity_function') as elasticity, \
+             patch.dict(aws_ec2_auto_onboarding.skipped_events, {'duplicate': 0, 'stale': 0}):
+            self.assertTrue(aws_ec2_auto_onboarding.process_record(data, MOTO_ACCOUNT, 'log'))
+            self.assertEqual({'duplicate': 1, 'stale': 0}, aws_ec2_auto_onboarding.skipped_events)
+        claim_instance_event.assert_called_once_with(INSTANCE_ID, 'running', 1588327200)
+        elasticity.assert_not_called()
+
+    def test_process_record_stale_event(self):
+        data = dict(generate_state_event('running'), time='2020-05-01T10:00:00Z')
+        latest_event = {'InstanceId': INSTANCE_ID, 'LastState': 'terminated', 'LastEventTime': 1588327260}
+        with patch('aws_services.claim_instance_event', return_value=(False, latest_event)), \
+             patch('aws_ec2_auto_onboarding.elasticity_function') as elasticity, \
+             patch.dict(aws_ec2_auto_onboarding.skipped_events, {'duplicate': 0, 'stale': 0}):
+            self.assertTrue(aws_ec2_auto_onboarding.process_record(data, MOTO_ACCOUNT, 'log'))
+            self.assertEqual({'duplicate': 0, 'stale': 1}, aws_ec2_auto_onboarding.skipped_events)
+        elasticity.assert_not_called()
+
+    def test_process_record_failure_releases_event(self):
+        data = dict(generate_state_event('terminated'), time='2020-05-01T10:00:00Z')
+        previous_event = {'InstanceId': INSTANCE_ID, 'LastState': 'running', 'LastEventTime': 1588327000}
+        with patch('aws_services.claim_instance_event', return_value=(True, previous_event)), \
+             patch('aws_ec2_auto_onboarding.elasticity_function', side_effect=Exception('fake_exc')), \
+             patch('aws_services.release_instance_event') as release_instance_event:
+            self.assertFalse(aws_ec2_auto_onboarding.process_record(data, MOTO_ACCOUNT, 'log'))
+        release_instance_event.assert_called_once_with(INSTANCE_ID, 'terminated', 1588327200, previous_event)
+
+    @mock_dynamodb2
+    def test_lambda_handler_failed_event_redelivered(self):
+        boto3.client('dynamodb').create_table(
+            TableName=aws_services.INSTANCE_EVENTS_TABLE_NAME, BillingMode='PAY_PER_REQUEST',
+            KeySchema=[{'AttributeName': 'InstanceId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'InstanceId', 'AttributeType': 'S'}])
+        event = {'Records': [{'Sns': {'MessageId': 'sns-1', 'Message': json.dumps(
+            dict(generate_state_event('running'), time='2020-05-01T10:00:00Z'))}}]}
+        with patch('aws_ec2_auto_onboarding.elasticity_function', side_effect=[False, True]) as elasticity:
+            with self.assertRaises(Exception):
+                aws_ec2_auto_onboarding.lambda_handler(event, generate_lambda_context(900000))
+            redelivered = aws_ec2_auto_onboarding.lambda_handler(event, generate_lambda_context(900000))
+            duplicate = aws_ec2_auto_onboarding.lambda_handler(event, generate_lambda_context(900000))
+        self.assertEqual({'batchItemFailures': []}, redelivered)
+        self.assertEqual({'batchItemFailures': []}, duplicate)
+        self.assertEqual(2, elasticity.call_count)
+
+    def test_process_record_parameter_store_change(self):
+        data = {'source': 'aws.ssm', 'detail-type': 'Parameter Store Change', 'detail': {'name': 'AOB_Vault_Pass'}}
+        with patch('aws_services.invalidate_params_cache') as invalidate:
+            self.assertTrue(aws_ec2_auto_onboarding.process_record(data, MOTO_ACCOUNT, 'log'))
+        invalidate.assert_called_once_with()
+
+    def test_elasticity_function_terminated_saved_vault_account(self):
+        instance_data = {'Status': {'S': 'on boarded'}, 'Address': {'S': '192.192.192.192'},
+                         'VaultAccountId': {'S': '30_4'}}
+        lease = aws_services.InstanceLease(INSTANCE_ID, 'owner', 900, 3, instance_data)
+        with patch('aws_services.acquire_instance_lease', return_value=lease), \
+             patch('aws_services.release_instance_lease') as release_instance_lease, \
+             patch('aws_services.get_account_details') as get_account_details, \
+             patch('aws_services.get_ec2_details') as get_ec2_details, \
+             patch('aws_services.get_params_from_param_store', return_value=EC2Details().sp_class), \
+             patch('aws_services.get_session_from_dynamo', return_value=(1, 'guid')), \
+             patch('pvwa_integration.PvwaIntegration.get_session', return_value='session'), \
+             patch('aws_services.release_session_on_dynamo'), \
+             patch('instance_processing.delete_instance', return_value=True) as delete_instance:
+            aws_ec2_auto_onboarding.elasticity_function(INSTANCE_ID, 'terminated', MOTO_ACCOUNT, 'eu-west-2',
+                                                        MOTO_ACCOUNT, 'log')
+        get_account_details.assert_not_called()
+        get_ec2_details.assert_not_called()
+        self.assertEqual((INSTANCE_ID, 'session'), delete_instance.call_args[0][:2])
+        self.assertIsNone(delete_instance.call_args[0][4])
+        self.assertIs(lease, delete_instance.call_args[0][5])
+        release_instance_lease.assert_called_once_with(lease)
+
+    def test_elasticity_function_lease_not_acquired(self):
+        with patch('aws_services.acquire_instance_lease', return_value=None), \
+             patch('aws_ec2_auto_onboarding.get_instance_enrichment') as get_instance_enrichment, \
+             patch('aws_services.release_instance_lease') as release_instance_lease:
+            self.assertFalse(aws_ec2_auto_onboarding.elasticity_function(INSTANCE_ID, 'running', MOTO_ACCOUNT,
+                                                                         'eu-west-2', MOTO_ACCOUNT, 'log'))
+        get_instance_enrichment.assert_not_called()
+        release_instance_lease.assert_not_called()
+
+    @mock_dynamodb2
+    def test_elasticity_function_circuit_open(self):
+        boto3.client('dynamodb').create_table(
+            TableName='Instances', BillingMode='PAY_PER_REQUEST',
+            KeySchema=[{'AttributeName': 'InstanceId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'InstanceId', 'AttributeType': 'S'},
+                                  {'AttributeName': 'Status', 'AttributeType': 'S'}],
+            GlobalSecondaryIndexes=[{'IndexName': aws_services.INSTANCES_STATUS_INDEX_NAME,
+                                     'KeySchema': [{'AttributeName': 'Status', 'KeyType': 'HASH'}],
+                                     'Projection': {'ProjectionType': 'ALL'}}])
+        instances_table = boto3.resource('dynamodb').Table('Instances')
+        instances_table.put_item(Item={'InstanceId': 'i-onboarded', 'Status': 'on boarded', 'Address': '1.1.1.1'})
+        with patch('circuit_breaker.is_pvwa_available', return_value=False), \
+             patch('aws_ec2_auto_onboarding.process_instance_state') as process_instance_state:
+            for instance_id, action_type in [(INSTANCE_ID, 'running'), ('i-onboarded', 'terminated'), ('i-other', 'terminated')]:
+                aws_ec2_auto_onboarding.elasticity_function(instance_id, action_type, MOTO_ACCOUNT, 'eu-west-2',
+                                                            MOTO_ACCOUNT, 'log')
+        # Only the termination of an instance that is not on DB is processed without the PVWA
+        self.assertEqual('i-other', process_instance_state.call_args[0][0])
+        instance_groups = sweeper.get_failed_instance_groups(time.time(), sweeper.SweepReport())
+        self.assertEqual([(MOTO_ACCOUNT, 'eu-west-2')], list(instance_groups))
+        self.assertEqual({(INSTANCE_ID, 'on board failed'), ('i-onboarded', 'delete failed')},
+                         {(item['InstanceId'], item['Status']) for item in instance_groups[(MOTO_ACCOUNT, 'eu-west-2')]})
+        self.assertNotIn('LeaseOwner', instances_table.get_item(Key={'InstanceId': INSTANCE_ID})['Item'])
+
+    def test_get_instance_enrichment(self):
+        instance_data = {'Status': {'S': 'on boarded'}, 'Address': {'S': '192.192.192.192'}}
+        with patch('aws_services.get_params_from_param_store', return_value='parameters'), \
+             patch('aws_services.get_account_details', return_value='ec2') as get_account_details, \
+             patch('aws_services.get_ec2_details', return_value='details') as get_ec2_details:
+            running = aws_ec2_auto_onboarding.get_instance_enrichment(INSTANCE_ID, 'running', MOTO_ACCOUNT, 'eu-west-2',
+                                                                      MOTO_ACCOUNT, False)
+            terminated = aws_ec2_auto_onboarding.get_instance_enrichment(INSTANCE_ID, 'terminated', MOTO_ACCOUNT,
+                                                                         'eu-west-2', MOTO_ACCOUNT, instance_data)
+        self.assertEqual(('details', 'parameters'), running)
+        self.assertEqual(('details', 'parameters'), terminated)
+        get_account_details.assert_called_with(MOTO_ACCOUNT, MOTO_ACCOUNT, 'eu-west-2')
+        get_ec2_details.assert_called_with(INSTANCE_ID, 'ec2', MOTO_ACCOUNT)
+
+    def test_get_instance_enrichment_failure(self):
+        with patch('aws_services.get_params_from_param_store', return_value='parameters'), \
+             patch('aws_services.get_account_details', side_effect=Exception('AccessDenied')):
+            with self.assertRaises(Exception) as context:
+                aws_ec2_auto_onboarding.get_instance_enrichment(INSTANCE_ID, 'running', MOTO_ACCOUNT, 'eu-west-2',
+                                                                MOTO_ACCOUNT, False)
+        self.assertEqual('AccessDenied', str(context.exception))
+
+    def test_poll_pending_passwords(self):
+        pending_instances = [{'InstanceId': instance_id, 'AccountId': MOTO_ACCOUNT, 'Region': 'eu-west-2',
+                              'PollAttempts': poll_attempts}
+                             for instance_id, poll_attempts in [('i-claimed', 1), ('i-available', 2), ('i-expired', 14)]]
+        lease = aws_services.InstanceLease('i-expired', 'owner', 900, 3, {'Status': {'S': 'pending password'}})
+        with patch('aws_services.get_pending_password_instances', return_value=pending_instances), \
+             patch('aws_services.claim_pending_password_poll', side_effect=lambda instance_id, *args: instance_id != 'i-claimed'), \
+             patch('instance_processing.get_instance_password_data',
+                   side_effect=lambda instance_id, *args: 'data' if instance_id == 'i-available' else ''), \
+             patch('aws_ec2_auto_onboarding.elasticity_function', return_value=True) as elasticity, \
+             patch('aws_services.acquire_instance_lease', return_value=lease) as acquire_instance_lease, \
+             patch('aws_services.release_instance_lease') as release_instance_lease, \
+             patch('aws_services.update_instances_table_status') as update_instances_table_status:
+            self.assertTrue(aws_ec2_auto_onboarding.process_record({'source': 'aws.events'}, MOTO_ACCOUNT, 'log'))
+        elasticity.assert_called_once_with('i-available', 'running', MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'log')
+        acquire_instance_lease.assert_called_once_with('i-expired')
+        update_instances_table_status.assert_called_once_with('i-expired', 'on board failed',
+                                                              'Instance password data is not available', lease)
+        release_instance_lease.assert_called_once_with(lease)
+
+    def test_poll_pending_password_status_changed(self):
+        pending_instance = {'InstanceId': 'i-expired', 'AccountId': MOTO_ACCOUNT, 'Region': 'eu-west-2', 'PollAttempts': 14}
+        lease = aws_services.InstanceLease('i-expired', 'owner', 900, 3, {'Status': {'S': 'on boarded'}})
+        with patch('aws_services.claim_pending_password_poll', return_value=True), \
+             patch('instance_processing.get_instance_password_data', return_value=''), \
+             patch('aws_services.acquire_instance_lease', return_value=lease), \
+             patch('aws_services.release_instance_lease') as release_instance_lease, \
+             patch('aws_services.update_instances_table_status') as update_instances_table_status:
+            self.assertFalse(aws_ec2_auto_onboarding.poll_pending_password(pending_instance, MOTO_ACCOUNT, 'log'))
+        update_instances_table_status.assert_not_called()
+        release_instance_lease.assert_called_once_with(lease)
+
+    def test_elasticity_function_lookup_failure(self):
+        lease = aws_services.InstanceLease(INSTANCE_ID, 'owner', 900, 3, {'Status': {'S': 'on board failed'},
+                                                                          'Address': {'S': '192.192.192.192'}})
+        with patch('aws_services.acquire_instance_lease', return_value=lease), \
+             patch('aws_services.release_instance_lease'), \
+             patch('aws_ec2_auto_onboarding.get_instance_enrichment', side_effect=Exception('AccessDenied')), \
+             patch('aws_services.put_instance_to_dynamo_table') as put_instance_to_dynamo_table, \
+             patch('aws_services.release_session_on_dynamo') as release_session_on_dynamo:
+            self.assertFalse(aws_ec2_auto_onboarding.elasticity_function(INSTANCE_ID, 'running', MOTO_ACCOUNT,
+                                                                         'eu-west-2', MOTO_ACCOUNT, 'log'))
+        self.assertEqual((INSTANCE_ID, '192.192.192.192', 'on board failed', 'AccessDenied'),
+                         put_instance_to_dynamo_table.call_args[0][:4])
+        release_session_on_dynamo.assert_not_called()
+
+@mock_sts
+@mock_ec2
+class ReconciliationTest(unittest.TestCase):
+    def setUp(self):
+        aws_clients.clear()
+        close_circuit(self)
+
+    def test_lambda_handler(self):
+        instances = boto3.resource('ec2').create_instances(ImageId='ami-760aaa0f', MinCount=6, MaxCount=6)
+        instance_ids = [instance.id for instance in instances]
+        instances_status = {instance_ids[0]: 'on boarded', instance_ids[1]: 'pending password', instance_ids[2]: 'on board failed'}
+        with patch('aws_services.get_instances_status_from_dynamo_table', return_value=instances_status), \
+             patch('aws_ec2_auto_onboarding.elasticity_function',
+                   side_effect=lambda instance_id, *args: instance_id != instance_ids[3]) as elasticity:
+            report = reconciliation.lambda_handler({'regions': ['eu-west-2']}, generate_lambda_context(900000))
+        self.assertEqual(len(instance_ids) - 2, elasticity.call_count)
+        elasticity.assert_any_call(instance_ids[2], 'running', MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'log')
+        self.assertEqual((len(instance_ids), 2, len(instance_ids) - 3, 1, True),
+                         (report['instances'], report['skipped'], report['processed'], report['failed'], report['complete']))
+
+    def test_lambda_handler_stops_before_timeout(self):
+        generate_ec2(boto3.resource('ec2'))
+        with patch('aws_services.get_instances_status_from_dynamo_table', return_value={}), \
+             patch('aws_ec2_auto_onboarding.elasticity_function') as elasticity:
+            report = reconciliation.lambda_handler({'regions': ['eu-west-2']}, generate_lambda_context(1000))
+        elasticity.assert_not_called()
+        self.assertFalse(report['complete'])
+
+@mock_sts
+@mock_ec2
+class SweeperTest(unittest.TestCase):
+    def setUp(self):
+        aws_clients.clear()
+        self.circuit_table = close_circuit(self)
+
+    def test_lambda_handler(self):
+        instances = boto3.resource('ec2').create_instances(ImageId='ami-760aaa0f', MinCount=3, MaxCount=3)
+        instances[2].stop()
+        running_id, failing_id, stopped_id = [instance.id for instance in instances]
+        failed_instances = {
+            'on board failed': [
+                {'InstanceId': running_id, 'Status': 'on board failed', 'AccountId': MOTO_ACCOUNT, 'Region': 'eu-west-2'},
+                {'InstanceId': failing_id, 'Status': 'on board failed', 'AccountId': MOTO_ACCOUNT, 'Region': 'eu-west-2',
+                 'SweepAttempts': 2},
+                {'InstanceId': stopped_id, 'Status': 'on board failed', 'AccountId': MOTO_ACCOUNT, 'Region': 'eu-west-2'},
+                {'InstanceId': 'i-deleted', 'Status': 'on board failed', 'AccountId': MOTO_ACCOUNT, 'Region': 'eu-west-2'},
+                {'InstanceId': 'i-legacy', 'Status': 'on board failed'}],
+            'delete failed': [
+                {'InstanceId': 'i-terminated', 'Status': 'delete failed', 'AccountId': '111111111111', 'Region': 'us-east-1'}]}
+        instances_data = {failing_id: {'Status': {'S': 'on board failed'}}}
+        with patch('aws_services.get_instances_to_sweep', side_effect=lambda status, *args: failed_instances[status]), \
+             patch('aws_services.get_account_credentials', return_value={}) as get_account_credentials, \
+             patch('aws_ec2_auto_onboarding.elasticity_function') as elasticity, \
+             patch('aws_services.get_instance_data_from_dynamo_table',
+                   side_effect=lambda instance_id: instances_data.get(instance_id, False)), \
+             patch('aws_services.put_instance_sweep_backoff') as put_instance_sweep_backoff:
+            report = sweeper.lambda_handler({}, generate_lambda_context(900000))
+        get_account_credentials.assert_called_once_with(MOTO_ACCOUNT, MOTO_ACCOUNT, 'eu-west-2')
+        self.assertEqual(4, elasticity.call_count)
+        elasticity.assert_any_call(running_id, 'running', MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'log')
+        elasticity.assert_any_call('i-deleted', 'terminated', MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'log')
+        elasticity.assert_any_call('i-terminated', 'terminated', '111111111111', 'us-east-1', MOTO_ACCOUNT, 'log')
+        self.assertEqual((failing_id, 'on board failed', 3), put_instance_sweep_backoff.call_args[0][:3])
+        self.assertGreater(put_instance_sweep_backoff.call_args[0][3], time.time() + sweeper.SWEEP_BASE_DELAY)
+        self.assertEqual((6, 2, 3, 1, True),
+                         (report['instances'], report['skipped'], report['recovered'], report['failed'], report['complete']))
+
+    def test_lambda_handler_circuit_open(self):
+        self.circuit_table.get_item.return_value = {'Item': {'name': 'PvwaCircuitBreaker', 'OpenUntil': time.time() + 60}}
+        with patch('aws_services.get_instances_to_sweep') as get_instances_to_sweep:
+            report = sweeper.lambda_handler({}, generate_lambda_context(900000))
+        get_instances_to_sweep.assert_not_called()
+        self.assertFalse(report['complete'])
+
+    def test_get_next_sweep_time(self):
+        self.assertLessEqual(sweeper.get_next_sweep_time(1), time.time() + sweeper.SWEEP_BASE_DELAY * 1.2)
+        self.assertLessEqual(sweeper.get_next_sweep_time(20), time.time() + sweeper.SWEEP_MAX_DELAY * 1.2)
+
 ##General Functions##
 def fake_exc(a, b):
     raise Exception('fake_exc')
 
+def generate_lambda_context(remaining_time):
+    context = Mock(invoked_function_arn=f'arn:aws:lambda:eu-west-2:{MOTO_ACCOUNT}:function:AOB', log_stream_name='log')
+    context.get_remaining_time_in_millis.return_value = remaining_time
+    return context
+
+def generate_state_event(state):
+    return {'id': 'event-1', 'account': MOTO_ACCOUNT, 'region': 'eu-west-2',
+            'detail': {'instance-id': INSTANCE_ID, 'state': state}}
+
 def generate_ec2(ec2_resource, returnObject=False):
     ec2_linux_object = ec2_resource.create_instances(ImageId='ami-760aaa0f', MinCount=1, MaxCount=5)
     ec2_windows_object = ec2_resource.create_instances(ImageId='ami-56ec3e2f', MinCount=1, MaxCount=5)
@@ -372,6 +1281,11 @@ def dynamo_create_instances_table(dynamo_resource):
                                          AttributeDefinitions=[{"AttributeName": "InstanceId", "AttributeType": "S"}])
     return table
 
+def generate_pem_key():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=1024, backend=default_backend())
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                     serialization.NoEncryption()).decode()
+
 def dynamo_put_ec2_object(dynamo_resource, ec2_object):
     table = dynamo_resource.Table('Instances')
     table.put_item(Item={'InstanceId': ec2_object})
@@ -380,7 +1294,6 @@ def dynamo_put_ec2_object(dynamo_resource, ec2_object):
 def func_create_instance(ec2_class, ec2_object):
     mocky = Mock()
     mocky.return_value = ['1', '2']
-    @patch('kp_processing.save_key_pair', return_value=True)
     @patch('instance_processing.get_instance_password_data', return_value='StrongPassword')
     @patch('kp_processing.convert_pem_to_ppk', return_value='VeryValue')
     @patch('kp_processing.decrypt_password', mocky)
@@ -423,6 +1336,19 @@ def mock_pvwa_integration(method, parameters, return_code=int, json_response=Non
     output = invoke()
     return output
 
+def create_accounts_index_table():
+    boto3.client('dynamodb').create_table(
+        TableName=aws_services.ACCOUNTS_INDEX_TABLE_NAME, BillingMode='PAY_PER_REQUEST',
+        KeySchema=[{'AttributeName': 'SafeName', 'KeyType': 'HASH'}, {'AttributeName': 'AccountId', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'SafeName', 'AttributeType': 'S'},
+                              {'AttributeName': 'AccountId', 'AttributeType': 'S'},
+                              {'AttributeName': 'AddressKey', 'AttributeType': 'S'}],
+        LocalSecondaryIndexes=[{'IndexName': aws_services.ACCOUNTS_INDEX_ADDRESS_INDEX_NAME,
+                                'KeySchema': [{'AttributeName': 'SafeName', 'KeyType': 'HASH'},
+                                              {'AttributeName': 'AddressKey', 'KeyType': 'RANGE'}],
+                                'Projection': {'ProjectionType': 'ALL'}}])
+    return boto3.resource('dynamodb').Table(aws_services.ACCOUNTS_INDEX_TABLE_NAME)
+
 def mock_requests_response(code=int, json_response=None):
     response = requests.Response()
     response.status_code = code
@@ -456,5 +1382,17 @@ class EC2Details:
     def set_image_description(self, image_description):
         self.details['image_description'] = image_description
 
+
+# The PVWA circuit is closed, its item is not read from DynamoDB
+def close_circuit(test_case):
+    circuit_table = MagicMock()
+    circuit_table.get_item.return_value = {}
+    patcher = patch('circuit_breaker.get_circuit_table', return_value=circuit_table)
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+    circuit_breaker.circuit_state['expiration'] = 0
+    return circuit_table
+
+
 if __name__ == '__main__':
     unittest.main()